@@ -115,46 +115,81 @@ function trackStatus(request_id) {
     ws.addEventListener("error", (_) => (isBusy = false));
 }
 
-function updateSongTable() {
-    get("/songs")
-        .then((response) => response.json())
-        .then((json) => {
-            const songTable = document.getElementById("song-table");
-
-            // XXX: Force clear table
-            songTable.innerHTML = "";
-
-            for (const song of json) {
-                const row = songTable.insertRow();
-                row.setAttribute("data-song-id", song.id);
-
-                // XXX: Add Z as the given time is in UTC
-                row.insertCell().innerText = song.title;
-                row.insertCell().innerText = song.artists
-                    .map((a) => a["name"])
-                    .join(",");
-                row.insertCell().innerText = song.album["name"];
-                const downloadCell = row.insertCell();
-                row.insertCell().innerText = new Date(
-                    `${song["created_date"]}Z`
-                ).toLocaleString();
-                row.insertCell().innerText =
-                    song.tagger === null ? "-" : song.tagger.name;
-
-                const downloadButton = document.createElement("button");
-                downloadButton.innerText = "Download";
-                downloadButton.classList.add("btn");
-                downloadButton.classList.add("btn-primary");
-                downloadButton.classList.add("btn-sm");
-                downloadButton.addEventListener("click", () => {
-                    downloadURI(BASE_URL + `/download/${song.id}`);
-                });
-                downloadCell.appendChild(downloadButton);
+function addSongRows(songs) {
+    const songTable = document.getElementById("song-table");
+
+    for (const song of songs) {
+        const row = songTable.insertRow();
+        row.setAttribute("data-song-id", song.id);
+
+        // XXX: Add Z as the given time is in UTC
+        row.insertCell().innerText = song.title;
+        row.insertCell().innerText = song.artists
+            .map((a) => a["name"])
+            .join(",");
+        row.insertCell().innerText = song.album["name"];
+        const downloadCell = row.insertCell();
+        row.insertCell().innerText = new Date(
+            `${song["created_date"]}Z`
+        ).toLocaleString();
+        row.insertCell().innerText =
+            song.tagger === null ? "-" : song.tagger.name;
+
+        const downloadButton = document.createElement("button");
+        downloadButton.innerText = "Download";
+        downloadButton.classList.add("btn");
+        downloadButton.classList.add("btn-primary");
+        downloadButton.classList.add("btn-sm");
+        downloadButton.addEventListener("click", () => {
+            downloadURI(BASE_URL + `/download/${song.id}`);
+        });
+        downloadCell.appendChild(downloadButton);
+    }
+}
+
+/**
+ * Fetch a page of songs and add them to the song table.
+ * @param {string|null} cursor - the cursor of the page, null for the first page
+ */
+function loadSongs(cursor) {
+    const songTable = document.getElementById("song-table");
+    const loadMoreButton = document.getElementById("load-more-songs-btn");
+
+    const params = new URLSearchParams({ limit: songTable.dataset.pageSize });
+    if (cursor !== null) {
+        params.set("cursor", cursor);
+    }
+
+    loadMoreButton.disabled = true;
+
+    get(`/songs?${params}`)
+        .then((response) => {
+            const nextCursor = response.headers.get("X-Next-Cursor");
+            return response.json().then((json) => [json, nextCursor]);
+        })
+        .then(([json, nextCursor]) => {
+            if (cursor === null) {
+                // XXX: Force clear table
+                songTable.innerHTML = "";
             }
+
+            addSongRows(json);
+
+            songTable.dataset.nextCursor = nextCursor || "";
+            loadMoreButton.hidden = nextCursor === null;
         })
-        .catch((error) => console.error("Error:", error));
+        .catch((error) => console.error("Error:", error))
+        .finally(() => (loadMoreButton.disabled = false));
 }
 
+function updateSongTable() {
+    loadSongs(null);
+}
+
+document.getElementById("load-more-songs-btn").addEventListener("click", () => {
+    loadSongs(document.getElementById("song-table").dataset.nextCursor);
+});
+
 const inputForm = document.getElementById("input-form");
 inputForm.addEventListener("submit", (ev) => {
     ev.preventDefault();
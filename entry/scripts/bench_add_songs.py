@@ -0,0 +1,71 @@
+#!/bin/env python
+"""
+Compare adding songs one by one with ``add_song`` against a single ``add_songs`` batch.
+
+Usage: bench_add_songs.py [N]
+"""
+import sys
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from sqlalchemy.orm import Session
+
+from src.db import Song, add_song, add_songs, init
+from src.schemas import SongMetadataForDownload
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+
+def generate_songs(n):
+    rng = random.Random(42)
+    artists = [f'Artist {i}' for i in range(500)]
+    albums = [f'Album {i}' for i in range(200)]
+    taggers = [f'Tagger {i}' for i in range(20)] + [None]
+
+    return [
+        (
+            SongMetadataForDownload(
+                title=f'Song {i}',
+                album=rng.choice(albums),
+                artists=rng.sample(artists, rng.randint(1, 3)),
+                original_artists=rng.sample(artists, rng.randint(0, 2)),
+                video_id=f'{i:011d}',
+                tagger=rng.choice(taggers),
+                thumbnail_url=None,
+            ),
+            Path(f'/tmp/songs/song-{i}.mp3'),
+        )
+        for i in range(n)
+    ]
+
+
+def bench(name, f, songs):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = init(Path(tmp) / 'bench.sqlite')
+        s = Session(engine)
+
+        start = time.perf_counter()
+        f(s, songs)
+        elapsed = time.perf_counter() - start
+
+        assert s.query(Song).count() == len(songs)
+        s.close()
+        engine.dispose()
+
+    print(f'{name:<10} {elapsed:8.2f}s  {len(songs) / elapsed:10.0f} songs/s')
+
+
+def one_by_one(s, songs):
+    for meta, path in songs:
+        add_song(s, meta, path)
+
+
+if __name__ == '__main__':
+    songs = generate_songs(N)
+    print(f'Adding {N} songs')
+    bench('add_song', one_by_one, songs)
+    bench('add_songs', add_songs, songs)
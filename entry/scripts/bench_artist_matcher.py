@@ -0,0 +1,90 @@
+#!/bin/env python
+"""
+Benchmark the indexed artist matcher against a full scan with thefuzz,
+and check that both produce the same guesses.
+"""
+import sys
+import os
+import time
+
+sys.path.append(os.getcwd())
+from src.matcher import ArtistMatcher
+from src.metadata import guess_artist
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT
+from src.snapshot import load_artists
+
+# Titles of covers as they are uploaded on youtube
+TITLES = [
+    '【歌ってみた】KING / Kanaria【Sakura Miko/さくらみこ】',
+    '【オリジナル曲】Stellar Stellar / 星街すいせい(official)',
+    'ghost / 星街すいせい(Cover)',
+    'Tokino Sora - 夢色アウトライン (Cover)',
+    '【歌ってみた】 ド屑 / 白上フブキ(cover)',
+    '【cover】夜に駆ける/YOASOBI 【天音かなた/ホロライブ】',
+    'REFLECT - Gawr Gura (Original Song)',
+    'Mori Calliope - Dead Beats (Official Music Video)',
+    '【歌ってみた】シャルル / 兎田ぺこら cover',
+    'Usada Pekora - Pekorandom Brain! (cover)',
+    '【歌ってみた】アイドル / YOASOBI covered by 湊あくあ',
+    'Shirakami Fubuki - Say!ファンファーレ!',
+    '【MV】Ahoy!! 我ら宝鐘海賊団☆【宝鐘マリン/ホロライブ3期生】',
+    'Houshou Marine - Ahoy!! (cover)',
+    '[Cover] unravel / 猫又おかゆ',
+    '【歌ってみた】再上映 / 戌神ころね',
+    'Ninomae Ina\'nis - Violet (cover)',
+    'Amelia Watson - Red (Cover)',
+    'Takanashi Kiara - HINOTORI (Original Song)',
+    '【Original MV】Ochame Kinou / Hololive Gamers',
+    '【歌ってみた】ロキ / 大神ミオ×白上フブキ',
+    'Nekomata Okayu & Inugami Korone - God knows... (cover)',
+    '【cover】Shinunoga E-Wa / 角巻わため',
+    'Tsunomaki Watame - Everlasting Song',
+    '【歌ってみた】地球最後の告白を / 常闇トワ',
+    'Hakos Baelz - PSYCHO (cover)',
+    'Ouro Kronii - Daydream Café (Cover)',
+    'IRyS - caesura of despair (Original Song)',
+    '【歌枠】karaoke ~ sing with me ~【Kobo Kanaeru/hololive ID】',
+    'Vestia Zeta - Last Dance (cover)',
+    'Kureiji Ollie - Bad Apple!! (cover)',
+    '【3DMV】Rabbit Hole / 兎田ぺこら × 宝鐘マリン',
+    'Sakura Miko - Mikorune (Original)',
+    '【歌ってみた】beautiful life / 桃鈴ねね',
+    'Momosuzu Nene - Nenenenenene',
+    '【歌ってみた】可愛くてごめん / 紫咲シオン',
+    'Airani Iofifteen - Kawaikute Gomen (cover)',
+    '【cover】群青 / 癒月ちょこ',
+    'Kagura Mea - Cinderella Girl',
+    'Kizuna AI - Hello, Morning',
+]
+
+ROUNDS = 3
+
+artist_names, artist_lookup, _ = load_artists(ARTISTS, ARTISTS_SNAPSHOT)
+
+start = time.perf_counter()
+matcher = ArtistMatcher(artist_names)
+print(f'Built index over {len(matcher)} names in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+
+def bench(names):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        results = [guess_artist(t, names, artist_lookup) for t in TITLES]
+    return results, (time.perf_counter() - start) / (ROUNDS * len(TITLES))
+
+
+expected, scan_time = bench(artist_names)
+actual, index_time = bench(matcher)
+
+mismatches = [t for t, e, a in zip(TITLES, expected, actual) if e != a]
+shortlist = sum(len(matcher.candidates(t, 80)) for t in TITLES) / len(TITLES)
+
+print(f'full scan  {scan_time * 1000:8.2f}ms/title')
+print(f'indexed    {index_time * 1000:8.2f}ms/title, {shortlist:.0f} candidates on average')
+print(f'speedup    {scan_time / index_time:8.1f}x')
+print(f'parity     {len(TITLES) - len(mismatches)}/{len(TITLES)} titles')
+
+for t in mismatches:
+    print(f'  mismatch: {t}')
+
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,145 @@
+#!/bin/env python
+"""
+Measure the memory the artist lookups cost every worker, comparing lookups of
+pydantic models, as the previous snapshot format loaded them, with the artist
+store mapped from the snapshot.
+
+Every worker reads every artist through the lookups, like reindexing the artists
+does, then runs a full garbage collection. Reading objects that were loaded before
+the fork writes their reference counts, which copies their pages into the worker.
+The memory of workers that load nothing is subtracted, the numbers are only the
+cost of the lookups. PSS divides shared pages between the workers sharing them.
+
+Linux only, reads /proc/self/smaps_rollup.
+
+Usage: entry/scripts/bench_artist_memory.py [workers]
+"""
+import sys
+import os
+import gc
+import multiprocessing
+import subprocess
+import time
+
+sys.path.append(os.getcwd())
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT
+from src.snapshot import build_snapshot, load_artists
+
+WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1] != '--run' else 4
+
+
+def load_objects():
+    """The lookups as plain objects, every artist is one model shared by the lookups."""
+    names, lookup, yt_lookup = load_artists(ARTISTS, ARTISTS_SNAPSHOT)
+    artists = {}
+
+    def materialize(view):
+        if view.id not in artists:
+            artists[view.id] = view.to_metadata()
+        return artists[view.id]
+
+    return (
+        list(names),
+        {name: materialize(artist) for name, artist in lookup.items()},
+        {yt_id: materialize(artist) for yt_id, artist in yt_lookup.items()},
+    )
+
+
+LOADERS = {
+    'none': lambda: None,
+    'objects': load_objects,
+    'store': lambda: load_artists(ARTISTS, ARTISTS_SNAPSHOT),
+}
+
+
+def memory() -> dict:
+    """Rss, Pss and private memory of this process in KiB."""
+    values = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if parts[0].endswith(':') and len(parts) == 3:
+                values[parts[0][:-1]] = int(parts[1])
+
+    return {
+        'rss': values['Rss'],
+        'pss': values['Pss'],
+        'private': values['Private_Clean'] + values['Private_Dirty'],
+    }
+
+
+def touch(lookups):
+    if lookups is None:
+        return
+
+    names, lookup, yt_lookup = lookups
+    for name in lookup:
+        artist = lookup[name]
+        artist.name, artist.alternative_names
+    for yt_id in yt_lookup:
+        yt_lookup[yt_id].accounts
+
+
+def worker(loader: str, lookups, barrier, results):
+    if lookups is None:
+        lookups = LOADERS[loader]()
+
+    touch(lookups)
+    gc.collect()
+
+    # Measure when all workers are alive, so shared pages are divided between all of them
+    barrier.wait()
+    results.put(memory())
+    barrier.wait()
+
+
+def run(loader: str, preload: bool, workers: int):
+    """Start workers in this fresh process and print their average memory."""
+    ctx = multiprocessing.get_context('fork')
+    lookups = LOADERS[loader]() if preload else None
+
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(loader, lookups, barrier, results)) for _ in range(workers)]
+    for p in processes:
+        p.start()
+
+    measured = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+
+    average = {key: sum(m[key] for m in measured) / workers for key in measured[0]}
+    print(' '.join(f'{key}={value:.0f}' for key, value in average.items()))
+
+
+def measure(loader: str, preload: bool) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, '--run', loader, str(int(preload)), str(WORKERS)],
+        check=True, capture_output=True, text=True,
+    ).stdout.split()
+    return {key: float(value) for key, value in (item.split('=') for item in output)}
+
+
+def main():
+    if sys.argv[1:2] == ['--run']:
+        run(sys.argv[2], sys.argv[3] == '1', int(sys.argv[4]))
+        return
+
+    start = time.perf_counter()
+    build_snapshot(ARTISTS, ARTISTS_SNAPSHOT)
+    print(f'Built {ARTISTS_SNAPSHOT} ({ARTISTS_SNAPSHOT.stat().st_size / 1024:.0f} KiB) '
+          f'in {time.perf_counter() - start:.2f}s')
+    print(f'{WORKERS} workers, KiB per worker for the artist lookups')
+    print(f'{"":<26}{"private":>10}{"pss":>10}{"rss":>10}')
+
+    for preload in (True, False):
+        baseline = measure('none', preload)
+        for loader in ('objects', 'store'):
+            result = measure(loader, preload)
+            label = f'{loader}, {"loaded before fork" if preload else "loaded per worker"}'
+            print(f'{label:<26}' + ''.join(f'{result[key] - baseline[key]:>10.0f}'
+                                           for key in ('private', 'pss', 'rss')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/bin/env python
+"""
+Compare the startup cost of processing the vdb dump against loading the snapshot.
+"""
+import sys
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from src.metadata import load_vdb_artists
+from src.settings import ARTISTS
+from src.snapshot import build_snapshot, load_snapshot
+
+ROUNDS = 5
+
+
+def bench(name, f):
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+
+    print(f'{name:<10} median {statistics.median(timings) * 1000:8.1f}ms  min {min(timings) * 1000:8.1f}ms')
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    snapshot = Path(tmp) / 'artists.snapshot'
+    build_snapshot(ARTISTS, snapshot)
+
+    print(f'{ARTISTS}: {ARTISTS.stat().st_size} bytes, snapshot: {snapshot.stat().st_size} bytes')
+    bench('json', lambda: load_vdb_artists(ARTISTS))
+    bench('snapshot', lambda: load_snapshot(ARTISTS, snapshot))
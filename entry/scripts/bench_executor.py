@@ -0,0 +1,79 @@
+#!/bin/env python
+"""
+Compare the throughput of the thread and process download executors,
+by converting N copies of a local media file concurrently.
+
+Usage: entry/scripts/bench_executor.py <media file> [N]
+"""
+import sys
+import os
+import asyncio
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+import eyed3
+
+from src.metadata import encode_and_tag
+from src.schemas import SongMetadataForDownload
+from src.tasks.executor import DownloadExecutor
+
+COVER = Path('data/artists/covers/default.jpg')
+
+
+def convert(media_file: Path, i: int) -> float:
+    start = time.perf_counter()
+
+    meta = SongMetadataForDownload(
+        title=f'Benchmark {i}',
+        artists=['Benchmark'],
+        album='Benchmark',
+        original_artists=[],
+        video_id=str(i),
+        tagger=None,
+        thumbnail_url=None,
+    )
+    song = encode_and_tag(media_file, meta, COVER)
+
+    # Parse the result like the legacy pipeline does, this holds the GIL
+    eyed3.load(song)
+
+    return time.perf_counter() - start
+
+
+async def bench(mode: str, media_file: Path, n: int, tmp_dir: Path):
+    copies = []
+    for i in range(n):
+        copy = tmp_dir / f'{mode}-{i}{media_file.suffix}'
+        shutil.copy(media_file, copy)
+        copies.append(copy)
+
+    executor = DownloadExecutor(mode)
+    executor.start(asyncio.get_running_loop())
+
+    # Warm up the pool, so process start up is not measured
+    await asyncio.gather(*(executor.run(time.sleep, 0) for _ in range(os.cpu_count() or 1)))
+
+    start = time.perf_counter()
+    durations = await asyncio.gather(*(executor.run(convert, c, i) for i, c in enumerate(copies)))
+    total = time.perf_counter() - start
+
+    executor.shutdown()
+
+    print(f'{mode:<8} {n} jobs in {total:6.2f}s, {n / total:5.2f} jobs/s, '
+          f'mean job time {sum(durations) / n:5.2f}s')
+
+
+async def main():
+    media_file = Path(sys.argv[1])
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('thread', 'process'):
+            await bench(mode, media_file, n, Path(tmp))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
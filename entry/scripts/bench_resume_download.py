@@ -0,0 +1,134 @@
+#!/bin/env python
+"""
+Download a local media file through an HTTP server that drops connections,
+to check that downloads are retried and resumed from the partial file.
+
+Every response is cut off after <drop after> bytes, until the server dropped
+<drops> connections. With --no-range the server ignores range requests,
+like servers that do not support resuming, so bytes are downloaded again.
+
+Usage: entry/scripts/bench_resume_download.py <media file> [drops] [drop after] [--no-range]
+"""
+import sys
+import os
+import hashlib
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from src.tasks.download import init_ydl_options
+from src.tasks.resume import TransferMeter, download_with_retry, partial_size
+
+CONTENT_TYPES = {'.webm': 'audio/webm', '.m4a': 'audio/mp4', '.mp3': 'audio/mpeg', '.ogg': 'audio/ogg'}
+
+
+def make_handler(data: bytes, content_type: str, drops: int, drop_after: int, support_range: bool):
+    state = {'drops': 0, 'requests': 0}
+    lock = threading.Lock()
+
+    class FlakyHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.send_head(0, len(data), 200)
+
+        def do_GET(self):
+            with lock:
+                state['requests'] += 1
+
+            start, status = 0, 200
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if support_range and match and int(match.group(1)) < len(data):
+                start, status = int(match.group(1)), 206
+
+            self.send_head(start, len(data), status)
+            body = data[start:]
+
+            with lock:
+                drop = state['drops'] < drops and len(body) > drop_after
+                if drop:
+                    state['drops'] += 1
+
+            if drop:
+                self.wfile.write(body[:drop_after])
+                self.wfile.flush()
+                self.close_connection = True
+                # Cut the connection without sending the rest of the response
+                self.connection.shutdown(2)
+            else:
+                self.wfile.write(body)
+
+        def send_head(self, start: int, size: int, status: int):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(size - start))
+            if support_range:
+                self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+            self.end_headers()
+
+    return FlakyHandler, state
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+
+    media = Path(args[0])
+    drops = int(args[1]) if len(args) > 1 else 3
+    data = media.read_bytes()
+    drop_after = int(args[2]) if len(args) > 2 else max(1, len(data) // (drops + 2))
+    support_range = '--no-range' not in sys.argv
+
+    handler, state = make_handler(
+        data, CONTENT_TYPES.get(media.suffix, 'application/octet-stream'), drops, drop_after, support_range)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/{media.name}'
+
+    with tempfile.TemporaryDirectory() as out:
+        out_dir = Path(out)
+        meter = TransferMeter()
+        options = init_ydl_options(out_dir, 'media', [meter], extract_audio=False)
+        options['quiet'] = True
+
+        delays = []
+        start = time.perf_counter()
+        attempts = download_with_retry(
+            url, options, out_dir, 'media', meter,
+            retries=drops + 1, backoff_base=.05, backoff_max=.5,
+            on_retry=lambda attempt, e: print(f'attempt {attempt} failed, {partial_size(out_dir, "media")} bytes kept'),
+            sleep=lambda d: (delays.append(d), time.sleep(d)),
+        )
+        elapsed = time.perf_counter() - start
+
+        downloaded = next(p for p in out_dir.iterdir() if p.suffix not in ('.part', '.ytdl'))
+        intact = hashlib.sha256(downloaded.read_bytes()).digest() == hashlib.sha256(data).digest()
+
+    server.shutdown()
+
+    print(f'file size:        {len(data)} bytes')
+    print(f'range requests:   {"yes" if support_range else "no"}')
+    print(f'connections cut:  {state["drops"]} after {drop_after} bytes')
+    print(f'requests:         {state["requests"]}')
+    print(f'attempts:         {attempts}')
+    print(f'transferred:      {meter.transferred} bytes ({meter.transferred / len(data):.2f}x file size)')
+    print(f're-transferred:   {meter.retransferred} bytes')
+    print(f'backoff:          {sum(delays):.2f}s over {len(delays)} retries')
+    print(f'elapsed:          {elapsed:.2f}s')
+    print(f'file intact:      {intact}')
+
+    if not intact:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/bin/env python
+"""
+Measure the throughput of re-tagging songs after their artist was renamed,
+comparing ``add_metadata`` per file with the re-tagger.
+
+Songs are generated with ffmpeg and an embedded cover, once like songs encoded before
+``ID3_PADDING`` existed (10 bytes of padding), and once with the padding. The first
+re-tag of the old songs rewrites them with padding, later re-tags fit in place.
+``add_metadata`` reads the cover from a local file here, when downloading it fetches it.
+
+Usage: entry/scripts/bench_retag.py [--files N] [--workers N] [--seconds S]
+"""
+import sys
+import os
+import argparse
+import logging
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from sqlalchemy.orm import Session
+
+from src.db import add_songs, init, Artist
+from src.metadata import add_metadata
+from src.retag import Retagger
+from src.schemas import DownloadJob, RetagRequest, SongMetadataForDownload, Status
+from src.settings import ID3_PADDING, RETAG_WORKERS
+
+
+def generate_song(directory: Path, seconds: int, padding: int) -> Path:
+    cover = directory / 'cover.jpg'
+    if not cover.exists():
+        subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=s=480x360', '-frames:v', '1',
+                        str(cover)], check=True)
+
+    song = directory / f'padding-{padding}.mp3'
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'sine=d={seconds}', '-i', str(cover),
+        '-map', '0:a', '-map', '1:v', '-c:a', 'libmp3lame', '-b:a', '192k', '-c:v', 'copy',
+        '-id3v2_version', '3', '-metadata', 'title=Song', '-metadata', 'artist=Artist', '-metadata', 'album=Album',
+        '-metadata_header_padding', str(padding), str(song),
+    ], check=True)
+    return song
+
+
+def copy_songs(engine, source: Path, directory: Path, artist: str, n: int):
+    directory.mkdir()
+    songs = []
+    for i in range(n):
+        path = directory / f'song-{i}.mp3'
+        shutil.copyfile(source, path)
+        meta = SongMetadataForDownload(title=f'Song {i}', artists=[artist, f'Artist {i % 50}'], album='Album',
+                                       original_artists=[], video_id=f'{i:011d}', tagger=None, thumbnail_url=None)
+        songs.append((meta, path))
+
+    s = Session(engine)
+    add_songs(s, songs)
+    s.close()
+    return songs
+
+
+def report(name: str, n: int, elapsed: float, detail: str = ''):
+    print(f'{name:<34} {elapsed:7.2f}s {n / elapsed:8.0f} files/s  {detail}')
+
+
+def rename(retagger: Retagger, engine, artist: str, new_name: str):
+    s = Session(engine)
+    artist_id = s.query(Artist.id).filter(Artist.name == artist).scalar()
+    s.close()
+
+    job = DownloadJob(request_id=uuid.uuid4(), status=Status.WAITING, percentage_done=0.0, last_update=time.time())
+    start = time.perf_counter()
+    stats = retagger.run(RetagRequest(artist_id=artist_id, artist_name=new_name), job, lambda _: None)
+    elapsed = time.perf_counter() - start
+    return stats, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the throughput of re-tagging songs.')
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=RETAG_WORKERS, help='threads writing files')
+    parser.add_argument('--seconds', type=int, default=240, help='length of the generated songs')
+    args = parser.parse_args()
+
+    logging.getLogger('eyed3').setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        engine = init(tmp / 'bench.sqlite')
+        old = generate_song(tmp, args.seconds, -1)
+        padded = generate_song(tmp, args.seconds, ID3_PADDING)
+        print(f'{args.files} songs of {old.stat().st_size / 1024 / 1024:.1f} MiB, {args.workers} workers')
+
+        songs = copy_songs(engine, old, tmp / 'add_metadata', 'Baseline', args.files)
+        start = time.perf_counter()
+        for meta, path in songs:
+            add_metadata(path, meta.copy(update={'artists': ['Renamed baseline', *meta.artists[1:]]}), tmp / 'cover.jpg')
+        report('add_metadata, 10 bytes padding', args.files, time.perf_counter() - start)
+
+        retagger = Retagger(engine, lambda: {}, args.workers, ID3_PADDING)
+        copy_songs(engine, old, tmp / 'old', 'Old', args.files)
+        copy_songs(engine, padded, tmp / 'padded', 'Padded', args.files)
+
+        runs = (
+            ('re-tag, 10 bytes padding', 'Old', 'Old renamed'),
+            ('re-tag again', 'Old renamed', 'Old renamed again'),
+            (f're-tag, {ID3_PADDING} bytes padding', 'Padded', 'Padded renamed'),
+            ('re-tag, tags match', 'Padded renamed', 'Padded renamed'),
+        )
+        for name, artist, new_name in runs:
+            stats, elapsed = rename(retagger, engine, artist, new_name)
+            report(name, stats.songs, elapsed, f'{stats.in_place} in place, {stats.rewritten} rewritten, '
+                                               f'{stats.unchanged} unchanged, {stats.failed} failed')
+
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/bin/env python
+"""
+Measure search latency on a synthetic library, comparing the FTS5 index against a LIKE scan.
+
+Usage: bench_search.py [N songs]
+"""
+import sys
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src import search
+from src.db import add_songs, init
+from src.schemas import SongMetadataForDownload
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT
+from src.snapshot import load_artists
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+BATCH = 5_000
+ROUNDS = 20
+
+WORDS = ('blue', 'star', 'night', 'dream', 'heart', 'rain', 'summer', 'light', 'song', 'sky',
+         'moon', 'fire', 'snow', 'world', 'love', 'time', 'shine', 'flower', 'melody', 'tomorrow')
+
+
+def generate_songs(n, artist_names):
+    rng = random.Random(42)
+    albums = [f'Album {i}' for i in range(1_000)]
+
+    for i in range(n):
+        yield (
+            SongMetadataForDownload(
+                title=' '.join(rng.sample(WORDS, 3)) + f' {i}',
+                album=rng.choice(albums),
+                artists=rng.sample(artist_names, rng.randint(1, 2)),
+                original_artists=[],
+                video_id=f'{i:011d}',
+                tagger=None,
+                thumbnail_url=None,
+            ),
+            Path(f'/tmp/songs/song-{i}.mp3'),
+        )
+
+
+def bench(name, f):
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    p95 = timings[int(len(timings) * .95) - 1]
+    print(f'{name:<32} median {statistics.median(timings) * 1000:8.2f}ms  p95 {p95 * 1000:8.2f}ms')
+
+
+def like_scan(conn, q):
+    return conn.execute(text('''
+        SELECT id, title FROM song WHERE title LIKE :q
+        UNION ALL SELECT id, name FROM artist WHERE name LIKE :q
+        UNION ALL SELECT id, name FROM album WHERE name LIKE :q
+        LIMIT 20
+    '''), {'q': f'%{q}%'}).all()
+
+
+if __name__ == '__main__':
+    artist_names, artist_lookup, _ = load_artists(ARTISTS, ARTISTS_SNAPSHOT)
+    artist_names = [n for n in artist_names if n in artist_lookup]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = init(Path(tmp) / 'bench.sqlite')
+        s = Session(engine)
+
+        songs = list(generate_songs(N, artist_names))
+        start = time.perf_counter()
+        for i in range(0, N, BATCH):
+            add_songs(s, songs[i:i + BATCH], artist_lookup=artist_lookup)
+        print(f'Added {N} songs with incremental indexing in {time.perf_counter() - start:.2f}s')
+
+        start = time.perf_counter()
+        count = search.rebuild_index(engine, artist_lookup)
+        print(f'Rebuilt index of {count} entries in {time.perf_counter() - start:.2f}s')
+
+        alias = next(a for n in artist_names for a in artist_lookup[n].alternative_names if a.isascii())
+        queries = {
+            'word': 'melody',
+            'prefix': 'tomo',
+            'two words': 'blue night',
+            'artist': artist_names[0],
+            'alias': alias,
+            'miss': 'zzzzz',
+        }
+
+        for name, q in queries.items():
+            bench(f'fts   {name} ({q})', lambda: search.search(s, q))
+            bench(f'like  {name} ({q})', lambda: like_scan(s, q))
+
+        s.close()
+        engine.dispose()
@@ -0,0 +1,108 @@
+#!/bin/env python
+"""
+Measure the thumbnail cache against fetching every thumbnail, with thumbnails
+served by a local HTTP server that adds latency to every request.
+
+Songs pick one of a few thumbnails, like songs of the same video or channel.
+Reports the time spent fetching, the time a job waits for its prefetched
+thumbnail after its download, and the size of downscaled thumbnails.
+
+Usage: entry/scripts/bench_thumbnail_cache.py [songs] [thumbnails] [latency ms] [max dimension]
+"""
+import sys
+import os
+import functools
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from src.metadata import fetch_thumbnail
+from src.thumbnails import ThumbnailCache
+
+SONGS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+THUMBNAILS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+LATENCY = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else .1
+MAX_DIMENSION = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+# Time a simulated download takes
+DOWNLOAD_SECONDS = .2
+
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        super().do_GET()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        served = tmp / 'served'
+        served.mkdir()
+
+        # A maxres sized thumbnail
+        image = served / 'maxres.jpg'
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=size=1280x720',
+                        '-frames:v', '1', '-q:v', '2', str(image)], check=True)
+        for i in range(THUMBNAILS):
+            os.link(image, served / f'{i}.jpg')
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(SlowHandler, directory=str(served)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+
+        rng = random.Random(42)
+        urls = [f'{base}/{rng.randrange(THUMBNAILS)}.jpg' for _ in range(SONGS)]
+
+        start = time.perf_counter()
+        for url in urls:
+            fetch_thumbnail(url)
+        uncached = time.perf_counter() - start
+
+        cache = ThumbnailCache(tmp / 'cache', 256 * 1024 * 1024)
+        start = time.perf_counter()
+        for url in urls:
+            cache.get(url)
+        cached = time.perf_counter() - start
+
+        # Prefetch during a simulated download, then wait for the thumbnail as the convert stage does
+        prefetching = ThumbnailCache(tmp / 'prefetch', 256 * 1024 * 1024)
+        waits = []
+        for url in urls[:THUMBNAILS]:
+            prefetching.prefetch(url)
+            time.sleep(DOWNLOAD_SECONDS)
+            start = time.perf_counter()
+            prefetching.get(url)
+            waits.append(time.perf_counter() - start)
+        prefetching.close()
+
+        small = ThumbnailCache(tmp / 'small', 256 * 1024 * 1024, max_dimension=MAX_DIMENSION)
+        downscaled = small.get(urls[0])
+
+        # A cache that holds only a few thumbnails
+        bounded = ThumbnailCache(tmp / 'bounded', 5 * image.stat().st_size)
+        for url in urls:
+            bounded.get(url)
+        bounded_files = len(list((tmp / 'bounded').glob('*.jpg')))
+
+        server.shutdown()
+
+        print(f'{SONGS} songs, {THUMBNAILS} thumbnails, {LATENCY * 1000:.0f}ms latency')
+        print(f'fetch every thumbnail: {uncached:.2f}s')
+        print(f'thumbnail cache:       {cached:.2f}s ({cache.hits} hits, {cache.misses} misses)')
+        print(f'wait after a {DOWNLOAD_SECONDS * 1000:.0f}ms download: '
+              f'{max(waits) * 1000:.1f}ms max (serial fetch would add {LATENCY * 1000:.0f}ms)')
+        print(f'thumbnail size:        {image.stat().st_size} bytes, '
+              f'{downscaled.stat().st_size} bytes at max {MAX_DIMENSION}px')
+        print(f'bounded cache:         {bounded_files} files, {bounded.hits} hits, {bounded.misses} misses')
+
+
+if __name__ == '__main__':
+    main()
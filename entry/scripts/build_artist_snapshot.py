@@ -0,0 +1,18 @@
+#!/bin/env python
+"""
+Precompile the artist index snapshot, so the server does not have to
+process the vdb dump on startup.
+"""
+import sys
+import os
+import time
+
+sys.path.append(os.getcwd())
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT
+from src.snapshot import build_snapshot
+
+start = time.perf_counter()
+artist_names, _, yt_lookup = build_snapshot(ARTISTS, ARTISTS_SNAPSHOT)
+
+print(f'Wrote {ARTISTS_SNAPSHOT} with {len(artist_names)} names and {len(yt_lookup)} channels '
+      f'in {time.perf_counter() - start:.2f}s')
@@ -1,30 +1,180 @@
 #!/bin/env python
+"""
+Download the Youtube channel thumbnails of all artists as their covers.
+
+Channels are taken from the artist database and looked up 50 at a time,
+covers are downloaded in parallel and written atomically into the cover
+directory. A manifest next to the covers remembers the url and ETag of
+every cover, covers with an unchanged url are skipped. With --revalidate
+they are requested again, conditionally, and only replaced if they changed.
+
+Usage: entry/scripts/download_yt_thumbnails.py [--workers N] [--revalidate] [--limit N]
+"""
 import sys
 import os
+import argparse
+import concurrent.futures
+import json
+import tempfile
+import time
 from pathlib import Path
-from urllib import request
+from typing import Dict, Optional, Tuple
+from urllib import error, request
 
-import slugify
 from dotenv import load_dotenv
 
 sys.path.append(os.getcwd())
-from src.metadata import load_artists, YoutubeAPI
+from src.covers import cover_filename
+from src.metadata import PREFERRED_THUMBNAIL_RES, YoutubeAPI
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT, COVER_DIR
+from src.snapshot import load_artists
+
+MANIFEST = COVER_DIR / 'manifest.json'
+
+DOWNLOADED = 'downloaded'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write a file so readers see either the old or the new file, never a partial one."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_manifest() -> Dict[str, dict]:
+    try:
+        return json.loads(MANIFEST.read_text(encoding='utf8'))
+    except FileNotFoundError:
+        return {}
+
+
+def channel_thumbnail(thumbnails: Dict[str, dict]) -> Optional[str]:
+    for res in ('high', *PREFERRED_THUMBNAIL_RES):
+        if res in thumbnails:
+            return thumbnails[res]['url']
+    return None
+
+
+def download_cover(filename: str, url: str, entry: Optional[dict], revalidate: bool,
+                   timeout: float) -> Tuple[str, int, Optional[dict]]:
+    """
+    Download a cover unless it is unchanged.
+
+    :return: the outcome, the number of bytes received and the new manifest entry
+    """
+    path = COVER_DIR / filename
+    known = entry is not None and entry.get('url') == url and path.exists()
+
+    if known and not revalidate:
+        return SKIPPED, 0, entry
+
+    headers = {}
+    if known and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if known and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    try:
+        with request.urlopen(request.Request(url, headers=headers), timeout=timeout) as response:
+            data = response.read()
+            info = response.info()
+    except error.HTTPError as e:
+        if e.code == 304:
+            return UNCHANGED, 0, entry
+        raise
+
+    write_atomic(path, data)
+    return DOWNLOADED, len(data), {
+        'url': url,
+        'etag': info.get('ETag'),
+        'last_modified': info.get('Last-Modified'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the channel thumbnails of all artists as covers.')
+    parser.add_argument('--workers', type=int, default=8, help='the number of concurrent downloads')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='request covers with an unchanged url again, only changed covers are replaced')
+    parser.add_argument('--limit', type=int, default=None, help='only download the covers of the first N artists')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds until a download times out')
+    args = parser.parse_args()
+
+    load_dotenv('.env')
+    start = time.perf_counter()
+
+    _, _, yt_lookup = load_artists(ARTISTS, ARTISTS_SNAPSHOT)
+
+    # Artists can have several channels, the cover is taken from the first one
+    channel_artists = {}
+    seen = set()
+    for yt_id, artist in yt_lookup.items():
+        if artist.name not in seen:
+            seen.add(artist.name)
+            channel_artists[yt_id] = artist.name
+    channel_ids = list(channel_artists)[:args.limit]
+
+    YoutubeAPI.init()
+    lookup_start = time.perf_counter()
+    channels = YoutubeAPI.channel_info(channel_ids)
+    lookup_time = time.perf_counter() - lookup_start
+    print(f'Looked up {len(channels)} of {len(channel_ids)} channels in {lookup_time:.2f}s')
+
+    COVER_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest()
+    counts = {DOWNLOADED: 0, UNCHANGED: 0, SKIPPED: 0, FAILED: 0}
+    received = 0
+
+    download_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        futures = {}
+        for ch in channels:
+            url = channel_thumbnail(ch.snippet.thumbnails)
+            if url is None:
+                counts[FAILED] += 1
+                print(f'{channel_artists[ch.id]}: channel {ch.id} has no thumbnail')
+                continue
 
-load_dotenv('.env')
-artists, _ = load_artists(Path('data/artists/artists.yaml'))
+            filename = cover_filename(channel_artists[ch.id])
+            future = executor.submit(
+                download_cover, filename, url, manifest.get(filename), args.revalidate, args.timeout)
+            futures[future] = filename
 
-YoutubeAPI.init()
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            try:
+                outcome, size, entry = future.result()
+            except Exception as e:  # noqa
+                counts[FAILED] += 1
+                print(f'{filename}: {e}')
+                continue
 
-channels = YoutubeAPI.channel_info([a.yt_id for a in artists])
+            counts[outcome] += 1
+            received += size
+            manifest[filename] = entry
+            if outcome == DOWNLOADED:
+                print(f'{filename} ({size} bytes)')
 
-for ch in channels:
-    artist = next(a for a in artists if a.yt_id == ch.id)
+    download_time = time.perf_counter() - download_start
+    write_atomic(MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode())
 
-    thumbnail_url = ch.snippet.thumbnails['high']['url']
+    requested = counts[DOWNLOADED] + counts[UNCHANGED]
+    print(f'{counts[DOWNLOADED]} downloaded, {counts[UNCHANGED]} unchanged, '
+          f'{counts[SKIPPED]} skipped, {counts[FAILED]} failed')
+    print(f'{received / 1024:.0f} KiB in {download_time:.2f}s, '
+          f'{requested / download_time if download_time else 0:.1f} covers/s, '
+          f'{received / 1024 / download_time if download_time else 0:.0f} KiB/s '
+          f'with {args.workers} workers')
+    print(f'Total {time.perf_counter() - start:.2f}s')
 
-    with request.urlopen(thumbnail_url) as response:
-        subtype = response.info().get_content_subtype()
 
-        print(f'{slugify.slugify(artist.name)}.{subtype}')
-        with open(f'data/artists/covers/{slugify.slugify(artist.name)}.{subtype}', 'wb') as f:
-            f.write(response.read())
+if __name__ == '__main__':
+    main()
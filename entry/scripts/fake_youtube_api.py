@@ -0,0 +1,203 @@
+#!/bin/env python
+"""
+A local fake of the Youtube Data API, serving the videos and channels endpoints
+the server uses, for testing without a developer key or network access.
+
+Every video and channel ID exists, except IDs starting with 'missing', and gets
+a generated snippet. Videos of the channels in the artist database can be requested
+as '<channel id>.<anything>', their snippet has that channel as channelId.
+Requests can be slowed down and failed at random to exercise timeouts and retries.
+
+Run the server against it with:
+
+    YOUTUBE_API_ROOT_URL=http://127.0.0.1:8765/ YOUTUBE_DEVELOPER_KEY=fake uvicorn ...
+
+Usage: entry/scripts/fake_youtube_api.py [--port N] [--latency MS] [--fail-rate F] [--check]
+"""
+import sys
+import os
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+sys.path.append(os.getcwd())
+
+
+def thumbnails(name: str, url: Optional[str] = None) -> dict:
+    return {
+        res: {'url': url or f'https://i.ytimg.com/vi/{name}/{res}.jpg', 'width': width, 'height': height}
+        for res, width, height in (('default', 120, 90), ('medium', 320, 180), ('high', 480, 360))
+    }
+
+
+def video_item(video_id: str, thumbnail_url: Optional[str] = None) -> dict:
+    channel_id = video_id.split('.', 1)[0] if '.' in video_id else 'UCfake'
+    return {
+        'kind': 'youtube#video',
+        'id': video_id,
+        'snippet': {
+            'title': f'Fake cover {video_id}',
+            'channelId': channel_id,
+            'channelTitle': 'Fake channel',
+            'thumbnails': thumbnails(video_id, thumbnail_url),
+        },
+    }
+
+
+def channel_item(channel_id: str) -> dict:
+    return {
+        'kind': 'youtube#channel',
+        'id': channel_id,
+        'snippet': {
+            'title': f'Fake channel {channel_id}',
+            'thumbnails': thumbnails(channel_id),
+        },
+    }
+
+
+class FakeYoutubeAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency: float = 0, fail_rate: float = 0, seed: int = 0,
+                 thumbnail_url: Optional[str] = None):
+        super().__init__(address, FakeYoutubeHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        # Every video has this thumbnail if set, e.g. a file:// url for running without network access
+        self.thumbnail_url = thumbnail_url
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.connections = 0
+
+    @property
+    def root_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/'
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out closed the connection before the response was sent
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeYoutubeHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like the real API
+    protocol_version = 'HTTP/1.1'
+    server: FakeYoutubeAPI
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.count('requests')
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        with self.server.lock:
+            fail = self.server.rng.random() < self.server.fail_rate
+        if fail:
+            self.server.count('failures')
+            return self.send_json(503, {'error': {'code': 503, 'message': 'Backend Error'}})
+
+        if 'key' not in query:
+            return self.send_json(403, {'error': {'code': 403, 'message': 'The request is missing a valid API key.'}})
+
+        ids = [i for i in ','.join(query.get('id', [])).split(',') if i and not i.startswith('missing')]
+
+        if url.path == '/youtube/v3/videos':
+            items = [video_item(i, self.server.thumbnail_url) for i in ids]
+            kind = 'youtube#videoListResponse'
+        elif url.path == '/youtube/v3/channels':
+            items = [channel_item(i) for i in ids]
+            kind = 'youtube#channelListResponse'
+        else:
+            return self.send_json(404, {'error': {'code': 404, 'message': 'Not Found'}})
+
+        self.send_json(200, {'kind': kind, 'pageInfo': {'totalResults': len(items)}, 'items': items})
+
+
+def check(server: FakeYoutubeAPI, requests: int):
+    """Request the fake API through the client from several threads and report the connections used."""
+    import asyncio
+
+    import src.settings as settings
+    settings.YOUTUBE_API_ROOT_URL = server.root_url
+    settings.YOUTUBE_DEVELOPER_KEY = settings.YOUTUBE_DEVELOPER_KEY or 'fake'
+
+    from src.metadata import YoutubeAPI, get_metadata_async
+    YoutubeAPI.init()
+    # Every request goes to the fake
+    YoutubeAPI.configure_cache(1, 0)
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(get_metadata_async(f'video{i}', [], {}, {}) for i in range(requests)),
+            return_exceptions=True,
+        )
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(run())
+    errors = [r for r in results if isinstance(r, Exception)]
+    YoutubeAPI.close()
+
+    print(f'{requests} metadata requests in {elapsed:.2f}s, {len(errors)} failed')
+    print(f'{server.requests} API requests ({server.failures} failed and retried) '
+          f'over {server.connections} connections')
+    for e in errors[:3]:
+        print(f'  {type(e).__name__}: {e}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake of the Youtube Data API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every request')
+    parser.add_argument('--fail-rate', type=float, default=0, help='fraction of requests answered with a 503')
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='make N metadata requests through the client against the fake and exit')
+    args = parser.parse_args()
+
+    server = FakeYoutubeAPI((args.host, args.port), args.latency / 1000, args.fail_rate)
+
+    if args.check:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        check(server, args.check)
+        server.shutdown()
+        return
+
+    print(f'Serving a fake Youtube API at {server.root_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/bin/env python
+"""
+Import the mp3 files of a directory into the database, like ``POST /admin/library/import``.
+
+Files that were imported before and did not change are skipped, so the
+import can be run again after adding songs. Prints the progress and the
+number of files read per second.
+
+Usage: entry/scripts/import_library.py [directory] [--workers N] [--batch-size N]
+"""
+import sys
+import os
+import argparse
+import time
+import uuid
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+from src.db import init
+from src.library import LibraryImporter
+from src.schemas import DownloadJob, Status
+from src.settings import (
+    ARTISTS, ARTISTS_SNAPSHOT, DB, LIBRARY_IMPORT_BATCH_SIZE, LIBRARY_IMPORT_WORKERS, SONGS_STORAGE,
+)
+from src.snapshot import load_artists
+
+
+def print_progress(job: DownloadJob):
+    stats = job.library_import
+    print(f'{job.percentage_done * 100:5.1f}%  {stats.imported} imported, {stats.unchanged} unchanged, '
+          f'{stats.failed} failed of {stats.found}, {stats.files_per_second:.0f} files/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import the mp3 files of a directory into the database.')
+    parser.add_argument('directory', nargs='?', type=Path, default=SONGS_STORAGE)
+    parser.add_argument('--workers', type=int, default=LIBRARY_IMPORT_WORKERS, help='processes reading tags')
+    parser.add_argument('--batch-size', type=int, default=LIBRARY_IMPORT_BATCH_SIZE,
+                        help='files written per transaction')
+    args = parser.parse_args()
+
+    _, artist_lookup, _ = load_artists(ARTISTS, ARTISTS_SNAPSHOT)
+    importer = LibraryImporter(init(DB), lambda: artist_lookup, args.workers, args.batch_size)
+    job = DownloadJob(request_id=uuid.uuid4(), status=Status.WAITING, percentage_done=0.0, last_update=time.time())
+
+    start = time.perf_counter()
+    stats = importer.run(args.directory, job, print_progress)
+    print(f'Imported {stats.imported} songs from {args.directory} in {time.perf_counter() - start:.2f}s, '
+          f'{stats.files_per_second:.0f} files/s with {args.workers} workers')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/bin/env python
+"""
+Run a playlist through the playlist runner with a fake extractor, a fake Youtube API
+(see fake_youtube_api.py) and the stubbed downloader of load_test_scheduler.py,
+while another user submits a single job.
+
+Reports how many jobs of the playlist were in the scheduler at once, how long the
+single job waited for a download slot, and whether the progress of the playlist
+only increased. Thread executor only, like load_test_scheduler.py.
+
+Usage: entry/scripts/load_test_playlist.py <media file> [videos] [download seconds]
+"""
+import sys
+import os
+import asyncio
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import src.settings as settings
+import src.tasks.download as download
+import src.tasks.resume as resume
+from fake_youtube_api import FakeYoutubeAPI
+from load_test_scheduler import COVER, StubDownloader
+from src.db import init
+from src.dependencies import job_bus, jobs
+from src.metadata import YoutubeAPI
+from src.schemas import DownloadJob, PlaylistRequest, PlaylistStats, SongMetadataForDownload, Status
+from src.tasks.executor import DownloadExecutor
+from src.tasks.playlist import PlaylistRunner
+from src.tasks.scheduler import JobScheduler
+
+
+class FakePlaylistExtractor:
+    """Stands in for :class:`src.tasks.playlist.YtDlpPlaylistExtractor`, every tenth video is unavailable."""
+
+    def __init__(self, videos: int):
+        self.videos = videos
+
+    def extract(self, url: str):
+        return f'Fake playlist {url}', [
+            f'missing{i:05d}' if i % 10 == 9 else f'playlist{i:05d}' for i in range(self.videos)
+        ]
+
+
+async def main():
+    StubDownloader.media_file = Path(sys.argv[1])
+    videos = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    StubDownloader.seconds = float(sys.argv[3]) if len(sys.argv) > 3 else .5
+    resume.yt_dlp.YoutubeDL = StubDownloader
+
+    api = FakeYoutubeAPI(('127.0.0.1', 0), thumbnail_url=COVER.resolve().as_uri())
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    settings.YOUTUBE_API_ROOT_URL = api.root_url
+    settings.YOUTUBE_DEVELOPER_KEY = settings.YOUTUBE_DEVELOPER_KEY or 'fake'
+    YoutubeAPI.init()
+    YoutubeAPI.configure_cache(1, 0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings.SONGS_STORAGE = Path(tmp) / 'songs'
+        download.engine = init(Path(tmp) / 'db.sqlite')
+
+        loop = asyncio.get_running_loop()
+        job_bus.bind(loop)
+        executor = DownloadExecutor('thread', settings.DOWNLOAD_WORKERS)
+        executor.start(loop)
+        scheduler = JobScheduler(executor, settings.DOWNLOAD_SLOTS, settings.CONVERT_SLOTS, settings.MAX_QUEUED_JOBS)
+        runner = PlaylistRunner(scheduler, FakePlaylistExtractor(videos), settings.PLAYLIST_CONCURRENCY, .1)
+
+        parent = DownloadJob(request_id=uuid.uuid4(), status=Status.WAITING, percentage_done=0.0,
+                             last_update=time.time(), playlist=PlaylistStats())
+        jobs.add(parent)
+        start = time.perf_counter()
+        runner.start(parent.request_id, PlaylistRequest(url='https://www.youtube.com/playlist?list=fake'))
+
+        # Another user converts a single song while the playlist runs
+        await asyncio.sleep(StubDownloader.seconds * 2)
+        single = SongMetadataForDownload(
+            title='Single', artists=['Other user'], album='Single', original_artists=[],
+            video_id='single00001', tagger=None, thumbnail_url=COVER.resolve().as_uri(),
+        )
+        single_uid = uuid.uuid4()
+        jobs.add(DownloadJob(request_id=single_uid, status=Status.WAITING, percentage_done=0.0,
+                             last_update=time.time()), single)
+        single_submitted = time.perf_counter()
+        single_started = None
+        scheduler.submit(single_uid, single)
+
+        peak = 0
+        progress = [0.0]
+        while not parent.is_finished():
+            children = [jobs.get(uid) for uid in parent.playlist.jobs]
+            in_scheduler = sum(
+                1 for job in children
+                if job is not None and not job.is_finished() and (not job.is_waiting() or job.queue_position)
+            )
+            peak = max(peak, in_scheduler)
+            if parent.percentage_done != progress[-1]:
+                progress.append(parent.percentage_done)
+            if single_started is None and not jobs[single_uid].is_waiting():
+                single_started = time.perf_counter()
+            await asyncio.sleep(.01)
+
+        total = time.perf_counter() - start
+        executor.shutdown()
+
+    stats = parent.playlist
+    print(f'{stats.videos} videos, {stats.skipped} skipped, {stats.done} done, {stats.failed} failed '
+          f'in {total:.2f}s, status {Status(parent.status).value}')
+    print(f'{settings.DOWNLOAD_SLOTS} download slots, playlist concurrency {settings.PLAYLIST_CONCURRENCY}, '
+          f'peak playlist jobs in the scheduler {peak}')
+    print(f'single job waited {single_started - single_submitted:.2f}s for a download slot')
+    print(f'{len(progress) - 1} playlist progress updates, only increasing: {progress == sorted(progress)}')
+    print(f'{api.requests} Youtube API requests for {videos} videos')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
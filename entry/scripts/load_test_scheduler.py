@@ -0,0 +1,134 @@
+#!/bin/env python
+"""
+Drive many concurrent jobs through the job scheduler with a stubbed downloader.
+
+The downloader sleeps to simulate the network and copies a local media file,
+which is then converted by the real convert stage into a temporary library.
+Thread executor only, the stub is not available in spawned worker processes.
+
+Usage: entry/scripts/load_test_scheduler.py <media file> [jobs] [download seconds]
+"""
+import sys
+import os
+import asyncio
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+sys.path.append(os.getcwd())
+import src.settings as settings
+import src.tasks.download as download
+import src.tasks.resume as resume
+from src.db import init
+from src.dependencies import jobs
+from src.schemas import DownloadJob, SongMetadataForDownload, Status
+from src.tasks.executor import DownloadExecutor
+from src.tasks.scheduler import JobScheduler, QueueFull
+
+COVER = Path('data/artists/covers/default.jpg')
+
+
+class StubDownloader:
+    """Stands in for ``yt_dlp.YoutubeDL``."""
+
+    media_file: Path
+    seconds: float
+    active = 0
+    peak = 0
+
+    def __init__(self, options: dict):
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def download(self, urls):
+        StubDownloader.active += 1
+        StubDownloader.peak = max(StubDownloader.peak, StubDownloader.active)
+        try:
+            for hook in self.options['progress_hooks']:
+                hook({'status': 'downloading', 'downloaded_bytes': 0, 'total_bytes': 1})
+            time.sleep(self.seconds)
+            out = self.options['outtmpl'].replace('%(ext)s', self.media_file.suffix.lstrip('.'))
+            shutil.copy(self.media_file, out)
+            for hook in self.options['progress_hooks']:
+                hook({'status': 'finished'})
+        finally:
+            StubDownloader.active -= 1
+
+
+async def main():
+    StubDownloader.media_file = Path(sys.argv[1])
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    StubDownloader.seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    resume.yt_dlp.YoutubeDL = StubDownloader
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings.SONGS_STORAGE = Path(tmp) / 'songs'
+        download.engine = init(Path(tmp) / 'db.sqlite')
+
+        executor = DownloadExecutor('thread', settings.DOWNLOAD_WORKERS)
+        executor.start(asyncio.get_running_loop())
+        scheduler = JobScheduler(executor, settings.DOWNLOAD_SLOTS, settings.CONVERT_SLOTS, settings.MAX_QUEUED_JOBS)
+
+        submitted = {}
+        rejected = 0
+        peak_converting = 0
+        start = time.perf_counter()
+
+        # Submit all jobs at once, like a burst of requests
+        for i in range(n):
+            req = SongMetadataForDownload(
+                title=f'Load test {i}',
+                artists=['Load test'],
+                album='Load test',
+                original_artists=[],
+                video_id=f'load{i:07d}',
+                tagger=None,
+                thumbnail_url=COVER.resolve().as_uri(),
+            )
+            uid = uuid.uuid4()
+            jobs[uid] = DownloadJob(request_id=uid, status=Status.WAITING, percentage_done=0.0, last_update=time.time())
+            try:
+                scheduler.submit(uid, req)
+                submitted[uid] = time.perf_counter()
+            except QueueFull as e:
+                del jobs[uid]
+                rejected += 1
+                retry_after = e.retry_after
+
+            # Let started jobs take their slots, like between requests
+            await asyncio.sleep(0)
+
+        durations = {}
+        while len(durations) < len(submitted):
+            peak_converting = max(peak_converting, scheduler.converting)
+            for uid, submitted_at in submitted.items():
+                if uid not in durations and jobs[uid].is_finished():
+                    durations[uid] = time.perf_counter() - submitted_at
+            await asyncio.sleep(.01)
+
+        total = time.perf_counter() - start
+        executor.shutdown()
+
+    failed = sum(Status(jobs[uid].status) == Status.ERROR for uid in submitted)
+    latencies = sorted(durations.values())
+
+    print(f'{n} jobs, {settings.DOWNLOAD_SLOTS} download slots, {settings.CONVERT_SLOTS} convert slots, '
+          f'queue of {settings.MAX_QUEUED_JOBS}')
+    print(f'accepted {len(submitted)}, rejected {rejected} with 429'
+          + (f' (last Retry-After {retry_after}s)' if rejected else ''))
+    print(f'done in {total:.2f}s, {len(submitted) / total:.2f} jobs/s, {failed} failed')
+    print(f'job latency median {statistics.median(latencies):.2f}s, max {latencies[-1]:.2f}s')
+    print(f'peak concurrent downloads {StubDownloader.peak}, peak concurrent conversions {peak_converting}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,20 @@
+#!/bin/env python
+"""
+Rebuild the full-text search index from the database,
+e.g. after the artist aliases changed or after editing the database by hand.
+"""
+import sys
+import os
+import time
+
+sys.path.append(os.getcwd())
+from src import search
+from src.db import init
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT, DB
+from src.snapshot import load_artists
+
+start = time.perf_counter()
+_, artist_lookup, _ = load_artists(ARTISTS, ARTISTS_SNAPSHOT)
+count = search.rebuild_index(init(DB), artist_lookup)
+
+print(f'Indexed {count} artists, songs and albums in {time.perf_counter() - start:.2f}s')
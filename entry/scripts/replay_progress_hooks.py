@@ -0,0 +1,203 @@
+#!/bin/env python
+"""
+Replay recorded yt-dlp progress hooks through the ProgressReporter, and count the
+job updates it publishes.
+
+The recording (progress_hooks.json next to this script) holds the hook dicts of three
+downloads of a generated song from a local HTTP server, rate limited by yt-dlp:
+
+- ``http``: a plain download, the hooks have ``total_bytes``
+- ``http_no_length``: the server sends no Content-Length, the hooks have no total
+- ``hls``: a fragmented download, the hooks have ``total_bytes_estimate`` and the fragment index
+
+The clock of the reporter follows the ``elapsed`` of the hooks, or advances by 1/rate
+per call with --rate. With --record the recording is made again, this needs ffmpeg.
+
+Usage: entry/scripts/replay_progress_hooks.py [--rate N] [--record]
+"""
+import sys
+import os
+import argparse
+import functools
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import yt_dlp
+
+sys.path.append(os.getcwd())
+from src.schemas import DownloadJob, Status
+from src.settings import PROGRESS_MIN_DELTA, PROGRESS_MIN_INTERVAL
+from src.tasks.download import init_ydl_options
+from src.tasks.progress import ProgressReporter
+
+RECORDING = Path(__file__).resolve().parent / 'progress_hooks.json'
+# The fields of the hook dicts the reporter may read, the others are left out of the recording
+HOOK_FIELDS = (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'fragment_index', 'fragment_count', 'elapsed',
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def replay(hooks: list, rate: float = None) -> dict:
+    """
+    Feed hook dicts through a reporter.
+
+    :param rate: calls per second, by default the clock follows the ``elapsed`` of the hooks
+    :return: the number of calls and the published (clock, percentage_done, status) of the job
+    """
+    clock = FakeClock()
+    job = DownloadJob(request_id=uuid.uuid4(), status=Status.DOWNLOADING, percentage_done=0.0,
+                      last_update=time.time())
+    updates = []
+    reporter = ProgressReporter(
+        job,
+        lambda j: updates.append((clock.now, j.percentage_done, Status(j.status))),
+        min_interval=PROGRESS_MIN_INTERVAL,
+        min_delta=PROGRESS_MIN_DELTA,
+        clock=clock,
+    )
+
+    for i, hook in enumerate(hooks):
+        if rate is not None:
+            clock.now = i / rate
+        elif hook.get('elapsed') is not None:
+            clock.now = hook['elapsed']
+        reporter(dict(hook))
+
+    assert reporter.calls == len(hooks)
+    assert reporter.published == len(updates)
+    return {'calls': reporter.calls, 'updates': updates}
+
+
+def check(name: str, updates: list):
+    """The invariants of the published updates of a download."""
+    assert updates, f'{name}: nothing was published'
+    assert updates[-1][1:] == (1.0, Status.CONVERTING), f'{name}: the end of the download was not published'
+
+    progress = [percentage for _, percentage, _ in updates]
+    assert progress == sorted(progress), f'{name}: the published progress decreased'
+
+    downloading = [at for at, _, status in updates if status == Status.DOWNLOADING]
+    gaps = [b - a for a, b in zip(downloading, downloading[1:])]
+    assert all(gap >= PROGRESS_MIN_INTERVAL for gap in gaps), f'{name}: updates were published too often'
+
+
+def record(seconds: int, ratelimit: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        serve_dir = tmp / 'serve'
+        serve_dir.mkdir()
+        song = serve_dir / 'song.mp3'
+        subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'sine=d={seconds}',
+                        '-c:a', 'libmp3lame', '-b:a', '128k', str(song)], check=True)
+        subprocess.run(['ffmpeg', '-v', 'error', '-i', str(song), '-c', 'copy', '-f', 'hls', '-hls_time', '4',
+                        '-hls_playlist_type', 'vod', '-hls_segment_filename', str(serve_dir / 'seg%03d.ts'),
+                        str(serve_dir / 'song.m3u8')], check=True)
+
+        class Handler(SimpleHTTPRequestHandler):
+            extensions_map = {**SimpleHTTPRequestHandler.extensions_map, '.m3u8': 'application/vnd.apple.mpegurl'}
+
+            def log_message(self, *args):
+                pass
+
+            def send_no_length_head(self):
+                # Like servers that stream a response of unknown length
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/mpeg')
+                self.end_headers()
+
+            def do_HEAD(self):
+                if self.path != '/no-length/song.mp3':
+                    return super().do_HEAD()
+                self.send_no_length_head()
+
+            def do_GET(self):
+                if self.path != '/no-length/song.mp3':
+                    return super().do_GET()
+
+                self.send_no_length_head()
+                try:
+                    with open(song, 'rb') as f:
+                        shutil.copyfileobj(f, self.wfile)
+                except ConnectionError:
+                    # The generic extractor only reads the start of the response
+                    pass
+                self.close_connection = True
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=str(serve_dir)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        root = f'http://127.0.0.1:{server.server_address[1]}'
+
+        recording = {}
+        urls = (
+            ('http', f'{root}/song.mp3'),
+            ('http_no_length', f'{root}/no-length/song.mp3'),
+            ('hls', f'{root}/song.m3u8'),
+        )
+        for name, url in urls:
+            hooks = []
+
+            def hook(d: dict):
+                recorded = {k: d[k] for k in HOOK_FIELDS if d.get(k) is not None}
+                if 'elapsed' in recorded:
+                    recorded['elapsed'] = round(recorded['elapsed'], 3)
+                hooks.append(recorded)
+
+            options = init_ydl_options(tmp / name, 'song', [hook], extract_audio=False)
+            # A hook is called per block, yt-dlp starts with small blocks and grows them with the speed
+            options.update(ratelimit=ratelimit, buffersize=4096, noresizebuffer=True)
+
+            with yt_dlp.YoutubeDL(options) as ydl:
+                ydl.download([url])
+
+            recording[name] = hooks
+            print(f'Recorded {len(hooks)} hooks of {name}')
+
+        server.shutdown()
+        return recording
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded yt-dlp progress hooks through the reporter.')
+    parser.add_argument('--rate', type=float, help='calls per second, by default the recorded timing is used')
+    parser.add_argument('--record', action='store_true', help=f'record the hooks into {RECORDING.name} first')
+    parser.add_argument('--seconds', type=int, default=120, help='length of the recorded song')
+    parser.add_argument('--ratelimit', type=int, default=256 * 1024, help='bytes per second of the recording')
+    args = parser.parse_args()
+
+    if args.record:
+        recording = record(args.seconds, args.ratelimit)
+        with open(RECORDING, 'w') as f:
+            json.dump(recording, f, separators=(',', ':'))
+            f.write('\n')
+
+    with open(RECORDING) as f:
+        recording = json.load(f)
+
+    print(f'min interval {PROGRESS_MIN_INTERVAL}s, min delta {PROGRESS_MIN_DELTA}')
+    for name, hooks in recording.items():
+        result = replay(hooks, args.rate)
+        updates = result['updates']
+        check(name, updates)
+        duration = updates[-1][0]
+        print(f'{name:<16} {result["calls"]:5d} hooks in {duration:6.2f}s, published {len(updates):3d} updates '
+              f'({len(updates) / result["calls"]:.1%})')
+
+
+if __name__ == '__main__':
+    main()
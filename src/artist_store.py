@@ -0,0 +1,289 @@
+"""
+This module contains the compact artist store, an array-backed form of the artist lookups.
+
+The lookups of :func:`src.metadata.load_vdb_artists` hold a pydantic model per artist
+and account, and a dict entry and string per alias, in every worker. The store keeps the
+same data in a single buffer: every distinct string once in a UTF-8 blob, artists as
+integer IDs, and their aliases and accounts as ranges in offset arrays. Names and
+channel IDs are found by binary search over their sorted order.
+
+The buffer is the payload of the artist snapshot (see :mod:`src.snapshot`), which is
+mapped read-only, so workers share the pages of the file instead of each building its
+own objects, and forked workers do not copy them when reading. Artists are read through
+:class:`ArtistView` and only materialized into :class:`src.schemas.ArtistMetadata`
+for responses.
+
+Layout of the buffer, all integers are native ``u32``::
+
+    counts (8 u32) | string offsets | artist names | alias offsets | aliases
+        | account offsets | accounts (id, type, platform) | names
+        | name keys | name artists | name order | channel keys | channel artists | channel order
+        | strings
+
+Keys are in insertion order, the order arrays sort them by their UTF-8 bytes.
+"""
+import struct
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Iterator, List, Union
+
+from src.schemas import ArtistAccount, ArtistMetadata
+
+_COUNTS = struct.Struct('=8I')
+
+# Lone surrogates can occur in the vdb dump, they are stored as is
+_ERRORS = 'surrogatepass'
+
+
+class ArtistView:
+    """
+    An artist in an :class:`ArtistStore`, with the same attributes as :class:`src.schemas.ArtistMetadata`.
+    Attributes are read from the store on access.
+    """
+
+    __slots__ = ('_store', 'id')
+
+    def __init__(self, store: 'ArtistStore', artist_id: int):
+        self._store = store
+        self.id = artist_id
+
+    @property
+    def name(self) -> str:
+        return self._store._string(self._store._artist_names[self.id])
+
+    @property
+    def alternative_names(self) -> List[str]:
+        store = self._store
+        start, end = store._alias_offsets[self.id], store._alias_offsets[self.id + 1]
+        return [store._string(s) for s in store._aliases[start:end]]
+
+    @property
+    def accounts(self) -> List[ArtistAccount]:
+        store = self._store
+        start, end = store._account_offsets[self.id], store._account_offsets[self.id + 1]
+        fields = [store._string(s) for s in store._accounts[start * 3:end * 3]]
+
+        # The data was validated when the store was built, skip validation
+        return [
+            ArtistAccount.construct(id=fields[i], type=fields[i + 1], platform=fields[i + 2])
+            for i in range(0, len(fields), 3)
+        ]
+
+    def to_metadata(self) -> ArtistMetadata:
+        return ArtistMetadata.construct(
+            name=self.name,
+            alternative_names=self.alternative_names,
+            accounts=self.accounts,
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, ArtistView) and other._store is self._store and other.id == self.id
+
+    def __hash__(self):
+        return hash((id(self._store), self.id))
+
+    def __repr__(self):
+        return f'ArtistView({self.id}, {self.name!r})'
+
+
+Artist = Union[ArtistMetadata, ArtistView]
+
+
+def as_metadata(artist: Artist) -> ArtistMetadata:
+    """The artist as a pydantic model, for artists from a store or from plain lookups."""
+    return artist if isinstance(artist, ArtistMetadata) else artist.to_metadata()
+
+
+class _Names(Sequence):
+    __slots__ = ('_store', '_ids')
+
+    def __init__(self, store: 'ArtistStore', ids: memoryview):
+        self._store = store
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._store._string(s) for s in self._ids[i]]
+        return self._store._string(self._ids[i])
+
+    def __iter__(self) -> Iterator[str]:
+        string = self._store._string
+        for s in self._ids:
+            yield string(s)
+
+
+class _ArtistMapping(Mapping):
+    """Read-only mapping from names or channel IDs to :class:`ArtistView`."""
+
+    __slots__ = ('_store', '_keys', '_artists', '_order')
+
+    def __init__(self, store: 'ArtistStore', keys: memoryview, artists: memoryview, order: memoryview):
+        self._store = store
+        self._keys = keys
+        self._artists = artists
+        self._order = order
+
+    def _find(self, key: str) -> int:
+        try:
+            target = key.encode('utf8', _ERRORS)
+        except AttributeError:
+            return -1
+
+        keys, order, raw = self._keys, self._order, self._store._raw
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if raw(keys[order[mid]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(order) and raw(keys[order[lo]]) == target:
+            return order[lo]
+        return -1
+
+    def __getitem__(self, key: str) -> ArtistView:
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return ArtistView(self._store, self._artists[i])
+
+    def __contains__(self, key) -> bool:
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self) -> Iterator[str]:
+        string = self._store._string
+        for s in self._keys:
+            yield string(s)
+
+
+class ArtistStore:
+    """
+    The artist lookups backed by a single buffer, see the module docstring for the layout.
+
+    :param buffer: the encoded store, from :func:`encode_store`. Any buffer works,
+        a read-only ``mmap`` is shared with other processes mapping the same file.
+    :raises ValueError: if the buffer does not match its counts
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < _COUNTS.size:
+            raise ValueError('Artist store is truncated')
+
+        (n_strings, strings_size, n_artists, n_aliases, n_accounts,
+         n_names, n_keys, n_channels) = _COUNTS.unpack_from(view)
+        offset = _COUNTS.size
+
+        def section(length: int) -> memoryview:
+            nonlocal offset
+            end = offset + length * 4
+            if end > len(view):
+                raise ValueError('Artist store is truncated')
+            values = view[offset:end].cast('I')
+            offset = end
+            return values
+
+        self._string_offsets = section(n_strings + 1)
+        self._artist_names = section(n_artists)
+        self._alias_offsets = section(n_artists + 1)
+        self._aliases = section(n_aliases)
+        self._account_offsets = section(n_artists + 1)
+        self._accounts = section(n_accounts * 3)
+        names = section(n_names)
+        name_keys, name_artists, name_order = section(n_keys), section(n_keys), section(n_keys)
+        channel_keys, channel_artists, channel_order = section(n_channels), section(n_channels), section(n_channels)
+
+        if offset + strings_size != len(view):
+            raise ValueError('Artist store size does not match its counts')
+        ends = (self._string_offsets[-1], self._alias_offsets[-1], self._account_offsets[-1])
+        if ends != (strings_size, n_aliases, n_accounts):
+            raise ValueError('Artist store offsets are corrupt')
+
+        self._strings = view[offset:]
+
+        self.names: Sequence = _Names(self, names)
+        self.lookup: Mapping = _ArtistMapping(self, name_keys, name_artists, name_order)
+        self.yt_lookup: Mapping = _ArtistMapping(self, channel_keys, channel_artists, channel_order)
+        self.nbytes = len(view)
+
+    def __len__(self):
+        """The number of artists."""
+        return len(self._artist_names)
+
+    def _raw(self, s: int) -> bytes:
+        return bytes(self._strings[self._string_offsets[s]:self._string_offsets[s + 1]])
+
+    def _string(self, s: int) -> str:
+        return str(self._strings[self._string_offsets[s]:self._string_offsets[s + 1]], 'utf8', _ERRORS)
+
+    def artist(self, artist_id: int) -> ArtistView:
+        if not 0 <= artist_id < len(self):
+            raise IndexError(artist_id)
+        return ArtistView(self, artist_id)
+
+    def lookups(self):
+        """The names, artists by name and artists by Youtube channel ID, like :func:`src.metadata.load_vdb_artists`."""
+        return self.names, self.lookup, self.yt_lookup
+
+
+def encode_store(artist_names: Sequence, artist_lookup: Mapping, yt_lookup: Mapping) -> bytes:
+    """
+    Encode artist lookups into the buffer of an :class:`ArtistStore`.
+
+    :param artist_names: all names in matching order, as returned by :func:`src.metadata.load_vdb_artists`
+    :param artist_lookup: the artists by name
+    :param yt_lookup: the artists by Youtube channel ID
+    """
+    strings: dict = {}
+
+    def intern(s: str) -> int:
+        return strings.setdefault(s, len(strings))
+
+    # Artists are shared between the lookups, store each of them once
+    artist_ids: dict = {}
+    artist_name_ids = array('I')
+    alias_offsets, aliases = array('I', [0]), array('I')
+    account_offsets, accounts = array('I', [0]), array('I')
+
+    def ref(artist: Artist) -> int:
+        key = id(artist) if isinstance(artist, ArtistMetadata) else artist
+        if key not in artist_ids:
+            artist_ids[key] = len(artist_name_ids)
+            artist_name_ids.append(intern(artist.name))
+            aliases.extend(intern(n) for n in artist.alternative_names)
+            alias_offsets.append(len(aliases))
+            for a in artist.accounts:
+                accounts.extend((intern(a.id), intern(a.type), intern(a.platform)))
+            account_offsets.append(len(accounts) // 3)
+        return artist_ids[key]
+
+    def keyed(lookup: Mapping):
+        keys = array('I', (intern(k) for k in lookup))
+        artists = array('I', (ref(a) for a in lookup.values()))
+        encoded = [k.encode('utf8', _ERRORS) for k in lookup]
+        order = array('I', sorted(range(len(encoded)), key=encoded.__getitem__))
+        return keys, artists, order
+
+    names = array('I', (intern(n) for n in artist_names))
+    name_keys, name_artists, name_order = keyed(artist_lookup)
+    channel_keys, channel_artists, channel_order = keyed(yt_lookup)
+
+    blob = bytearray()
+    string_offsets = array('I', [0])
+    for s in strings:
+        blob += s.encode('utf8', _ERRORS)
+        string_offsets.append(len(blob))
+
+    counts = _COUNTS.pack(len(strings), len(blob), len(artist_name_ids), len(aliases), len(accounts) // 3,
+                          len(names), len(name_keys), len(channel_keys))
+    sections = (string_offsets, artist_name_ids, alias_offsets, aliases, account_offsets, accounts, names,
+                name_keys, name_artists, name_order, channel_keys, channel_artists, channel_order)
+
+    return counts + b''.join(s.tobytes() for s in sections) + bytes(blob)
@@ -0,0 +1,172 @@
+"""
+This module contains the artist registry, which holds the artist index used for matching metadata.
+
+The index (names, lookups and fuzzy matcher) is immutable once built. A reload
+builds a complete new index next to the current one and publishes it with a
+single reference assignment, so a reader that took :attr:`ArtistRegistry.current`
+sees one consistent index, and requests are served while the index is rebuilt.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Mapping, Optional, Sequence, Tuple
+
+from src.matcher import ArtistMatcher
+from src.artist_store import Artist
+from src.snapshot import load_artists, source_digest
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ArtistIndex:
+    """
+    A version of the artist database, see :func:`src.metadata.load_vdb_artists` for the lookups.
+    The lookups are backed by the mapped snapshot, see :mod:`src.artist_store`.
+    """
+
+    version: int
+    names: Sequence[str]
+    lookup: Mapping[str, Artist]
+    yt_lookup: Mapping[str, Artist]
+    matcher: ArtistMatcher
+    # Hex sha256 of the artists file the index was built from
+    digest: str
+    built_at: float
+    build_seconds: float
+
+
+# Called with the new index after it was published
+ReloadCallback = Callable[[ArtistIndex], None]
+
+
+class ArtistRegistry:
+    """
+    Holds the current artist index and rebuilds it when the artists file changes.
+
+    :param artists_file: the vdb artists file
+    :param snapshot_file: the precompiled snapshot of ``artists_file``, see :mod:`src.snapshot`
+    """
+
+    def __init__(self, artists_file: Path, snapshot_file: Path):
+        self.artists_file = artists_file
+        self.snapshot_file = snapshot_file
+
+        self.last_error: Optional[str] = None
+        self._on_reload: List[ReloadCallback] = []
+
+        # Held while building, so only one build runs at a time
+        self._build_lock = threading.Lock()
+        self._file_stat: Optional[Tuple[int, int]] = None
+
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self._reloader: Optional[threading.Thread] = None
+
+        self.current: ArtistIndex = self._build(version=1)
+
+    @property
+    def reloading(self) -> bool:
+        return self._build_lock.locked()
+
+    def on_reload(self, callback: ReloadCallback):
+        """Register a function that is called from the reloading thread with every new index."""
+        self._on_reload.append(callback)
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat_result = self.artists_file.stat()
+        except FileNotFoundError:
+            return None
+        return stat_result.st_mtime_ns, stat_result.st_size
+
+    def _build(self, version: int) -> ArtistIndex:
+        start = time.perf_counter()
+        self._file_stat = self._stat()
+        digest = source_digest(self.artists_file).hex()
+        names, lookup, yt_lookup = load_artists(self.artists_file, self.snapshot_file)
+        matcher = ArtistMatcher(names)
+
+        index = ArtistIndex(
+            version=version,
+            names=names,
+            lookup=lookup,
+            yt_lookup=yt_lookup,
+            matcher=matcher,
+            digest=digest,
+            built_at=time.time(),
+            build_seconds=time.perf_counter() - start,
+        )
+        logger.info('Built artist index version %d with %d names in %.2fs',
+                    index.version, len(names), index.build_seconds)
+        return index
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Rebuild the index in the calling thread and publish it.
+
+        :param force: rebuild even if the artists file did not change
+        :return: whether a new index was published, False if the file is unchanged
+            or another reload is running
+        """
+        if not self._build_lock.acquire(blocking=False):
+            return False
+
+        try:
+            if not force and source_digest(self.artists_file).hex() == self.current.digest:
+                self._file_stat = self._stat()
+                return False
+
+            index = self._build(self.current.version + 1)
+            self.current = index
+            self.last_error = None
+        except Exception as e:  # noqa
+            self.last_error = str(e)
+            logger.error('Reloading the artist index failed, keeping version %d: %s',
+                         self.current.version, e, exc_info=True)
+            return False
+        finally:
+            self._build_lock.release()
+
+        for callback in self._on_reload:
+            try:
+                callback(index)
+            except Exception as e:  # noqa
+                logger.error('Artist reload callback failed: %s', e, exc_info=True)
+
+        return True
+
+    def reload_in_background(self, force: bool = False) -> bool:
+        """
+        Start a reload in a background thread.
+
+        :return: False if a reload is running already
+        """
+        if self.reloading or (self._reloader is not None and self._reloader.is_alive()):
+            return False
+
+        self._reloader = threading.Thread(target=self.reload, args=(force,), name='artist-reload', daemon=True)
+        self._reloader.start()
+        return True
+
+    def is_stale(self) -> bool:
+        """Cheap check whether the artists file changed since the current index was built."""
+        return self._stat() != self._file_stat
+
+    def watch(self, interval: float):
+        """Reload in a background thread whenever the artists file changes, checked every ``interval`` seconds."""
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name='artist-watch', daemon=True)
+        self._watcher.start()
+
+    def _watch(self, interval: float):
+        while not self._stop.wait(interval):
+            if self.is_stale() and not self.reloading:
+                logger.info('%s changed, reloading artists', self.artists_file)
+                self.reload()
+
+    def close(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
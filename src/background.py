@@ -0,0 +1,129 @@
+"""
+This module contains the base of the background runners, e.g. the library importer and the re-tagger.
+
+A runner runs one job at a time in a background thread, and reports its progress as a
+:class:`src.schemas.DownloadJob`, which is published like the progress of downloads.
+The library importer is imported by its reader processes, so this module must not
+import :mod:`src.dependencies`.
+"""
+import abc
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from pydantic import BaseModel
+
+from src.schemas import DownloadJob, Status
+
+logger = logging.getLogger(__name__)
+
+# Called from the background thread whenever the job changed
+PublishCallback = Callable[[DownloadJob], None]
+
+
+class Stopped(Exception):
+    """Raised in the background thread when the runner was closed during a run."""
+
+
+class BackgroundRunner(abc.ABC):
+    """
+    Runs jobs in a background thread, one at a time.
+
+    :param progress_interval: the minimum number of seconds between progress updates
+    """
+
+    # The name of the background thread
+    thread_name = 'background'
+    # The field of the job holding the statistics of a run
+    stats_field: str
+
+    def __init__(self, progress_interval: float = 1):
+        self.progress_interval = progress_interval
+
+        # The job of the running or last run
+        self.job: Optional[DownloadJob] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, arg: Any, job: DownloadJob, publish: PublishCallback) -> bool:
+        """
+        Start a run in the background.
+
+        :param arg: what to run, see :meth:`run`
+        :param job: the job to report the progress on
+        :param publish: called from the background thread whenever the job changed
+        :return: False if a run is running already
+        """
+        with self._lock:
+            if self.running:
+                return False
+
+            self.job = job
+            self._thread = threading.Thread(
+                target=self._run_job, args=(arg, job, publish), name=self.thread_name, daemon=True)
+            self._thread.start()
+
+        return True
+
+    def _run_job(self, arg: Any, job: DownloadJob, publish: PublishCallback):
+        try:
+            self.run(arg, job, publish)
+        except Stopped:
+            logger.info('%s was stopped', self.describe(arg))
+        except Exception as e:  # noqa
+            logger.error('%s failed: %s', self.describe(arg), e, exc_info=True)
+            job.status = Status.ERROR
+            job.last_update = time.time()
+            publish(job)
+
+    def close(self):
+        """Stop a running run and wait for its thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def describe(self, arg: Any) -> str:
+        """The name of a run in log messages."""
+        return self.thread_name
+
+    @abc.abstractmethod
+    def run(self, arg: Any, job: DownloadJob, publish: PublishCallback) -> BaseModel:
+        """
+        Run in the calling thread.
+
+        :raises Stopped: if the runner was closed during the run
+        :return: the final statistics, which are also set on the job
+        """
+
+    @abc.abstractmethod
+    def progress(self, stats: BaseModel) -> Optional[float]:
+        """The part of a run that is done, None if it is not known yet."""
+
+    def reporter(self, job: DownloadJob, stats: BaseModel, publish: PublishCallback) -> Callable[..., None]:
+        """
+        Create the function that publishes the statistics of a run on its job,
+        at most every ``progress_interval`` seconds unless it is forced.
+        """
+        last_report = 0.0
+
+        def report(force: bool = False):
+            nonlocal last_report
+            if not force and time.monotonic() - last_report < self.progress_interval:
+                return
+            last_report = time.monotonic()
+
+            percentage_done = self.progress(stats)
+            if percentage_done is not None and not job.is_finished():
+                job.percentage_done = percentage_done
+            # Replaced as a whole, the job may be serialized by another thread while this one runs
+            setattr(job, self.stats_field, stats.copy())
+            job.last_update = time.time()
+            publish(job)
+
+        return report
@@ -0,0 +1,186 @@
+"""
+This module contains the cache for Youtube API responses.
+
+Responses are kept in an in-process LRU with a TTL, and optionally in an
+SQLite table so they survive restarts and are shared between workers.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+import cachetools
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteCacheStore:
+    """
+    Size bounded key-value store with expiring entries, backed by an SQLite table.
+
+    :param path: path to the database file
+    :param ttl: seconds until an entry expires
+    :param max_entries: the maximum number of entries, the oldest entries are evicted first
+    """
+
+    _TABLE = 'response_cache'
+
+    # Stay below the maximum number of host parameters of older SQLite versions
+    _MAX_PARAMS = 500
+
+    def __init__(self, path: Path, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self._TABLE} ('
+            '  key TEXT PRIMARY KEY,'
+            '  value TEXT NOT NULL,'
+            '  created REAL NOT NULL,'
+            '  expires REAL NOT NULL'
+            ')'
+        )
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{self._TABLE}_created ON {self._TABLE} (created)')
+        self._size = self._conn.execute(f'SELECT COUNT(*) FROM {self._TABLE}').fetchone()[0]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        now = time.time()
+        rows = []
+
+        with self._lock:
+            for i in range(0, len(keys), self._MAX_PARAMS):
+                chunk = keys[i:i + self._MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                rows.extend(self._conn.execute(
+                    f'SELECT key, value FROM {self._TABLE} WHERE key IN ({placeholders}) AND expires > ?',
+                    (*chunk, now),
+                ))
+
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_many(self, items: Dict[str, Any]):
+        if not items:
+            return
+
+        now = time.time()
+        rows = [(key, json.dumps(value), now, now + self.ttl) for key, value in items.items()]
+
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany(f'INSERT OR REPLACE INTO {self._TABLE} VALUES (?, ?, ?, ?)', rows)
+                self._size += len(rows)
+                if self._size > self.max_entries:
+                    self._evict(now)
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def _evict(self, now: float):
+        self._conn.execute(f'DELETE FROM {self._TABLE} WHERE expires <= ?', (now,))
+        self._size = self._conn.execute(f'SELECT COUNT(*) FROM {self._TABLE}').fetchone()[0]
+
+        overflow = self._size - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                f'DELETE FROM {self._TABLE} WHERE key IN '
+                f'(SELECT key FROM {self._TABLE} ORDER BY created LIMIT ?)',
+                (overflow,),
+            )
+            self._size -= overflow
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f'DELETE FROM {self._TABLE}')
+            self._size = 0
+
+    def close(self):
+        self._conn.close()
+
+
+class ResponseCache:
+    """
+    Two level cache, an in-process LRU in front of an optional persistent store.
+
+    :param namespace: prefix for keys in the persistent store, so multiple caches can share it
+    :param maxsize: the maximum number of entries in the in-process LRU
+    :param ttl: seconds until an entry expires from the in-process LRU
+    :param store: the persistent store, or None to only cache in-process
+    """
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float, store: Optional[SqliteCacheStore] = None):
+        self.namespace = namespace
+        self.store = store
+
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._lru = cachetools.TTLCache(maxsize, ttl)
+
+    def _store_key(self, key: str) -> str:
+        return f'{self.namespace}:{key}'
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get all cached values of ``keys``.
+
+        :return: the cached values by key, keys that are not cached are left out
+        """
+        found = {}
+        missing = []
+
+        with self._lock:
+            for key in keys:
+                value = self._lru.get(key)
+                if value is None:
+                    missing.append(key)
+                else:
+                    found[key] = value
+            self.hits += len(found)
+
+        stored = {}
+        if missing and self.store is not None:
+            prefix = len(self.namespace) + 1
+            stored = {
+                k[prefix:]: v
+                for k, v in self.store.get_many(self._store_key(k) for k in missing).items()
+            }
+            found.update(stored)
+
+        with self._lock:
+            self._lru.update(stored)
+            self.store_hits += len(stored)
+            self.misses += len(missing) - len(stored)
+
+        return found
+
+    def set_many(self, items: Dict[str, Any]):
+        with self._lock:
+            self._lru.update(items)
+
+        if self.store is not None:
+            self.store.set_many({self._store_key(k): v for k, v in items.items()})
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self.hits = self.store_hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._lru),
+                'hits': self.hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,95 @@
+"""
+This module contains the lookup of artist cover art.
+
+Covers are stored in ``COVER_DIR`` as ``<slugified artist name>.jpg``.
+:class:`CoverIndex` keeps the artist id to cover path mapping in memory,
+so serving a cover does not need a database query.
+"""
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import cachetools
+import slugify
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+def cover_filename(artist_name: str) -> str:
+    return f'{slugify.slugify(artist_name)}.jpg'
+
+
+class CoverIndex:
+    """
+    In-memory map from artist id to cover path.
+
+    Artists are looked up in the database once, after that only the existence
+    of the cover file is checked. Artists without a cover are remembered for
+    ``miss_ttl`` seconds, so covers that are downloaded later show up.
+
+    :param cover_dir: the directory containing the covers
+    :param engine: the database engine to look up artists with
+    :param miss_ttl: the number of seconds to remember artists without a cover
+    """
+
+    def __init__(self, cover_dir: Path, engine: Any, miss_ttl: float = 60):
+        self.cover_dir = cover_dir
+        self.engine = engine
+
+        self._paths: Dict[int, Path] = {}
+        self._misses = cachetools.TTLCache(10_000, miss_ttl)
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Map all artists that have a cover."""
+        covers = {p.name for p in self.cover_dir.glob('*.jpg')} if self.cover_dir.exists() else set()
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('SELECT id, name FROM artist')).all()
+
+        paths = {}
+        for artist_id, name in rows:
+            filename = cover_filename(name)
+            if filename in covers:
+                paths[artist_id] = self.cover_dir / filename
+
+        with self._lock:
+            self._paths = paths
+            self._misses.clear()
+
+        logger.info('Loaded %d covers of %d artists', len(paths), len(rows))
+
+    def get(self, artist_id: int) -> Optional[Path]:
+        """
+        Get the cover path of an artist.
+
+        :return: the path, or None if the artist does not exist or has no cover
+        """
+        path = self._paths.get(artist_id)
+        if path is not None:
+            return path
+
+        with self._lock:
+            if artist_id in self._misses:
+                return None
+
+        with self.engine.connect() as conn:
+            name = conn.execute(text('SELECT name FROM artist WHERE id = :id'), {'id': artist_id}).scalar()
+
+        path = self.cover_dir / cover_filename(name) if name is not None else None
+
+        with self._lock:
+            if path is not None and path.is_file():
+                self._paths[artist_id] = path
+                return path
+
+            self._misses[artist_id] = True
+            return None
+
+    def invalidate(self, artist_id: int):
+        """Forget the cover of an artist, e.g. when its cover file is removed."""
+        with self._lock:
+            self._paths.pop(artist_id, None)
+            self._misses.pop(artist_id, None)
@@ -3,19 +3,35 @@ This module contains the ORM models and crud operations.
 """
 import datetime
 from pathlib import Path
-from typing import Any, List, Optional, Generator
-
-from sqlalchemy import create_engine, Column, Integer, Text, Table, ForeignKey, DateTime
+import logging
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Generator, Tuple
+
+from sqlalchemy import (
+    bindparam, create_engine, insert, literal_column, select, text, tuple_,
+    Column, Integer, Text, Table, ForeignKey, DateTime, Index,
+)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy.orm import joinedload, relationship, selectinload, Session
+
+from src import search
+from src.schemas import ArtistMetadata, SongMetadataForDownload, SongTagUpdate
 
-from src.schemas import SongMetadataForDownload
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# The maximum number of parameters in one IN query,
+# older versions of SQLite do not support more than 999
+_MAX_IN_PARAMS = 500
+
 
 class Song(Base):
     __tablename__ = 'song'
+    __table_args__ = (
+        # Songs are listed newest first, paginated on (created_date, id)
+        Index('ix_song_created_date_id', 'created_date', 'id'),
+    )
 
     # Columns from backrefs
     # necessary for typing
@@ -56,6 +72,9 @@ class Song(Base):
 
 class Artist(Base):
     __tablename__ = 'artist'
+    __table_args__ = (
+        Index('ix_artist_name', 'name', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(Text)
@@ -64,6 +83,9 @@ class Artist(Base):
 
 class Album(Base):
     __tablename__ = 'album'
+    __table_args__ = (
+        Index('ix_album_name', 'name', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(Text)
@@ -72,12 +94,57 @@ class Album(Base):
 
 class Tagger(Base):
     __tablename__ = 'tagger'
+    __table_args__ = (
+        Index('ix_tagger_name', 'name', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(Text)
     songs = relationship('Song', backref='tagger')
 
 
+class StoredMedia(Base):
+    """
+    The stored audio of a Youtube video, songs of the same video can be
+    re-tagged from it instead of downloading the video again.
+    """
+    __tablename__ = 'stored_media'
+    __table_args__ = (
+        Index('ix_stored_media_video_id_profile', 'video_id', 'profile', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    video_id = Column(Text, nullable=False)
+    # The audio pipeline that produced the file
+    profile = Column(Text, nullable=False)
+    filepath = Column(Text, nullable=False)
+    created_date = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class LibraryFile(Base):
+    """
+    A song file seen by a library import, files are read again
+    only when their modification time or size changed.
+    """
+    __tablename__ = 'library_file'
+    __table_args__ = (
+        Index('ix_library_file_filepath', 'filepath', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    filepath = Column(Text, nullable=False)
+    mtime_ns = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    # The song created from the file, None if the file could not be imported
+    song_id = Column(Integer, ForeignKey('song.id'), nullable=True)
+
+
+# (mtime_ns, size, song_id) of a library file
+LibraryFileState = Tuple[int, int, Optional[int]]
+# (filepath, title, artists, album) of a song, the tags of its file
+SongTags = Tuple[str, str, List[str], str]
+
+
 def init(db_name: str) -> Any:
     """
     Initializes sqlite database.
@@ -87,70 +154,495 @@ def init(db_name: str) -> Any:
     """
     engine = create_engine(f'sqlite:///{db_name}', connect_args={"check_same_thread": False})
     Base.metadata.create_all(engine)
+    create_missing_indexes(engine)
+    search.create_index(engine)
 
     return engine
 
 
-def add_song(s: Session, meta: SongMetadataForDownload, path: Path):
+def create_missing_indexes(engine: Any):
+    """
+    Create indexes that were added to existing tables,
+    ``create_all`` only creates the indexes of new tables.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError:
+                # Databases created before names were unique may contain duplicates,
+                # keep lookups indexed until they are merged
+                logger.warning('Duplicate values in %s, creating non-unique index instead', index.name)
+                columns = ', '.join(c.name for c in index.columns)
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        f'CREATE INDEX IF NOT EXISTS {index.name}_non_unique ON {table.name} ({columns})'))
+
+
+def add_song(
+    s: Session,
+    meta: SongMetadataForDownload,
+    path: Path,
+    artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None,
+):
     """
     Adds a song object to the database.
 
     :param s: current db session
     :param meta: the song metadata to create a Song from
     :param path: the host path to the song file
+    :param artist_lookup: the artists by name, for indexing alternative names
+    """
+    add_songs(s, [(meta, path)], artist_lookup=artist_lookup)
+
+
+def add_songs(
+    s: Session,
+    songs: Iterable[Tuple[SongMetadataForDownload, Path]],
+    artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None,
+) -> List[int]:
+    """
+    Adds multiple songs to the database in one transaction,
+    and adds them and their artists and albums to the search index.
+
+    Artists, albums and taggers are looked up for all songs at once,
+    and the missing ones are inserted in bulk. The songs are inserted with
+    core statements, building ORM objects with their backrefs is the
+    bottleneck for large batches.
+
+    :param s: current db session
+    :param songs: the song metadata and host path to the song file of each song
+    :param artist_lookup: the artists by name, for indexing alternative names
+    :return: the ids of the created songs
+    """
+    songs = list(songs)
+
+    artists = get_or_create_by_name(
+        s, Artist, {n for meta, _ in songs for n in (*meta.artists, *meta.original_artists)})
+    albums = get_or_create_by_name(s, Album, {meta.album for meta, _ in songs})
+    taggers = get_or_create_by_name(s, Tagger, {meta.tagger for meta, _ in songs if meta.tagger})
+
+    song_ids = []
+    artist_rows = []
+    original_artist_rows = []
+    insert_song = insert(Song.__table__)
+    for meta, path in songs:
+        # SQLite has no RETURNING for executemany, insert one by one to get the ids
+        song_id = s.execute(insert_song, {
+            'title': meta.title,
+            'filepath': str(path.resolve()),
+            'created_date': datetime.datetime.utcnow(),
+            '_album_id': albums[meta.album].id,
+            '_tagger_id': taggers[meta.tagger].id if meta.tagger else None,
+        }).inserted_primary_key[0]
+        song_ids.append(song_id)
+
+        artist_rows.extend(
+            {'song_id': song_id, 'artist_id': artists[n].id} for n in dict.fromkeys(meta.artists))
+        original_artist_rows.extend(
+            {'song_id': song_id, 'artist_id': artists[n].id} for n in dict.fromkeys(meta.original_artists))
+
+    if artist_rows:
+        s.execute(insert(Song.artist_association), artist_rows)
+    if original_artist_rows:
+        s.execute(insert(Song.original_artist_association), original_artist_rows)
+
+    search.index_entries(s, [
+        *(search.artist_entry(a.id, a.name, artist_lookup) for a in artists.values()),
+        *(('album', a.id, a.name, []) for a in albums.values()),
+        *(
+            ('song', song_id, meta.title, list(dict.fromkeys((*meta.artists, *meta.original_artists))))
+            for song_id, (meta, _) in zip(song_ids, songs)
+        ),
+    ])
+
+    s.commit()
+
+    return song_ids
+
+
+def song_exists(s: Session, path: Path) -> bool:
+    """Whether a song with the file at ``path`` exists."""
+    return s.query(Song.id).filter(Song.filepath == str(path.resolve())).first() is not None
+
+
+def get_stored_media(s: Session, video_id: str, profile: str) -> Optional[Path]:
+    """
+    Get the stored audio of a video.
+
+    :param s: current db session
+    :param video_id: the Youtube video id
+    :param profile: the audio pipeline the audio should be produced by
+    :return: the path to the audio, None if it is not stored or the file is missing
     """
-    song = Song(
-        title=meta.title,
-        artists=get_or_create_artists(s, meta.artists),
-        original_artists=get_or_create_artists(s, meta.original_artists),
-        filepath=str(path.resolve()),
+    filepath = (
+        s.query(StoredMedia.filepath)
+        .filter(StoredMedia.video_id == video_id, StoredMedia.profile == profile)
+        .scalar()
     )
 
-    album = s.query(Album).filter(Album.name == meta.album).scalar()
-    if album is None:
-        song.album = Album(name=meta.album)
-    else:
-        song.album = album
-
-    # Create tagger if not exists
-    if meta.tagger is not None and meta.tagger != '':
-        tagger = s.query(Tagger).filter(Tagger.name == meta.tagger).scalar()
-        if tagger is None:
-            song.tagger = Tagger(name=meta.tagger)
-        else:
-            song.tagger = tagger
-
-    s.add(song)
+    if filepath is None or not Path(filepath).is_file():
+        return None
+
+    return Path(filepath)
+
+
+def set_stored_media(s: Session, video_id: str, profile: str, path: Path):
+    """Store ``path`` as the audio of a video, replacing the previous file."""
+    s.execute(
+        insert(StoredMedia.__table__).prefix_with('OR REPLACE'),
+        {
+            'video_id': video_id,
+            'profile': profile,
+            'filepath': str(path.resolve()),
+            'created_date': datetime.datetime.utcnow(),
+        },
+    )
     s.commit()
 
 
+def get_library_files(s: Session, paths: List[str]) -> Dict[str, LibraryFileState]:
+    """
+    Get the state of library files when they were imported.
+
+    :param s: current db session
+    :param paths: the resolved paths of the files
+    :return: the state of the files that were seen before by path
+    """
+    files = {}
+    for i in range(0, len(paths), _MAX_IN_PARAMS):
+        chunk = paths[i:i + _MAX_IN_PARAMS]
+        rows = (
+            s.query(LibraryFile.filepath, LibraryFile.mtime_ns, LibraryFile.size, LibraryFile.song_id)
+            .filter(LibraryFile.filepath.in_(chunk))
+        )
+        files.update((filepath, (mtime_ns, size, song_id)) for filepath, mtime_ns, size, song_id in rows)
+    return files
+
+
+def get_song_ids_by_path(s: Session, paths: List[str]) -> Dict[str, int]:
+    """Get the ids of the songs with the given resolved file paths, e.g. songs that were downloaded."""
+    songs = {}
+    for i in range(0, len(paths), _MAX_IN_PARAMS):
+        chunk = paths[i:i + _MAX_IN_PARAMS]
+        songs.update(s.query(Song.filepath, Song.id).filter(Song.filepath.in_(chunk)))
+    return songs
+
+
+def set_library_files(s: Session, files: Mapping[str, LibraryFileState]):
+    """
+    Store the state of library files, replacing their previous state.
+    The caller is responsible for committing.
+    """
+    if files:
+        s.execute(
+            insert(LibraryFile.__table__).prefix_with('OR REPLACE'),
+            [
+                {'filepath': path, 'mtime_ns': mtime_ns, 'size': size, 'song_id': song_id}
+                for path, (mtime_ns, size, song_id) in files.items()
+            ],
+        )
+
+
+def delete_songs(s: Session, song_ids: List[int]):
+    """
+    Delete songs and their search entries, e.g. songs of files that changed.
+    The caller is responsible for committing.
+    """
+    for i in range(0, len(song_ids), _MAX_IN_PARAMS):
+        chunk = song_ids[i:i + _MAX_IN_PARAMS]
+        for table in (Song.artist_association, Song.original_artist_association):
+            s.execute(table.delete().where(table.c.song_id.in_(chunk)))
+        s.execute(LibraryFile.__table__.update().where(LibraryFile.song_id.in_(chunk)).values(song_id=None))
+        s.execute(Song.__table__.delete().where(Song.id.in_(chunk)))
+
+    search.remove_entries(s, 'song', song_ids)
+
+
+def update_library_files(s: Session, files: Mapping[str, Tuple[int, int]]):
+    """
+    Update the modification time and size of library files that were changed by the app,
+    so the next library import does not read them again. Files that were not imported are ignored.
+    The caller is responsible for committing.
+
+    :param files: the (mtime_ns, size) of the files by resolved path
+    """
+    if files:
+        table = LibraryFile.__table__
+        s.execute(
+            table.update()
+            .where(table.c.filepath == bindparam('b_filepath'))
+            .values(mtime_ns=bindparam('b_mtime_ns'), size=bindparam('b_size')),
+            [{'b_filepath': path, 'b_mtime_ns': mtime_ns, 'b_size': size} for path, (mtime_ns, size) in files.items()],
+        )
+
+
+def move_song_files(s: Session, moves: Mapping[str, str]):
+    """
+    Point the songs, stored audio and library files of moved files to their new paths.
+    The caller is responsible for committing.
+
+    :param moves: the new resolved path of the files by old resolved path
+    """
+    if moves:
+        params = [{'b_old': old, 'b_new': new} for old, new in moves.items()]
+        for table in (Song.__table__, StoredMedia.__table__, LibraryFile.__table__):
+            s.execute(
+                table.update().where(table.c.filepath == bindparam('b_old')).values(filepath=bindparam('b_new')),
+                params,
+            )
+
+
+def get_song_tags(s: Session, song_ids: List[int]) -> Dict[int, SongTags]:
+    """
+    Get the tags songs are written with, the artists are in the order they were added in.
+
+    :return: the tags of the songs that exist by id
+    """
+    table = Song.artist_association
+    tags = {}
+
+    for i in range(0, len(song_ids), _MAX_IN_PARAMS):
+        chunk = song_ids[i:i + _MAX_IN_PARAMS]
+        rows = (
+            s.query(Song.id, Song.filepath, Song.title, Album.name)
+            .outerjoin(Album, Song._album_id == Album.id)
+            .filter(Song.id.in_(chunk))
+        )
+        tags.update((song_id, (filepath, title, [], album or '')) for song_id, filepath, title, album in rows)
+
+        artists = s.execute(
+            select(table.c.song_id, Artist.name)
+            .join(Artist, Artist.id == table.c.artist_id)
+            .where(table.c.song_id.in_(chunk))
+            .order_by(literal_column(f'{table.name}.rowid'))
+        )
+        for song_id, name in artists:
+            tags[song_id][2].append(name)
+
+    return tags
+
+
+def get_artist_song_ids(s: Session, artist_id: int) -> List[int]:
+    """Get the ids of the songs of an artist, including the songs it is an original artist of."""
+    song_ids = set()
+    for table in (Song.artist_association, Song.original_artist_association):
+        song_ids.update(s.execute(select(table.c.song_id).where(table.c.artist_id == artist_id)).scalars())
+    return sorted(song_ids)
+
+
+def update_songs(
+    s: Session,
+    updates: Iterable[SongTagUpdate],
+    artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None,
+):
+    """
+    Correct the title, artists or album of songs, the search entries of the songs
+    are not updated, see :func:`src.search.reindex_songs`.
+    The caller is responsible for committing.
+
+    :param s: current db session
+    :param updates: the corrected tags, tags that are None are kept
+    :param artist_lookup: the artists by name, for indexing alternative names
+    """
+    updates = list(updates)
+    artists = get_or_create_by_name(s, Artist, {n for u in updates if u.artists is not None for n in u.artists})
+    albums = get_or_create_by_name(s, Album, {u.album for u in updates if u.album is not None})
+
+    table = Song.artist_association
+    for u in updates:
+        values = {}
+        if u.title is not None:
+            values['title'] = u.title
+        if u.album is not None:
+            values['_album_id'] = albums[u.album].id
+        if values:
+            s.execute(Song.__table__.update().where(Song.id == u.id).values(**values))
+
+        if u.artists is not None:
+            s.execute(table.delete().where(table.c.song_id == u.id))
+            if u.artists:
+                s.execute(insert(table), [
+                    {'song_id': u.id, 'artist_id': artists[n].id} for n in dict.fromkeys(u.artists)])
+
+    search.index_entries(s, [
+        *(search.artist_entry(a.id, a.name, artist_lookup) for a in artists.values()),
+        *(('album', a.id, a.name, []) for a in albums.values()),
+    ])
+
+
+def rename_artist(
+    s: Session,
+    artist_id: int,
+    name: str,
+    artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None,
+) -> int:
+    """
+    Rename an artist. If another artist has the name already, the songs of the artist
+    are moved to that artist and the artist is deleted. The search entries of the songs
+    are not updated, see :func:`src.search.reindex_songs`.
+    The caller is responsible for committing.
+
+    :param s: current db session
+    :param artist_id: the artist to rename
+    :param name: the new name
+    :param artist_lookup: the artists by name, for indexing alternative names
+    :return: the id of the artist with the new name
+    """
+    target_id = s.query(Artist.id).filter(Artist.name == name, Artist.id != artist_id).scalar()
+
+    if target_id is None:
+        s.execute(Artist.__table__.update().where(Artist.id == artist_id).values(name=name))
+        search.index_entries(s, [search.artist_entry(artist_id, name, artist_lookup)])
+        return artist_id
+
+    for table in (Song.artist_association, Song.original_artist_association):
+        # Songs of both artists keep a single one, the others keep their position
+        both = select(table.c.song_id).where(table.c.artist_id == target_id)
+        s.execute(table.delete().where(table.c.artist_id == artist_id, table.c.song_id.in_(both)))
+        s.execute(table.update().where(table.c.artist_id == artist_id).values(artist_id=target_id))
+
+    s.execute(Artist.__table__.delete().where(Artist.id == artist_id))
+    search.remove_entries(s, 'artist', [artist_id])
+    logger.info('Merged artist %d into %d (%s)', artist_id, target_id, name)
+
+    return target_id
+
+
+def get_or_create_by_name(session: Session, model: Any, names: Iterable[str]) -> Dict[str, Any]:
+    """
+    Get the rows of ``model`` with the given names, rows that do not exist yet are inserted.
+
+    :param session: current db session
+    :param model: a model with a unique name column, e.g. Artist
+    :param names: the names to get
+    :return: the rows by name
+    """
+    names = list(set(names))
+    if not names:
+        return {}
+
+    rows = _query_by_name(session, model, names)
+
+    missing = [n for n in names if n not in rows]
+    if missing:
+        # Ignore names that were inserted concurrently since the lookup
+        session.execute(
+            insert(model.__table__).prefix_with('OR IGNORE'),
+            [{'name': n} for n in missing],
+        )
+        rows.update(_query_by_name(session, model, missing))
+
+    return rows
+
+
+def _query_by_name(session: Session, model: Any, names: List[str]) -> Dict[str, Any]:
+    rows = {}
+    for i in range(0, len(names), _MAX_IN_PARAMS):
+        chunk = names[i:i + _MAX_IN_PARAMS]
+        rows.update((row.name, row) for row in session.query(model).filter(model.name.in_(chunk)))
+    return rows
+
+
 def get_or_create_artists(session: Session, artist_names: List[str]) -> List[Artist]:
     """
     Create Artist objects for each element in ``artist_names`` if no artist exists
     with the name already.
     """
-    artists = []
-    for name in artist_names:
-        row = session.query(Artist).filter(Artist.name == name).scalar()
-        if row is None:
-            artists.append(Artist(name=name))
-        else:
-            artists.append(row)
+    artists = get_or_create_by_name(session, Artist, artist_names)
+    return [artists[name] for name in artist_names]
 
-    return artists
 
+# The position of a song in the song listing
+SongKey = Tuple[datetime.datetime, int]
 
-def get_songs(session: Session, limit: Optional[int] = None) -> Generator[Song, None, None]:
+
+def get_songs(
+    session: Session,
+    limit: Optional[int] = None,
+    after: Optional[SongKey] = None,
+    page_size: int = 500,
+) -> Generator[Song, None, None]:
     """
     Query Song objects from the database, ordered by created date.
 
+    Songs are fetched in pages of ``page_size`` using keyset pagination on
+    ``(created_date, id)``, with their artists, album and tagger loaded eagerly.
+
     :param session: current db session
     :param limit: the max number of songs to retrieve
+    :param after: only retrieve songs listed after the song with this key
+    :param page_size: the number of songs fetched per query
     :return: a generator yielding the Song objects
     """
-    q = session.query(Song).order_by(Song.created_date.desc())
+    remaining = limit
+
+    while remaining is None or remaining > 0:
+        q = (
+            session.query(Song)
+            .options(
+                selectinload(Song.artists),
+                selectinload(Song.original_artists),
+                joinedload(Song.album),
+                joinedload(Song.tagger),
+            )
+            .order_by(Song.created_date.desc(), Song.id.desc())
+        )
+
+        if after is not None:
+            q = q.filter(tuple_(Song.created_date, Song.id) < after)
+
+        count = page_size if remaining is None else min(page_size, remaining)
+        page = q.limit(count).all()
+
+        yield from page
+
+        if len(page) < count:
+            return
+
+        after = song_key(page[-1])
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def song_key(song: Song) -> SongKey:
+    return song.created_date, song.id
+
+
+def next_song_key(session: Session, limit: int, after: Optional[SongKey] = None) -> Optional[SongKey]:
+    """
+    Get the key of the last song of a page, if more songs follow it.
+    Only the index is scanned, so this is cheap to run before streaming the page.
+
+    :param session: current db session
+    :param limit: the size of the page
+    :param after: the key of the song before the page
+    :return: the key to retrieve the next page with, None if this is the last page
+    """
+    if limit <= 0:
+        # An empty page has no last song to continue after
+        return None
+
+    q = session.query(Song.created_date, Song.id).order_by(Song.created_date.desc(), Song.id.desc())
 
-    if limit is not None:
-        q = q.limit(limit)
+    if after is not None:
+        q = q.filter(tuple_(Song.created_date, Song.id) < after)
 
-    return q.all()
+    keys = q.limit(limit + 1).all()
+    if len(keys) <= limit:
+        return None
+
+    return tuple(keys[limit - 1])
+
+
+def encode_song_key(key: SongKey) -> str:
+    created_date, song_id = key
+    return f'{created_date.isoformat()}_{song_id}'
+
+
+def decode_song_key(cursor: str) -> SongKey:
+    """
+    :raises ValueError: if the cursor is malformed
+    """
+    created_date, _, song_id = cursor.rpartition('_')
+    return datetime.datetime.fromisoformat(created_date), int(song_id)
@@ -1,25 +1,55 @@
-import cachetools
 import uuid
-from typing import TYPE_CHECKING
+from typing import Dict, Tuple
 
 from sqlalchemy.orm import sessionmaker, Session
 
 from src import settings
+from src.artists import ArtistRegistry
+from src.covers import CoverIndex
 from src.db import init
 
-from src.metadata import load_vdb_artists
-from src.settings import ARTISTS, DOWNLOAD_REQUEST_TTL
-
-if TYPE_CHECKING:
-    # Prevent circular import
-    from src.schemas import DownloadJob
+from src.events import JobBus
+from src.jobstore import create_job_store
+from src.library import LibraryImporter
+from src.retag import Retagger
+from src.settings import ARTISTS, ARTISTS_SNAPSHOT, DOWNLOAD_REQUEST_TTL, JOB_UPDATES_PER_SECOND
+from src.thumbnails import ThumbnailCache
 
 # Setup download necessities
-artist_names, artist_lookup, yt_lookup = load_vdb_artists(ARTISTS)
-jobs: cachetools.TTLCache[uuid.UUID, 'DownloadJob'] = cachetools.TTLCache(1_000, DOWNLOAD_REQUEST_TTL)
-
+# Always read the artists through `artist_registry.current`, the index is replaced when it is reloaded
+artist_registry = ArtistRegistry(ARTISTS, ARTISTS_SNAPSHOT)
+jobs = create_job_store(settings.JOB_STORE, settings.JOB_STORE_DB, DOWNLOAD_REQUEST_TTL, settings.JOB_STORE_SIZE)
+job_bus = JobBus(jobs, JOB_UPDATES_PER_SECOND)
+# Unfinished jobs by download key, see ``src.tasks.download.download_key``
+active_downloads: Dict[Tuple[str, str, str], uuid.UUID] = {}
+
+# Worker processes import this module too, the search index is only maintained by the server, see ``src.main``
 engine = init(settings.DB)
 
+covers = CoverIndex(settings.COVER_DIR, engine)
+thumbnails = ThumbnailCache(
+    settings.THUMBNAIL_CACHE_DIR,
+    settings.THUMBNAIL_CACHE_SIZE,
+    max_dimension=settings.THUMBNAIL_MAX_DIMENSION,
+    quality=settings.THUMBNAIL_QUALITY,
+)
+
+library = LibraryImporter(
+    engine,
+    lambda: artist_registry.current.lookup,
+    settings.LIBRARY_IMPORT_WORKERS,
+    settings.LIBRARY_IMPORT_BATCH_SIZE,
+)
+retagger = Retagger(
+    engine,
+    lambda: artist_registry.current.lookup,
+    settings.RETAG_WORKERS,
+    settings.ID3_PADDING,
+    settings.SONGS_STORAGE,
+)
+# The cover of an artist is looked up by its name
+retagger.on_rename(covers.invalidate)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
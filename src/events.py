@@ -0,0 +1,108 @@
+"""
+This module contains the job bus, which pushes job state changes to listeners.
+
+Publishing only wakes up the listeners of a job, every listener then reads the
+latest state of the job. Changes that happen while a listener is still busy
+are therefore coalesced, and listeners are throttled to a maximum rate so a
+chatty download does not flood every client watching it.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional
+
+from src.schemas import DownloadJob, Status
+
+logger = logging.getLogger(__name__)
+
+
+class _JobChannel:
+    def __init__(self):
+        self.changed = asyncio.Event()
+        self.listeners = 0
+
+
+class JobBus:
+    """
+    Event driven delivery of job updates.
+
+    :param jobs: the job store to save and read the latest job states, see :mod:`src.jobstore`
+    :param max_rate: the maximum number of updates per second a listener receives for a job
+    """
+
+    def __init__(self, jobs, max_rate: float):
+        self.jobs = jobs
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+
+        self._channels: Dict[uuid.UUID, _JobChannel] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Set the event loop the listeners run on, used by :meth:`publish_threadsafe`."""
+        self._loop = loop
+
+    @property
+    def listener_count(self) -> int:
+        return sum(c.listeners for c in self._channels.values())
+
+    def publish(self, job: DownloadJob):
+        """Store and signal that ``job`` changed, this must be called on the event loop."""
+        self.jobs.save(job)
+        self.notify(job.request_id)
+
+    def notify(self, uid: uuid.UUID):
+        """Signal that a job changed without storing it, e.g. when it was changed by another worker."""
+        channel = self._channels.get(uid)
+        if channel is not None:
+            channel.changed.set()
+
+    def publish_threadsafe(self, job: DownloadJob):
+        """Signal that ``job`` changed from any thread."""
+        if self._loop is None:
+            raise RuntimeError('JobBus is not bound to an event loop')
+
+        self._loop.call_soon_threadsafe(self.publish, job)
+
+    async def subscribe(self, uid: uuid.UUID, timeout: float) -> AsyncIterator[DownloadJob]:
+        """
+        Iterate over the states of a job, starting with the current state
+        and ending with a finished state.
+
+        :param uid: the job to listen to
+        :param timeout: seconds without progress after which a running job is reported as failed
+        :raises KeyError: if the job does not exist
+        """
+        job = self.jobs[uid]
+
+        channel = self._channels.setdefault(uid, _JobChannel())
+        channel.listeners += 1
+        try:
+            while True:
+                # Clear before reading, so changes made after reading wake us up again
+                channel.changed.clear()
+                job = self.jobs.get(uid, job)
+                sent_at = time.monotonic()
+                yield job
+
+                if job.is_finished():
+                    return
+
+                # Queued jobs make no progress, only running jobs can stall
+                remaining = timeout - (time.time() - job.last_update) if not job.is_waiting() else None
+                try:
+                    await asyncio.wait_for(channel.changed.wait(), max(remaining, 0) if remaining is not None else None)
+                except asyncio.TimeoutError:
+                    if time.time() - job.last_update >= timeout:
+                        logger.info('Job %s timed out', uid)
+                        yield job.copy(update={'status': Status.ERROR})
+                        return
+
+                # Throttle, changes made in the meantime are coalesced into the next state
+                delay = self.min_interval - (time.monotonic() - sent_at)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            channel.listeners -= 1
+            if channel.listeners == 0:
+                del self._channels[uid]
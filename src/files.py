@@ -0,0 +1,189 @@
+"""
+This module contains the serving of stored files with HTTP caching and range support.
+
+- Strong ETags derived from the identity of the file (inode, size and modification time)
+- ``If-None-Match`` and ``If-Modified-Since`` are answered with 304 Not Modified
+- Single byte ranges are answered with 206 Partial Content, so interrupted downloads can be resumed
+"""
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple, Union
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFileResponse(FileResponse):
+    """
+    Sends ``length`` bytes of a file starting at ``offset``.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: Union[str, 'os.PathLike[str]'], offset: int, length: int, **kwargs):
+        super().__init__(path, **kwargs)
+        self.offset = offset
+        self.length = length
+        self.headers['content-length'] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': self.status_code,
+            'headers': self.raw_headers,
+        })
+
+        if self.send_header_only or self.length == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        else:
+            async with await anyio.open_file(self.path, mode='rb') as file:
+                await file.seek(self.offset)
+                remaining = self.length
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        # The file was truncated while sending
+                        break
+                    remaining -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+
+                if remaining > 0:
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        if self.background is not None:
+            await self.background()
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    """Strong ETag of a file, it changes whenever the file is replaced or modified."""
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def is_not_modified(request_headers: Headers, etag: str, mtime: float) -> bool:
+    """
+    Evaluate the conditional request headers, ``If-Modified-Since`` is only
+    considered if there is no ``If-None-Match``.
+    """
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        # Weak comparison, as specified for If-None-Match
+        return '*' in tags or etag in (t.removeprefix('W/') for t in tags)
+
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have a resolution of seconds
+        return int(mtime) <= since
+
+    return False
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single byte range.
+
+    :return: the (offset, length) of the range, or None if it is not a single byte range
+    :raises ValueError: if the range is not satisfiable
+    """
+    match = _RANGE.match(range_header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if first == '':
+        # Suffix range, the last n bytes
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError(f'Unsatisfiable range {range_header}')
+        return size - length, length
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(f'Unsatisfiable range {range_header}')
+
+    return start, end - start + 1
+
+
+def _if_range_matches(if_range: str, etag: str, mtime: float) -> bool:
+    if if_range.startswith('"'):
+        return if_range == etag
+
+    try:
+        return int(mtime) <= parsedate_to_datetime(if_range).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def serve_file(
+    request: Request,
+    path: Union[str, 'os.PathLike[str]'],
+    media_type: str,
+    filename: Optional[str] = None,
+    cache_control: Optional[str] = None,
+) -> Response:
+    """
+    Create a response for a stored file, honoring conditional and range requests.
+
+    :param request: the request for the file
+    :param path: the path to the file
+    :param media_type: the content type of the file
+    :param filename: the name the client should save the file as
+    :param cache_control: the Cache-Control header to send
+    :raises FileNotFoundError: if ``path`` is not a file
+    """
+    stat_result = os.stat(path)
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise FileNotFoundError(path)
+
+    etag = file_etag(stat_result)
+    headers = {
+        'accept-ranges': 'bytes',
+        'etag': etag,
+        'last-modified': formatdate(stat_result.st_mtime, usegmt=True),
+    }
+    if cache_control is not None:
+        headers['cache-control'] = cache_control
+
+    if is_not_modified(request.headers, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    size = stat_result.st_size
+    offset, length, status_code = 0, size, 200
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header is not None and (if_range is None or _if_range_matches(if_range, etag, stat_result.st_mtime)):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, 'content-range': f'bytes */{size}'})
+
+        # Multiple ranges are not supported, those requests get the whole file
+        if byte_range is not None:
+            offset, length = byte_range
+            status_code = 206
+            headers['content-range'] = f'bytes {offset}-{offset + length - 1}/{size}'
+
+    return RangeFileResponse(
+        path,
+        offset,
+        length,
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+        filename=filename,
+        stat_result=stat_result,
+        method=request.method,
+    )
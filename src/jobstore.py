@@ -0,0 +1,343 @@
+"""
+This module contains the stores that hold the state of download jobs.
+
+- :class:`MemoryJobStore` keeps jobs in the process, jobs are lost on restart
+- :class:`SqliteJobStore` persists jobs in an SQLite database in WAL mode,
+  so every uvicorn worker can read every job and interrupted jobs are resumed
+
+Jobs are owned by the worker that runs them, the owner keeps the job object
+and changes it in place, then calls :meth:`save`. Other workers read the job
+from the database and are notified of changes by polling it.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import cachetools
+
+from src.schemas import DownloadJob, SongMetadataForDownload, Status
+
+logger = logging.getLogger(__name__)
+
+# Called with the id of a job that was changed by another worker
+ChangeCallback = Callable[[uuid.UUID], None]
+# Called with an interrupted job claimed by this worker and its request
+ResumeCallback = Callable[[DownloadJob, SongMetadataForDownload], None]
+
+
+class MemoryJobStore:
+    """
+    Jobs in a process local cache, jobs expire ``ttl`` seconds after they are added.
+
+    :param maxsize: the maximum number of jobs, the oldest jobs are evicted first
+    :param ttl: seconds until a job expires
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._jobs: 'cachetools.TTLCache[uuid.UUID, DownloadJob]' = cachetools.TTLCache(maxsize, ttl)
+
+    def __getitem__(self, uid: uuid.UUID) -> DownloadJob:
+        return self._jobs[uid]
+
+    def __contains__(self, uid: uuid.UUID) -> bool:
+        return uid in self._jobs
+
+    def __setitem__(self, uid: uuid.UUID, job: DownloadJob):
+        self._jobs[uid] = job
+
+    def __delitem__(self, uid: uuid.UUID):
+        del self._jobs[uid]
+
+    def get(self, uid: uuid.UUID, default: Optional[DownloadJob] = None) -> Optional[DownloadJob]:
+        return self._jobs.get(uid, default)
+
+    def add(self, job: DownloadJob, request: Optional[SongMetadataForDownload] = None):
+        self._jobs[job.request_id] = job
+
+    def save(self, job: DownloadJob):
+        pass
+
+    def start(self, on_change: ChangeCallback, on_resume: ResumeCallback):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteJobStore:
+    """
+    Jobs in an SQLite table shared by all workers.
+
+    A background thread polls the database for jobs changed by other workers,
+    keeps the heartbeat of this worker up to date, claims the unfinished jobs
+    of workers without a recent heartbeat and deletes expired jobs. Claimed jobs
+    are resumed if they were added with a request, the others are failed.
+
+    :param path: path to the database file
+    :param ttl: seconds after its last change until a job expires
+    :param poll_interval: seconds between polls for changes of other workers
+    :param heartbeat_interval: seconds between heartbeats, a worker is presumed
+        dead after three missed heartbeats
+    """
+
+    def __init__(self, path: Path, ttl: float, poll_interval: float = .25, heartbeat_interval: float = 5):
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+        # Jobs owned by this worker, these are changed in place
+        self._owned: Dict[uuid.UUID, DownloadJob] = {}
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS download_job (
+                request_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                request TEXT,
+                owner TEXT NOT NULL,
+                finished INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_download_job_seq ON download_job (seq);
+            CREATE INDEX IF NOT EXISTS ix_download_job_expires ON download_job (expires);
+            CREATE TABLE IF NOT EXISTS job_worker (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            );
+        ''')
+
+        self._heartbeat()
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __getitem__(self, uid: uuid.UUID) -> DownloadJob:
+        job = self.get(uid)
+        if job is None:
+            raise KeyError(uid)
+        return job
+
+    def __contains__(self, uid: uuid.UUID) -> bool:
+        return self.get(uid) is not None
+
+    def __setitem__(self, uid: uuid.UUID, job: DownloadJob):
+        self.add(job)
+
+    def __delitem__(self, uid: uuid.UUID):
+        with self._lock:
+            self._owned.pop(uid, None)
+            self._conn.execute('DELETE FROM download_job WHERE request_id = ?', (str(uid),))
+
+    def get(self, uid: uuid.UUID, default: Optional[DownloadJob] = None) -> Optional[DownloadJob]:
+        """Get a job, jobs of other workers are read from the database."""
+        job = self._owned.get(uid)
+        if job is not None:
+            return job
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT state FROM download_job WHERE request_id = ? AND expires > ?',
+                (str(uid), time.time()),
+            ).fetchone()
+
+        return DownloadJob.parse_raw(row[0]) if row is not None else default
+
+    def add(self, job: DownloadJob, request: Optional[SongMetadataForDownload] = None):
+        """
+        Add a job owned by this worker, the request is stored for resuming the job.
+        A job can be added again with its request, e.g. once it may be resumed.
+        """
+        self._owned[job.request_id] = job
+        self._write(job, request.json() if request is not None else None)
+
+    def save(self, job: DownloadJob):
+        """Store the current state of a job owned by this worker."""
+        if job.request_id in self._owned:
+            self._write(job)
+
+    def _write(self, job: DownloadJob, request: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO download_job (request_id, state, request, owner, finished, seq, expires)'
+                ' VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM download_job), ?)'
+                ' ON CONFLICT (request_id) DO UPDATE SET'
+                '  state = excluded.state, owner = excluded.owner, finished = excluded.finished,'
+                '  seq = excluded.seq, expires = excluded.expires,'
+                '  request = COALESCE(excluded.request, download_job.request)',
+                (str(job.request_id), job.json(), request, self.worker_id, job.is_finished(),
+                 time.time() + self.ttl),
+            )
+
+    def start(self, on_change: ChangeCallback, on_resume: ResumeCallback):
+        """
+        Start the background thread.
+
+        :param on_change: called from the thread for every job changed by another worker
+        :param on_resume: called from the thread for every interrupted job claimed by this worker
+        """
+        self._thread = threading.Thread(
+            target=self._run, args=(on_change, on_resume), name='job-store', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        with self._lock:
+            self._conn.execute('DELETE FROM job_worker WHERE worker_id = ?', (self.worker_id,))
+            self._conn.close()
+
+    def _run(self, on_change: ChangeCallback, on_resume: ResumeCallback):
+        with self._lock:
+            last_seq = self._conn.execute('SELECT COALESCE(MAX(seq), 0) FROM download_job').fetchone()[0]
+        last_maintenance = 0.0
+
+        while not self._stop.wait(self.poll_interval):
+            try:
+                for uid, seq in self._changes(last_seq):
+                    last_seq = max(last_seq, seq)
+                    on_change(uid)
+
+                if time.monotonic() - last_maintenance >= self.heartbeat_interval:
+                    last_maintenance = time.monotonic()
+                    self._heartbeat()
+                    for job, request in self._claim_orphans():
+                        on_resume(job, request)
+                    for uid in self._fail_orphans():
+                        on_change(uid)
+                    self._cleanup()
+            except Exception as e:  # noqa
+                logger.error('Job store maintenance failed: %s', e, exc_info=True)
+
+    def _changes(self, since: int) -> Iterator[Tuple[uuid.UUID, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT request_id, seq FROM download_job WHERE seq > ? AND owner != ? ORDER BY seq',
+                (since, self.worker_id),
+            ).fetchall()
+
+        for request_id, seq in rows:
+            yield uuid.UUID(request_id), seq
+
+    def _heartbeat(self):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO job_worker (worker_id, heartbeat) VALUES (?, ?)',
+                (self.worker_id, time.time()),
+            )
+
+    def _claim_orphans(self) -> List[Tuple[DownloadJob, SongMetadataForDownload]]:
+        """Take over the unfinished jobs of dead workers."""
+        dead_before = time.time() - 3 * self.heartbeat_interval
+        claimed = []
+
+        with self._lock:
+            self._conn.execute('DELETE FROM job_worker WHERE heartbeat < ?', (dead_before,))
+            rows = self._conn.execute(
+                'SELECT request_id, state, request, owner FROM download_job'
+                ' WHERE NOT finished AND request IS NOT NULL AND expires > ?'
+                ' AND owner NOT IN (SELECT worker_id FROM job_worker)',
+                (time.time(),),
+            ).fetchall()
+
+            for request_id, state, request, owner in rows:
+                # Another worker may claim the same job, only one update matches the owner
+                updated = self._conn.execute(
+                    'UPDATE download_job SET owner = ? WHERE request_id = ? AND owner = ?',
+                    (self.worker_id, request_id, owner),
+                ).rowcount
+                if updated:
+                    claimed.append((request_id, state, request))
+
+        resumed = []
+        for request_id, state, request in claimed:
+            job = DownloadJob.parse_raw(state)
+            job.status = Status.WAITING
+            job.percentage_done = 0.0
+            job.last_update = time.time()
+            job.queue_position = None
+            self._owned[job.request_id] = job
+            self._write(job)
+
+            logger.info('Resuming job %s of a stopped worker', request_id)
+            resumed.append((job, SongMetadataForDownload.parse_raw(request)))
+
+        return resumed
+
+    def _fail_orphans(self) -> List[uuid.UUID]:
+        """
+        Take over the unfinished jobs of dead workers that can't be resumed and fail them,
+        e.g. the jobs of playlists, library imports and re-tags.
+
+        :return: the failed jobs
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT request_id, state, owner FROM download_job'
+                ' WHERE NOT finished AND request IS NULL AND expires > ?'
+                ' AND owner NOT IN (SELECT worker_id FROM job_worker)',
+                (time.time(),),
+            ).fetchall()
+
+            claimed = [
+                (request_id, state) for request_id, state, owner in rows
+                if self._conn.execute(
+                    'UPDATE download_job SET owner = ? WHERE request_id = ? AND owner = ?',
+                    (self.worker_id, request_id, owner),
+                ).rowcount
+            ]
+
+        failed = []
+        for request_id, state in claimed:
+            job = DownloadJob.parse_raw(state)
+            job.status = Status.ERROR
+            job.last_update = time.time()
+            job.queue_position = None
+            self._owned[job.request_id] = job
+            self._write(job)
+
+            logger.info('Failed job %s of a stopped worker, it can not be resumed', request_id)
+            failed.append(job.request_id)
+
+        return failed
+
+    def _cleanup(self):
+        now = time.time()
+        with self._lock:
+            # Unfinished jobs of live workers may be queued for longer than the ttl
+            self._conn.execute(
+                'DELETE FROM download_job WHERE expires < ?'
+                ' AND (finished OR owner NOT IN (SELECT worker_id FROM job_worker))',
+                (now,),
+            )
+
+        # Forget finished jobs once they expired
+        for uid, job in list(self._owned.items()):
+            if job.is_finished() and now - job.last_update > self.ttl:
+                self._owned.pop(uid, None)
+
+
+def create_job_store(kind: str, path: Path, ttl: float, maxsize: int):
+    """
+    Create the job store configured by ``settings.JOB_STORE``.
+
+    :param kind: either 'memory' or 'sqlite'
+    """
+    if kind == 'sqlite':
+        return SqliteJobStore(path, ttl)
+    if kind == 'memory':
+        return MemoryJobStore(maxsize, ttl)
+
+    raise ValueError(f"Unknown job store {kind}, expected 'memory' or 'sqlite'")
@@ -0,0 +1,243 @@
+"""
+This module contains the library importer, which adds existing mp3 files to the database.
+
+Songs normally get into the database when they are downloaded. The importer walks a
+directory of songs that were tagged elsewhere, reads their ID3 tags with eyed3 in a
+process pool and adds them in batches of one transaction each. Files are remembered by
+path, modification time and size (:class:`src.db.LibraryFile`), so importing the same
+directory again only reads the files that are new or changed. Files of downloaded songs
+are known by their path.
+
+The progress of an import is reported as a :class:`src.schemas.DownloadJob`, see
+:mod:`src.background`. This module is imported by the reader processes, so it must not
+import :mod:`src.dependencies`.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import eyed3
+from sqlalchemy.orm import Session
+
+from src.background import BackgroundRunner, PublishCallback, Stopped
+from src.db import (
+    add_songs, delete_songs, get_library_files, get_song_ids_by_path, set_library_files, LibraryFileState,
+)
+from src.schemas import DownloadJob, LibraryImportStats, SongMetadataForDownload, Status
+
+logger = logging.getLogger(__name__)
+
+# Album of songs without an album tag
+UNKNOWN_ALBUM = 'Unknown Album'
+
+# (path, mtime_ns, size) of a file
+LibraryEntry = Tuple[str, int, int]
+# (title, artists, album) of a song
+SongTags = Tuple[str, List[str], str]
+
+
+def scan(directory: Path) -> Iterator[LibraryEntry]:
+    """Find the mp3 files in a directory and its subdirectories, skipping unfinished conversions."""
+    stack = [str(directory.resolve())]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith('.mp3') and not entry.name.endswith('.tmp.mp3') and entry.is_file():
+                    stat_result = entry.stat()
+                    yield entry.path, stat_result.st_mtime_ns, stat_result.st_size
+
+
+def init_reader():
+    """Initializer of the reader processes, eyed3 logs a warning for every malformed frame."""
+    logging.getLogger('eyed3').setLevel(logging.ERROR)
+
+
+def read_tags(path: str) -> Tuple[Optional[SongTags], Optional[str]]:
+    """
+    Read the tags of a song, this runs in the reader processes.
+
+    :return: the tags, or the reason the file can't be imported
+    """
+    try:
+        audio = eyed3.load(path)
+    except Exception as e:  # noqa
+        return None, str(e)
+
+    if audio is None:
+        return None, 'Not an mp3 file'
+    if audio.tag is None:
+        return None, 'No ID3 tag'
+
+    tag = audio.tag
+    # Songs tagged by this app join their artists with commas
+    artists = [a.strip() for a in (tag.artist or '').split(',') if a.strip()]
+    return (tag.title or Path(path).stem, artists, tag.album or UNKNOWN_ALBUM), None
+
+
+class ImportStopped(Stopped):
+    pass
+
+
+class LibraryImporter(BackgroundRunner):
+    """
+    Imports directories of mp3 files in a background thread, one import at a time.
+    Closing the importer stops a running import, the songs of the batches that were written stay imported.
+
+    :param engine: the database engine
+    :param artist_lookup: returns the current artists by name, for indexing their alternative names
+    :param workers: the number of processes reading tags
+    :param batch_size: the number of files written per transaction
+    :param progress_interval: the minimum number of seconds between progress updates
+    """
+
+    thread_name = 'library-import'
+    stats_field = 'library_import'
+
+    def __init__(self, engine: Any, artist_lookup: Callable[[], Mapping], workers: int, batch_size: int,
+                 progress_interval: float = 1):
+        super().__init__(progress_interval)
+        self.engine = engine
+        self.artist_lookup = artist_lookup
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def describe(self, directory: Path) -> str:
+        return f'Library import of {directory}'
+
+    def progress(self, stats: LibraryImportStats) -> Optional[float]:
+        return (stats.unchanged + stats.imported + stats.failed) / stats.found if stats.found else None
+
+    def run(self, directory: Path, job: DownloadJob, publish: PublishCallback) -> LibraryImportStats:
+        """
+        Import a directory in the calling thread.
+
+        :raises ImportStopped: if the importer was closed during the import
+        :return: the final statistics, which are also set on the job
+        """
+        stats = LibraryImportStats()
+        job.status = Status.CONVERTING
+        report = self.reporter(job, stats, publish)
+
+        files = list(scan(directory))
+        stats.found = len(files)
+
+        s = Session(self.engine)
+        try:
+            paths = [path for path, _, _ in files]
+            known = get_library_files(s, paths)
+            downloaded = get_song_ids_by_path(s, [p for p in paths if p not in known])
+        finally:
+            s.close()
+
+        # Files to read, with the song that was created from a previous version of the file
+        changed: List[Tuple[LibraryEntry, Optional[int]]] = []
+        seen: Dict[str, LibraryFileState] = {}
+        for path, mtime_ns, size in files:
+            state = known.get(path)
+            if state is None and path in downloaded:
+                seen[path] = (mtime_ns, size, downloaded[path])
+            elif state is None or state[:2] != (mtime_ns, size):
+                changed.append(((path, mtime_ns, size), state[2] if state is not None else None))
+                continue
+            stats.unchanged += 1
+
+        self._write([], seen)
+        logger.info('Importing %d of %d files in %s, %d are known', len(changed), len(files), directory, stats.unchanged)
+        report(force=True)
+
+        start = time.perf_counter()
+        if changed:
+            self._import(changed, stats, report)
+        elapsed = time.perf_counter() - start
+
+        read = stats.imported + stats.failed
+        stats.files_per_second = read / elapsed if elapsed > 0 else 0.0
+        logger.info('Imported %d songs from %s, %d unchanged and %d failed, read %d files in %.2fs (%.0f files/s)',
+                    stats.imported, directory, stats.unchanged, stats.failed, read, elapsed, stats.files_per_second)
+
+        job.status = Status.DONE
+        job.percentage_done = 1.0
+        report(force=True)
+        return stats
+
+    def _import(self, changed: List[Tuple[LibraryEntry, Optional[int]]], stats: LibraryImportStats,
+                report: Callable[..., None]):
+        # The importer runs next to the server threads, forking them is unsafe
+        ctx = multiprocessing.get_context('spawn')
+        pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=init_reader)
+        # Larger chunks need fewer round trips to the readers, small imports are still spread over all of them
+        chunksize = max(1, min(64, len(changed) // (self.workers * 4)))
+        start = time.perf_counter()
+
+        try:
+            results = pool.map(read_tags, [path for (path, _, _), _ in changed], chunksize=chunksize)
+            songs: List[Tuple[SongMetadataForDownload, Path, LibraryEntry, Optional[int]]] = []
+            failed = {}
+
+            for ((path, mtime_ns, size), old_song), (tags, error) in zip(changed, results):
+                if self._stop.is_set():
+                    raise ImportStopped()
+
+                if tags is None:
+                    logger.debug('Could not import %s: %s', path, error)
+                    # Keep the song of the previous version of the file
+                    failed[path] = (mtime_ns, size, old_song)
+                    stats.failed += 1
+                else:
+                    title, artists, album = tags
+                    meta = SongMetadataForDownload(
+                        title=title, artists=artists, album=album, original_artists=[],
+                        video_id='', tagger=None, thumbnail_url=None,
+                    )
+                    songs.append((meta, Path(path), (path, mtime_ns, size), old_song))
+
+                if len(songs) + len(failed) >= self.batch_size:
+                    self._write(songs, failed)
+                    stats.imported += len(songs)
+                    songs, failed = [], {}
+
+                elapsed = time.perf_counter() - start
+                stats.files_per_second = (stats.imported + len(songs) + stats.failed) / elapsed if elapsed else 0.0
+                report()
+
+            self._write(songs, failed)
+            stats.imported += len(songs)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _write(self, songs: List[Tuple[SongMetadataForDownload, Path, LibraryEntry, Optional[int]]],
+               files: Mapping[str, LibraryFileState]):
+        """
+        Add a batch of songs, replacing the songs of previous versions of their files,
+        and store the state of the files.
+        """
+        if not songs and not files:
+            return
+
+        files = dict(files)
+        s = Session(self.engine)
+        try:
+            replaced = [old_song for _, _, _, old_song in songs if old_song is not None]
+            if replaced:
+                delete_songs(s, replaced)
+
+            if songs:
+                # Commits the batch, the files are stored in a second transaction. If that one
+                # is lost, the next import knows the files by the paths of their songs.
+                song_ids = add_songs(s, [(meta, path) for meta, path, _, _ in songs], artist_lookup=self.artist_lookup())
+                for (_, _, (path, mtime_ns, size), _), song_id in zip(songs, song_ids):
+                    files[path] = (mtime_ns, size, song_id)
+
+            set_library_files(s, files)
+            s.commit()
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
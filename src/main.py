@@ -1,20 +1,29 @@
+import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
 
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from starlette.requests import Request
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, PlainTextResponse, Response
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
-from src.db import get_songs
-from src.dependencies import engine, get_db
+from src import metrics, search
+from src.db import encode_song_key, get_songs, next_song_key
+from src.dependencies import artist_registry, covers, engine, get_db, job_bus, jobs, library, retagger, thumbnails
 from src.metadata import YoutubeAPI
-from src.routers import data, download
-from src.settings import API_URL, LOGGING_CONFIG, VERSION
+from src.routers import admin, data, download
+from src.settings import (
+    API_URL, ARTISTS_RELOAD_INTERVAL, CONVERT_SLOTS, DOWNLOAD_EXECUTOR, DOWNLOAD_SLOTS, DOWNLOAD_WORKERS,
+    LOGGING_CONFIG, MAX_QUEUED_JOBS, PARTIAL_CLEANUP_INTERVAL, PARTIAL_FILE_MAX_AGE, PLAYLIST_CONCURRENCY,
+    PLAYLIST_MAX_VIDEOS, SONGS_PAGE_SIZE, SONGS_STORAGE, VERSION,
+)
+from src.tasks.executor import DownloadExecutor
+from src.tasks.playlist import PlaylistRunner, YtDlpPlaylistExtractor
+from src.tasks.resume import cleanup_partial_files_periodically
+from src.tasks.scheduler import JobScheduler
 
 
 def create_app() -> FastAPI:
@@ -30,34 +39,78 @@ def create_app() -> FastAPI:
         allow_origins=['*'],
         allow_methods=['*'],
         allow_headers=['*'],
+        expose_headers=['X-Next-Cursor'],
     )
 
     app.mount('/static', StaticFiles(directory='app/static'), name='static')
     templates = Jinja2Templates(directory='app/templates')
 
     @app.on_event('startup')
-    def startup():
+    async def startup():
         YoutubeAPI.init()
-        # TODO: use process pool, but share 'jobs' object
-        app.state.executor = ThreadPoolExecutor()
+        covers.load()
+        # Only here and not in the download worker processes, which only swap their own artist index
+        search.ensure_index(engine, artist_registry.current.lookup)
+        # The alternative names of artists are searchable
+        artist_registry.on_reload(lambda index: search.reindex_artists(engine, index.lookup))
+        if ARTISTS_RELOAD_INTERVAL > 0:
+            artist_registry.watch(ARTISTS_RELOAD_INTERVAL)
+        loop = asyncio.get_running_loop()
+        job_bus.bind(loop)
+        app.state.executor = DownloadExecutor(DOWNLOAD_EXECUTOR, DOWNLOAD_WORKERS)
+        app.state.executor.start(loop)
+        app.state.scheduler = JobScheduler(app.state.executor, DOWNLOAD_SLOTS, CONVERT_SLOTS, MAX_QUEUED_JOBS)
+        app.state.playlists = PlaylistRunner(
+            app.state.scheduler, YtDlpPlaylistExtractor(PLAYLIST_MAX_VIDEOS), PLAYLIST_CONCURRENCY)
+        if metrics.ENABLED:
+            scheduler = app.state.scheduler
+            metrics.QUEUE_DEPTH.set_function(lambda: scheduler.queue_depth)
+            metrics.JOBS_DOWNLOADING.set_function(lambda: scheduler.downloading)
+            metrics.JOBS_CONVERTING.set_function(lambda: scheduler.converting)
+            metrics.WEBSOCKET_LISTENERS.set_function(lambda: job_bus.listener_count)
+        jobs.start(
+            on_change=lambda uid: loop.call_soon_threadsafe(job_bus.notify, uid),
+            on_resume=lambda job, req: loop.call_soon_threadsafe(app.state.scheduler.resume, job.request_id, req),
+        )
+        app.state.partial_cleanup = asyncio.create_task(cleanup_partial_files_periodically(
+            SONGS_STORAGE, PARTIAL_FILE_MAX_AGE, PARTIAL_CLEANUP_INTERVAL))
 
     @app.on_event('shutdown')
     def shutdown_event():
+        app.state.partial_cleanup.cancel()
+        app.state.playlists.close()
+        library.close()
+        retagger.close()
         app.state.executor.shutdown()
-        engine.close()
+        thumbnails.close()
+        YoutubeAPI.close()
+        artist_registry.close()
+        jobs.close()
+        engine.dispose()
+
+    # Async so the gauges are read on the event loop that changes them
+    @app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+    async def metrics_endpoint():
+        if not metrics.ENABLED:
+            return Response(status_code=404)
+        return PlainTextResponse(metrics.REGISTRY.exposition(), media_type=metrics.CONTENT_TYPE)
 
     @app.get('/', response_class=HTMLResponse)
     async def index(request: Request, db: Session = Depends(get_db)):
-        songs = get_songs(db)
+        songs = list(get_songs(db, limit=SONGS_PAGE_SIZE, page_size=SONGS_PAGE_SIZE))
+        next_key = next_song_key(db, SONGS_PAGE_SIZE)
         ctx = {
             'request': request,
             'api_url': API_URL,
             'songs': songs,
+            'page_size': SONGS_PAGE_SIZE,
+            'next_cursor': encode_song_key(next_key) if next_key is not None else None,
             'timezone': timezone,
         }
         return templates.TemplateResponse('index.html', ctx)
 
     app.include_router(data.router, prefix=API_URL)
     app.include_router(download.router, prefix=API_URL)
+    app.include_router(admin.router, prefix=API_URL)
 
     return app
@@ -0,0 +1,177 @@
+"""
+This module contains an indexed fuzzy matcher for artist names.
+
+Scoring every known artist name against a song title with ``WRatio`` is the
+main cost of guessing artists. The :class:`ArtistMatcher` keeps an inverted
+index of tokens and bigrams of all names, and only scores the names that can
+possibly reach the score cutoff. The scores and ordering are the same as
+``thefuzz.process.extractBests`` over the full list of names.
+
+A name is shortlisted when the title and name are of similar length,
+when they share a token (``partial_token_set_ratio`` scores any shared token
+as 100), or when the name shares enough bigrams with the title to have a
+``partial_ratio`` above the cutoff. A character of the name that is not part
+of the best alignment destroys at most two of its bigrams, a character inserted
+in between destroys at most one, which bounds the number of bigrams that can be
+missing from the title for a given ratio.
+"""
+import bisect
+import itertools
+import math
+from collections import Counter, defaultdict
+from typing import Iterable, Sequence
+
+from thefuzz import fuzz, process, utils
+
+# Partial scores are scaled by these factors in WRatio
+_PARTIAL_SCALE = .9
+_LONG_PARTIAL_SCALE = .6
+_LONG_LEN_RATIO = 8
+
+
+def normalize(s: str) -> str:
+    """The same normalization that ``WRatio`` applies to its input."""
+    return utils.full_process(s, force_ascii=True)
+
+
+def token_bigrams(processed: str) -> set[str]:
+    """Bigrams within the tokens of a normalized string."""
+    return {
+        token[i:i + 2]
+        for token in processed.split()
+        for i in range(len(token) - 1)
+    }
+
+
+def max_lost_bigrams(length: int, min_ratio: float) -> int:
+    """
+    The maximum number of bigrams of a string of ``length`` that can be missing
+    from another string of at most the same length, when their Levenshtein ratio
+    is at least ``min_ratio``.
+
+    The ratio is ``2 * lcs / (length + other)``, every character of the string
+    outside of the lcs destroys at most two bigrams and every extra character
+    of the other string destroys at most one.
+    """
+    def lost(other: float) -> float:
+        lcs = min_ratio * (length + other) / 2
+        return 2 * (length - lcs) + (other - lcs)
+
+    # The bound is linear in the length of the other string, check both ends
+    shortest = min_ratio * length / (2 - min_ratio)
+    return math.floor(max(lost(shortest), lost(length)) + 1e-9)
+
+
+class ArtistMatcher:
+    """
+    Inverted index over artist names for fuzzy matching song titles.
+
+    :param artist_names: all names to match against, e.g. the names from
+        :func:`src.metadata.load_vdb_artists`. A sequence is used as is,
+        so the names of an :class:`src.artist_store.ArtistStore` are not copied.
+    """
+
+    def __init__(self, artist_names: Iterable[str]):
+        self.names = artist_names if isinstance(artist_names, Sequence) else list(artist_names)
+
+        self._lengths: list[int] = []
+        self._gram_counts: list[int] = []
+        self._tokens: dict[str, list[int]] = defaultdict(list)
+        self._grams: dict[str, list[int]] = defaultdict(list)
+
+        for i, name in enumerate(self.names):
+            processed = normalize(name)
+            self._lengths.append(len(processed))
+
+            # Names without any ascii characters always score 0
+            if not processed:
+                self._gram_counts.append(0)
+                continue
+
+            for token in set(processed.split()):
+                self._tokens[token].append(i)
+
+            grams = token_bigrams(processed)
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._grams[gram].append(i)
+
+        # Matchable names sorted by length, for selecting names in a length range
+        self._by_length = sorted((n, i) for i, n in enumerate(self._lengths) if n > 0)
+        self._required_cache: dict[float, tuple[list[int], list[int]]] = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _required_grams(self, score_cutoff: float) -> tuple[list[int], list[int]]:
+        """
+        The minimum number of shared bigrams each name needs to be
+        able to reach ``score_cutoff`` through a partial ratio.
+
+        :return: the required counts by name index, and the indices of the
+            names that need none
+        """
+        if score_cutoff not in self._required_cache:
+            # partial_ratio is rounded, then scaled and rounded again
+            min_partial = math.ceil((score_cutoff - .5) / _PARTIAL_SCALE) - .5
+            min_ratio = min(max(min_partial / 100, 0), 1)
+
+            required = [
+                count - max_lost_bigrams(length, min_ratio)
+                for length, count in zip(self._lengths, self._gram_counts)
+            ]
+
+            always = [i for i, n in enumerate(required) if n <= 0 and self._lengths[i] > 0]
+            self._required_cache[score_cutoff] = required, always
+
+        return self._required_cache[score_cutoff]
+
+    def _names_longer_than(self, min_len: float) -> Iterable[int]:
+        start = bisect.bisect_left(self._by_length, (math.ceil(min_len), -1))
+        return (i for _, i in itertools.islice(self._by_length, start, None))
+
+    def candidates(self, query: str, score_cutoff: float = 0) -> list[int]:
+        """
+        Indices of names that may score at least ``score_cutoff`` against ``query``.
+
+        :param query: the unprocessed query
+        :param score_cutoff: minimum WRatio score
+        :return: the indices in ascending order
+        """
+        processed = normalize(query)
+        query_len = len(processed)
+        if query_len == 0:
+            return []
+
+        if score_cutoff <= _LONG_PARTIAL_SCALE * 100:
+            # Every matchable name could reach the cutoff
+            return sorted(i for _, i in self._by_length)
+
+        # Names that are more than 8 times shorter than the query can't reach the cutoff
+        min_len = query_len / _LONG_LEN_RATIO
+
+        # For lengths this similar the plain ratio can reach the cutoff
+        similar_len_ratio = 200 / (score_cutoff - .5) - 1
+        selected = set(self._names_longer_than(query_len / similar_len_ratio))
+
+        # Candidates from shared tokens and bigrams
+        for token in set(processed.split()):
+            selected.update(self._tokens.get(token, ()))
+
+        required, always = self._required_grams(score_cutoff)
+        selected.update(always)
+
+        shared = Counter(itertools.chain.from_iterable(
+            self._grams[g] for g in token_bigrams(processed) if g in self._grams
+        ))
+        selected.update(i for i, n in shared.items() if n >= required[i])
+
+        return sorted(i for i in selected if self._lengths[i] >= min_len)
+
+    def extract_bests(self, query: str, score_cutoff: float = 0, limit: int = 5) -> list[tuple[str, int]]:
+        """
+        Same as ``thefuzz.process.extractBests(query, self.names, ...)``,
+        but only scores the candidates from the index.
+        """
+        shortlist = [self.names[i] for i in self.candidates(query, score_cutoff)]
+        return process.extractBests(query, shortlist, scorer=fuzz.WRatio, score_cutoff=score_cutoff, limit=limit)
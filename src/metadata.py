@@ -1,21 +1,33 @@
+import asyncio
+import concurrent.futures
+import functools
 import json
 import logging
+import mimetypes
 import os
 import pathlib
+import tempfile
+import threading
+import time
 import warnings
-from typing import Dict, List, Union
+from typing import Callable, Dict, List, Optional, TypeVar, Union
 from urllib import request
 
 import eyed3
 import ffmpeg
 import googleapiclient.discovery
 import googleapiclient.errors
+import httplib2
 import pykakasi
 import yaml
 from thefuzz import process
 from pydantic import BaseModel
 
 import src.settings as settings
+from src.artist_store import as_metadata
+from src.cache import ResponseCache, SqliteCacheStore
+from src.matcher import ArtistMatcher
+from src.metrics import ARTIST_MATCH_SECONDS, YOUTUBE_API_SECONDS, timed, timer
 from src.schemas import ArtistAccount, ArtistMetadata, SongMetadata, SongMetadataForDownload
 
 PREFERRED_THUMBNAIL_RES = [
@@ -27,6 +39,8 @@ PREFERRED_THUMBNAIL_RES = [
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
 
 class YtChannelSnippet(BaseModel):
     thumbnails: Dict[str, dict]
@@ -38,14 +52,38 @@ class YtChannelInfo(BaseModel):
     snippet: YtChannelSnippet
 
 
+class VideoUnavailable(LookupError):
+    """Raised when a video does not exist or is private."""
+
+
 class YoutubeAPI:
     _API_SERVICE_NAME = 'youtube'
     _API_VERSION = 'v3'
 
+    # The maximum number of IDs the API accepts in one request
+    MAX_IDS_PER_REQUEST = 50
+
     _youtube = None
 
+    # Every thread has its own connection, httplib2 connections can't be shared between threads
+    _local = threading.local()
+    # Runs API requests for the async variants
+    _executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+
+    # Responses are cached per video/channel ID
+    _video_cache = ResponseCache('video', settings.YOUTUBE_CACHE_SIZE, settings.YOUTUBE_CACHE_TTL)
+    _channel_cache = ResponseCache('channel', settings.YOUTUBE_CACHE_SIZE, settings.YOUTUBE_CACHE_TTL)
+
     @classmethod
     def init(cls):
+        if settings.YOUTUBE_CACHE_DB is not None and cls._video_cache.store is None:
+            cls.configure_cache(
+                settings.YOUTUBE_CACHE_SIZE,
+                settings.YOUTUBE_CACHE_TTL,
+                SqliteCacheStore(settings.YOUTUBE_CACHE_DB, settings.YOUTUBE_CACHE_TTL, settings.YOUTUBE_CACHE_DB_SIZE),
+            )
+
         if cls._youtube is None:
             key = settings.YOUTUBE_DEVELOPER_KEY
 
@@ -55,50 +93,165 @@ class YoutubeAPI:
             if settings.IS_DEBUG:
                 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-            # Get credentials and create an API client
-            cls._youtube = googleapiclient.discovery.build(
+            cls._youtube = cls._build(key)
+            logger.info('Created Youtube API Resource')
+
+        return cls._youtube
+
+    @classmethod
+    def _build(cls, key: str):
+        """
+        Create the API client from the vendored discovery document,
+        falling back to fetching the document if it is missing.
+        """
+        doc_file = settings.YOUTUBE_DISCOVERY_DOC
+
+        if not doc_file.exists():
+            logger.warning('%s does not exist, fetching the discovery document', doc_file)
+            return googleapiclient.discovery.build(
                 cls._API_SERVICE_NAME,
                 cls._API_VERSION,
                 developerKey=key,
-                cache_discovery=False
+                http=cls._http(),
+                cache_discovery=False,
             )
 
-            logger.info('Created Youtube API Resource')
+        with doc_file.open('r', encoding='utf8') as f:
+            doc = json.load(f)
 
-        return cls._youtube
+        if settings.YOUTUBE_API_ROOT_URL is not None:
+            doc['rootUrl'] = settings.YOUTUBE_API_ROOT_URL
+            doc['baseUrl'] = settings.YOUTUBE_API_ROOT_URL + doc['servicePath']
+
+        return googleapiclient.discovery.build_from_document(doc, developerKey=key, http=cls._http())
+
+    @classmethod
+    def _http(cls) -> httplib2.Http:
+        """The connection of the calling thread, kept alive between requests."""
+        http = getattr(cls._local, 'http', None)
+        if http is None:
+            http = httplib2.Http(timeout=settings.YOUTUBE_API_TIMEOUT)
+            cls._local.http = http
+        return http
+
+    @classmethod
+    def _execute(cls, request) -> dict:
+        return request.execute(http=cls._http(), num_retries=settings.YOUTUBE_API_RETRIES)
+
+    @classmethod
+    async def run_async(cls, fn: Callable[..., T], *args) -> T:
+        """
+        Run a function that requests the API in one of the API threads, so
+        the event loop is not blocked and the connections of the threads are reused.
+        """
+        if cls._executor is None:
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = concurrent.futures.ThreadPoolExecutor(
+                        settings.YOUTUBE_API_WORKERS, thread_name_prefix='youtube-api')
+
+        return await asyncio.get_running_loop().run_in_executor(cls._executor, functools.partial(fn, *args))
+
+    @classmethod
+    def close(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=False, cancel_futures=True)
+            cls._executor = None
+
+    @classmethod
+    def configure_cache(cls, maxsize: int, ttl: float, store: Optional[SqliteCacheStore] = None):
+        """
+        Replace the response caches.
+
+        :param maxsize: the maximum number of in-process entries per cache
+        :param ttl: seconds until an in-process entry expires
+        :param store: optional persistent store shared by the caches
+        """
+        cls._video_cache = ResponseCache('video', maxsize, ttl, store)
+        cls._channel_cache = ResponseCache('channel', maxsize, ttl, store)
+
+    @classmethod
+    def cache_stats(cls) -> Dict[str, Dict[str, int]]:
+        return {
+            'video': cls._video_cache.stats(),
+            'channel': cls._channel_cache.stats(),
+        }
 
     @classmethod
     def video_info(cls, video_ids: List[str]) -> list:
-        response = cls._youtube.videos().list(
-            part='snippet',
-            id=','.join(video_ids)
-        ).execute()
+        snippets = cls.video_snippets(video_ids)
+        return [snippets[i] for i in video_ids if i in snippets]
 
-        return [i['snippet'] for i in response['items']]
+    @classmethod
+    def video_snippets(cls, video_ids: List[str]) -> Dict[str, dict]:
+        """
+        Get the snippets of videos, requesting up to 50 videos per API call.
+
+        :param video_ids: the videos to get
+        :return: the snippet of each video by its ID, missing or private videos are left out
+        """
+        snippets = cls._video_cache.get_many(video_ids)
+        missing = [i for i in dict.fromkeys(video_ids) if i not in snippets]
+
+        for i in range(0, len(missing), cls.MAX_IDS_PER_REQUEST):
+            chunk = missing[i:i + cls.MAX_IDS_PER_REQUEST]
+            with timer(YOUTUBE_API_SECONDS, endpoint='videos'):
+                response = cls._execute(cls._youtube.videos().list(
+                    part='snippet',
+                    id=','.join(chunk),
+                ))
+
+            fetched = {item['id']: item['snippet'] for item in response['items']}
+            cls._video_cache.set_many(fetched)
+            snippets.update(fetched)
+
+        return snippets
 
     @classmethod
     def channel_info(cls, channel_ids: List[str]) -> List[YtChannelInfo]:
-        response = cls._youtube.channels().list(
-            part='snippet',
-            id=','.join(channel_ids)
-        ).execute()
+        """
+        Get the info of channels, requesting up to 50 channels per API call.
 
-        total = [YtChannelInfo(**item) for item in response['items']]
+        :param channel_ids: the channels to get
+        :return: the info of the channels that exist, cached channels first
+        """
+        cached = cls._channel_cache.get_many(channel_ids)
+        missing = [i for i in dict.fromkeys(channel_ids) if i not in cached]
 
-        while 'nextPageToken' in response:
-            response = cls._youtube.channels().list(
-                part='snippet',
-                id=','.join(channel_ids),
-                pageToken=response['nextPageToken'],
-            ).execute()
-            total.extend(YtChannelInfo(**item) for item in response['items'])
+        items = list(cached.values())
 
-        return total
+        for i in range(0, len(missing), cls.MAX_IDS_PER_REQUEST):
+            chunk = missing[i:i + cls.MAX_IDS_PER_REQUEST]
+            with timer(YOUTUBE_API_SECONDS, endpoint='channels'):
+                response = cls._execute(cls._youtube.channels().list(
+                    part='snippet',
+                    id=','.join(chunk),
+                ))
 
+            fetched = response['items']
+            cls._channel_cache.set_many({item['id']: item for item in fetched})
+            items.extend(fetched)
 
-def guess_artist(song_title: str, artist_names: list,
+        return [YtChannelInfo(**item) for item in items]
+
+
+@timed(ARTIST_MATCH_SECONDS)
+def guess_artist(song_title: str, artist_names: Union[list, ArtistMatcher],
                  artist_lookup: dict[str, ArtistMetadata], guess_threshold=80) -> dict[str, tuple[ArtistMetadata, int]]:
-    bests = process.extractBests(song_title, artist_names, score_cutoff=guess_threshold)
+    """
+    Fuzzy match artist names in a song title.
+
+    :param song_title: the title to match
+    :param artist_names: the names to match against, if an ArtistMatcher is given
+        only the candidates from its index are scored
+    :param artist_lookup: lookup from name to artist
+    :param guess_threshold: the minimum score of a match
+    :return: the matched artists by their default name, with the score of the match
+    """
+    if isinstance(artist_names, ArtistMatcher):
+        bests = artist_names.extract_bests(song_title, score_cutoff=guess_threshold)
+    else:
+        bests = process.extractBests(song_title, artist_names, score_cutoff=guess_threshold)
     logger.debug('guessed based on title: %s', bests)
 
     guessed_artists = {}
@@ -109,10 +262,65 @@ def guess_artist(song_title: str, artist_names: list,
     return guessed_artists
 
 
-def get_metadata(video_id: str, artist_names: list, artist_lookup: dict,
+def get_metadata(video_id: str, artist_names: Union[list, ArtistMatcher], artist_lookup: dict,
                  yt_lookup: dict[str, ArtistMetadata]) -> SongMetadata:
-    response = YoutubeAPI.video_info([video_id])[0]
+    snippets = YoutubeAPI.video_snippets([video_id])
+    if video_id not in snippets:
+        raise VideoUnavailable(video_id)
 
+    return song_metadata_from_snippet(video_id, snippets[video_id], artist_names, artist_lookup, yt_lookup)
+
+
+def get_metadata_batch(video_ids: List[str], artist_names: Union[list, ArtistMatcher], artist_lookup: dict,
+                       yt_lookup: dict[str, ArtistMetadata]) -> Dict[str, Union[SongMetadata, Exception]]:
+    """
+    Get the metadata of multiple videos, the video info is requested
+    in as few API calls as possible.
+
+    :return: the metadata by video ID, or the exception that occurred for that video
+    """
+    # Remove duplicates, keep the order of the request
+    video_ids = list(dict.fromkeys(video_ids))
+    snippets = YoutubeAPI.video_snippets(video_ids)
+
+    results: Dict[str, Union[SongMetadata, Exception]] = {}
+    for video_id in video_ids:
+        if video_id not in snippets:
+            results[video_id] = VideoUnavailable(video_id)
+            continue
+
+        try:
+            results[video_id] = song_metadata_from_snippet(
+                video_id, snippets[video_id], artist_names, artist_lookup, yt_lookup)
+        except Exception as e:  # noqa
+            logger.error('Could not create metadata for %s: %s', video_id, e)
+            results[video_id] = e
+
+    return results
+
+
+async def get_metadata_async(video_id: str, artist_names: Union[list, ArtistMatcher], artist_lookup: dict,
+                             yt_lookup: dict[str, ArtistMetadata]) -> SongMetadata:
+    """Async variant of :func:`get_metadata`, requesting and matching run in the API threads."""
+    return await YoutubeAPI.run_async(get_metadata, video_id, artist_names, artist_lookup, yt_lookup)
+
+
+async def get_metadata_batch_async(
+    video_ids: List[str], artist_names: Union[list, ArtistMatcher], artist_lookup: dict,
+    yt_lookup: dict[str, ArtistMetadata],
+) -> Dict[str, Union[SongMetadata, Exception]]:
+    """Async variant of :func:`get_metadata_batch`, requesting and matching run in the API threads."""
+    return await YoutubeAPI.run_async(get_metadata_batch, video_ids, artist_names, artist_lookup, yt_lookup)
+
+
+def song_metadata_from_snippet(video_id: str, response: dict, artist_names: Union[list, ArtistMatcher],
+                               artist_lookup: dict, yt_lookup: dict[str, ArtistMetadata]) -> SongMetadata:
+    """
+    Guess the song metadata from the snippet of a video.
+
+    :param video_id: the ID of the video
+    :param response: the video snippet as returned by the Youtube API
+    """
     title = response['title']
     channel_id = response['channelId']
 
@@ -127,7 +335,11 @@ def get_metadata(video_id: str, artist_names: list, artist_lookup: dict,
     logger.debug('guessing artist using fuzzy matching')
     guessed_artists.update(guess_artist(title, artist_names, artist_lookup))
 
-    artists = sorted(guessed_artists.values(), key=lambda a: a[1], reverse=True)
+    # Artists from the artist store are views, materialize them for the response
+    artists = [
+        (as_metadata(artist), score)
+        for artist, score in sorted(guessed_artists.values(), key=lambda a: a[1], reverse=True)
+    ]
 
     # Get thumbnail from video
     for res in PREFERRED_THUMBNAIL_RES:
@@ -149,6 +361,19 @@ def get_metadata(video_id: str, artist_names: list, artist_lookup: dict,
     )
 
 
+def fetch_thumbnail(thumbnail: Union[pathlib.Path, str]) -> tuple[bytes, str]:
+    """
+    Read a thumbnail image from a file or url.
+
+    :return: the image data and its mime type
+    """
+    if isinstance(thumbnail, pathlib.Path):
+        return thumbnail.read_bytes(), mimetypes.guess_type(thumbnail.name)[0] or 'image/jpeg'
+
+    with request.urlopen(thumbnail, timeout=30) as response:
+        return response.read(), response.info().get_content_type()
+
+
 def add_metadata(
     song_file: pathlib.Path,
     meta: SongMetadataForDownload,
@@ -160,23 +385,117 @@ def add_metadata(
     :param song_file: path to the mp3 file
     :param meta: the metadata to add
     :param thumbnail: the album cover image, if a path is given, it will use that file.
-        A string represents a url and the thumbnail will be downloaded from there, if a url is given,
-        it must be a jpeg
+        A string represents a url and the thumbnail will be downloaded from there
     """
     audio = eyed3.load(song_file.resolve())
 
     audio.tag.title = meta.title
     audio.tag.artist = ','.join(a for a in meta.artists)
     audio.tag.album = meta.album
-    if isinstance(thumbnail, pathlib.Path):
-        with thumbnail.open('rb') as f:
-            audio.tag.images.set(3, f.read(), f'image/{thumbnail.suffix}', 'Album Art')
-    else:
-        response = request.urlopen(thumbnail)
-        audio.tag.images.set(3, response.read(), response.info().get_content_type(), 'Album Art')
+    image, mime_type = fetch_thumbnail(thumbnail)
+    audio.tag.images.set(3, image, mime_type, 'Album Art')
     audio.tag.save()
 
 
+def probe_audio_codec(media_file: pathlib.Path) -> str:
+    """
+    Get the codec of the first audio stream of a media file.
+
+    :raises RuntimeError: if the file has no audio stream
+    """
+    info = ffmpeg.probe(str(media_file.resolve()))
+
+    for stream in info['streams']:
+        if stream['codec_type'] == 'audio':
+            return stream['codec_name']
+
+    raise RuntimeError(f'{media_file} does not contain an audio stream')
+
+
+def encode_and_tag(
+    media_file: pathlib.Path,
+    meta: SongMetadataForDownload,
+    thumbnail: Union[pathlib.Path, str],
+    timings: Optional[Dict[str, float]] = None,
+    output: Optional[pathlib.Path] = None,
+    keep_source: bool = False,
+) -> pathlib.Path:
+    """
+    Convert a downloaded media file to a tagged mp3 with a single ffmpeg invocation.
+
+    The audio stream is copied if it already is mp3, otherwise it is encoded once.
+    The ID3 tags and the album cover are written by the same ffmpeg run,
+    existing tags of the media file are dropped.
+
+    :param media_file: the downloaded file, in any container ffmpeg can read
+    :param meta: the metadata to add
+    :param thumbnail: the album cover image, either a path or a url
+    :param timings: if given, the duration of each step is added to it in seconds
+    :param output: the path of the mp3 file, by default the media file with an mp3 extension
+    :param keep_source: keep the media file, otherwise it is replaced by the mp3 file
+    :return: path to the mp3 file
+    """
+    if timings is None:
+        timings = {}
+
+    start = time.perf_counter()
+    codec = probe_audio_codec(media_file)
+    timings['probe'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image, mime_type = fetch_thumbnail(thumbnail)
+    timings['thumbnail'] = time.perf_counter() - start
+
+    song = output if output is not None else media_file.with_suffix('.mp3')
+    tmp_song = song.with_name(f'{song.stem}.tmp.mp3')
+
+    audio_options = {'c:a': 'copy'} if codec == 'mp3' else {'c:a': 'libmp3lame', 'q:a': 0}
+    logger.info('%s audio of %s', 'Copying' if codec == 'mp3' else f'Encoding {codec}', media_file)
+
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile(suffix=mimetypes.guess_extension(mime_type) or '.jpg') as cover:
+        cover.write(image)
+        cover.flush()
+
+        audio = ffmpeg.input(str(media_file.resolve())).audio
+        cover_image = ffmpeg.input(cover.name).video
+
+        try:
+            (ffmpeg
+             .output(
+                 audio, cover_image, str(tmp_song.resolve()),
+                 **audio_options,
+                 # mp3 supports embedding jpeg and png as is
+                 **{'c:v': 'copy' if mime_type in ('image/jpeg', 'image/png') else 'mjpeg'},
+                 # Drop tags of the source container
+                 map_metadata=-1,
+                 id3v2_version=3,
+                 # Room to re-tag the song in place, see src.retag
+                 metadata_header_padding=settings.ID3_PADDING,
+                 **{
+                     'metadata:g:0': f'title={meta.title}',
+                     'metadata:g:1': f'artist={",".join(meta.artists)}',
+                     'metadata:g:2': f'album={meta.album}',
+                     # Both specifiers select the cover stream, options can't be repeated
+                     'metadata:s:v': 'title=Album Art',
+                     # Marks the image as the front cover
+                     'metadata:s:v:0': 'comment=Cover (front)',
+                 },
+             )
+             .overwrite_output()
+             .run(quiet=True))
+        except ffmpeg.Error as e:
+            tmp_song.unlink(missing_ok=True)
+            raise RuntimeError(f'ffmpeg failed on {media_file}: {e.stderr.decode(errors="replace")}') from e
+
+    os.replace(tmp_song, song)
+    if media_file != song and not keep_source:
+        media_file.unlink()
+    timings['encode'] = time.perf_counter() - start
+
+    return song
+
+
 def force_mp3(song: pathlib.Path) -> pathlib.Path:
     """
     Encode media file into mp3 using ffmpeg.
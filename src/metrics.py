@@ -0,0 +1,266 @@
+"""
+This module contains the metrics of the server, exposed at ``/metrics`` in the Prometheus text format.
+
+Metrics are plain in-process objects, code is instrumented with :func:`timer` and
+:func:`timed`. With ``METRICS_ENABLED=false`` :func:`timed` returns the function
+itself and :func:`timer` a shared no-op context, so instrumented code runs as if
+it was not instrumented.
+
+The stages of download jobs run in worker threads or processes, their durations
+are taken from :attr:`src.schemas.DownloadJob.timings` when the job finishes, see
+:func:`observe_job`, so they are recorded in the server process in both executor modes.
+"""
+import abc
+import contextlib
+import functools
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import src.settings as settings
+
+ENABLED = settings.METRICS_ENABLED
+
+# Buckets in seconds, from fast in-process work up to downloads of long videos
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """The samples of the metric as (name suffix, formatted labels, value)."""
+
+    def exposition(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{self.name}{suffix}{labels} {_format_value(value)}' for suffix, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of finished jobs."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('_total', _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, either set directly or read from a function
+    when the metrics are collected.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def samples(self):
+        value = self._function() if self._function is not None else self._value
+        return [('', '', value)]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. durations in seconds."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label values: the count of each bucket (not cumulative), the sum and the count
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        # NaN is not less than any bound, it is counted in the +Inf bucket like prometheus_client does
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets) - 1)
+
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels((*self.labelnames, 'le'), (*key, _format_value(bound)))
+                samples.append(('_bucket', labels, cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        return '\n'.join(m.exposition() for m in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# Content type of the Prometheus text format, the response adds the charset
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+YOUTUBE_API_SECONDS = REGISTRY.register(Histogram(
+    'holotagger_youtube_api_seconds', 'Latency of Youtube Data API requests', ['endpoint']))
+ARTIST_MATCH_SECONDS = REGISTRY.register(Histogram(
+    'holotagger_artist_match_seconds', 'Time spent fuzzy matching artist names in a song title'))
+JOB_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'holotagger_job_stage_seconds',
+    'Duration of the stages of download jobs, e.g. download (yt-dlp), force_mp3, encode, tag and db',
+    ['stage']))
+JOBS = REGISTRY.register(Counter(
+    'holotagger_jobs', 'Download requests by outcome: done, error, rejected (queue full) or joined (same song)',
+    ['outcome']))
+DOWNLOAD_BYTES = REGISTRY.register(Counter(
+    'holotagger_download_bytes',
+    'Bytes received by downloads, retransferred bytes were received before by an attempt that could not be resumed',
+    ['kind']))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'holotagger_download_queue_depth', 'Jobs waiting for a download slot'))
+JOBS_DOWNLOADING = REGISTRY.register(Gauge(
+    'holotagger_jobs_downloading', 'Jobs in the download stage'))
+JOBS_CONVERTING = REGISTRY.register(Gauge(
+    'holotagger_jobs_converting', 'Jobs in the convert stage'))
+WEBSOCKET_LISTENERS = REGISTRY.register(Gauge(
+    'holotagger_websocket_listeners', 'Open job status websockets'))
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+_NOOP = contextlib.nullcontext()
+
+
+def timer(histogram: Histogram, **labels: str):
+    """Context manager that observes the duration of its block in ``histogram``."""
+    if not ENABLED:
+        return _NOOP
+    return _Timer(histogram, labels)
+
+
+def timed(histogram: Histogram, **labels: str):
+    """Decorator that observes the duration of every call in ``histogram``."""
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def count_job(outcome: str):
+    """Count a download request that did not start a job, e.g. because the queue is full."""
+    if ENABLED:
+        JOBS.inc(outcome=outcome)
+
+
+def observe_job(job, outcome: str):
+    """
+    Record a finished job, its outcome and the duration of its stages.
+
+    :param job: the :class:`src.schemas.DownloadJob`
+    :param outcome: either 'done' or 'error'
+    """
+    if not ENABLED:
+        return
+
+    JOBS.inc(outcome=outcome)
+    for stage, seconds in job.timings.items():
+        JOB_STAGE_SECONDS.observe(seconds, stage=stage)
+
+    if job.bytes_transferred:
+        DOWNLOAD_BYTES.inc(job.bytes_transferred, kind='transferred')
+    if job.bytes_retransferred:
+        DOWNLOAD_BYTES.inc(job.bytes_retransferred, kind='retransferred')
@@ -0,0 +1,358 @@
+"""
+This module contains the re-tagger, which updates the tags of songs in the database and in their files.
+
+Songs are re-tagged after their tags were corrected, or after one of their artists was renamed,
+e.g. because the canonical name of the artist changed in the artist database. The database is
+updated first and is the source of the tags, so re-tagging songs again repairs files that could
+not be written.
+
+Only the text frames of the existing ID3 tag are changed, embedded images such as the cover are
+kept as they are. If the new tag fits in the space of the old one including its padding, only
+that space is overwritten and the audio is not touched. Otherwise the file is rewritten once
+with ``ID3_PADDING`` bytes of padding, so later re-tags fit. Files whose tags match already are
+not written. Files are written by a pool of threads.
+
+Downloaded songs are stored at a path derived from the tags they were downloaded with, which
+is reused for later requests with the same tags. Re-tagged songs are moved out of that path,
+so those requests create a new file with the tags they asked for.
+"""
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+import eyed3
+import eyed3.id3
+import eyed3.id3.headers
+from sqlalchemy.orm import Session
+
+from src import search
+from src.background import BackgroundRunner, PublishCallback, Stopped
+from src.db import (
+    get_artist_song_ids, get_song_tags, move_song_files, rename_artist, update_library_files, update_songs, Artist,
+    SongTags,
+)
+from src.schemas import DownloadJob, RetagRequest, RetagStats, Status
+
+logger = logging.getLogger(__name__)
+
+# The results of writing the tags of a file
+UNCHANGED = 'unchanged'
+IN_PLACE = 'in_place'
+REWRITTEN = 'rewritten'
+FAILED = 'failed'
+
+# Downloaded songs are stored as <video id>/<tag digest>.mp3, see src.tasks.download.song_path
+_TAG_DIGEST_NAME = re.compile(r'[0-9a-f]{16}\.mp3')
+
+
+def retagged_path(storage_dir: Path, path: str, song_id: int) -> Optional[str]:
+    """
+    The path a downloaded song is moved to once its tags changed.
+
+    :param storage_dir: the directory downloaded songs are stored in
+    :param path: the resolved path of the song
+    :return: None if the song is not stored by its tags
+    """
+    song_file = Path(path)
+    if song_file.parent.parent != storage_dir.resolve() or _TAG_DIGEST_NAME.fullmatch(song_file.name) is None:
+        return None
+
+    return str(song_file.with_name(f'retagged-{song_id}.mp3'))
+
+
+def write_tags(path: str, title: str, artists: List[str], album: str, padding: int) -> Tuple[str, Optional[str]]:
+    """
+    Write the tags of a song into its file.
+
+    :param path: the mp3 file
+    :param padding: the bytes of padding to add if the file has to be rewritten
+    :return: how the file was written, and the reason it could not be written
+    """
+    try:
+        tag = eyed3.id3.Tag()
+        found = tag.parse(path, eyed3.id3.ID3_V2)
+    except Exception as e:  # noqa
+        return FAILED, str(e)
+
+    # Artists are joined with commas, like add_metadata does
+    artist = ','.join(artists)
+    if found and (tag.title, tag.artist, tag.album) == (title, artist, album):
+        return UNCHANGED, None
+
+    if tag.version == eyed3.id3.ID3_V2_2:
+        # eyed3 can't write ID3v2.2
+        tag.version = eyed3.id3.ID3_V2_4
+    tag.title = title
+    tag.artist = artist
+    tag.album = album
+
+    try:
+        if _CAN_RENDER:
+            try:
+                return _write_rendered(path, tag, found, padding), None
+            except (AttributeError, TypeError) as e:
+                # The internals of eyed3 changed, nothing was written yet
+                logger.debug('Could not render the tag of %s, saving it with eyed3: %s', path, e)
+
+        tag.save(path, version=tag.version)
+        return REWRITTEN, None
+    except Exception as e:  # noqa
+        return FAILED, str(e)
+
+
+# Tag.save parses the file again, and adds only 256 bytes of padding when the tag grows.
+# Tags are rendered with the internals of eyed3 0.9 instead, Tag.save is used if they are missing.
+_CAN_RENDER = hasattr(eyed3.id3.Tag, '_render') and hasattr(eyed3.id3.headers.TagHeader, 'SIZE')
+
+
+def _write_rendered(path: str, tag: eyed3.id3.Tag, found: bool, padding: int) -> str:
+    """Render a tag into the space of the current one, the file is rewritten if it does not fit."""
+    current_size = tag.file_info.tag_size if found else 0
+    rewrite, data, tag_padding = tag._render(tag.version, current_size, None)
+    if not rewrite:
+        with open(path, 'r+b') as f:
+            f.write(data + tag_padding)
+        return IN_PLACE
+
+    if not tag.header.extended:
+        # Only the size in the header depends on the padding
+        header_size = eyed3.id3.headers.TagHeader.SIZE
+        data = tag.header.render(len(data) + padding - header_size) + data[header_size:]
+        tag_padding = b'\x00' * padding
+    else:
+        _, data, tag_padding = tag._render(tag.version, len(data) + padding, None)
+    _rewrite(path, data + tag_padding, current_size)
+    return REWRITTEN
+
+
+def _rewrite(path: str, tag: bytes, audio_offset: int):
+    """Replace the tag of a file by writing a copy next to it, the file is replaced in one step."""
+    directory, name = os.path.split(path)
+    # Named like unfinished conversions, so it is cleaned up if the process dies
+    with tempfile.NamedTemporaryFile('wb', dir=directory, prefix=f'{Path(name).stem}.', suffix='.tmp.mp3',
+                                     delete=False) as tmp:
+        try:
+            tmp.write(tag)
+            with open(path, 'rb') as f:
+                f.seek(audio_offset)
+                shutil.copyfileobj(f, tmp, 1024 * 1024)
+            tmp.close()
+            shutil.copymode(path, tmp.name)
+            os.replace(tmp.name, path)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+
+class RetagStopped(Stopped):
+    pass
+
+
+# Called with the id of an artist whose name changed, or that songs were merged into
+RenameCallback = Callable[[int], None]
+
+
+class Retagger(BackgroundRunner):
+    """
+    Re-tags songs in a background thread, one request at a time.
+    Closing the re-tagger stops a running re-tag, the database is updated already and files
+    that were written stay written.
+
+    :param engine: the database engine
+    :param artist_lookup: returns the current artists by name, for canonical names and alternative names
+    :param workers: the number of threads writing files
+    :param padding: the bytes of padding of rewritten tags
+    :param storage_dir: the directory downloaded songs are stored in, see :func:`retagged_path`
+    :param progress_interval: the minimum number of seconds between progress updates
+    """
+
+    thread_name = 'retag'
+    stats_field = 'retag'
+
+    def __init__(self, engine: Any, artist_lookup: Callable[[], Mapping], workers: int, padding: int,
+                 storage_dir: Optional[Path] = None, progress_interval: float = 1):
+        super().__init__(progress_interval)
+        self.engine = engine
+        self.artist_lookup = artist_lookup
+        self.workers = workers
+        self.padding = padding
+        self.storage_dir = storage_dir
+
+        self._on_rename: List[RenameCallback] = []
+
+    def on_rename(self, callback: RenameCallback):
+        """Register a function that is called from the re-tag thread after an artist was renamed or merged."""
+        self._on_rename.append(callback)
+
+    def describe(self, req: RetagRequest) -> str:
+        return 'Re-tag'
+
+    def progress(self, stats: RetagStats) -> Optional[float]:
+        return (stats.in_place + stats.rewritten + stats.unchanged + stats.failed) / stats.songs if stats.songs else None
+
+    def run(self, req: RetagRequest, job: DownloadJob, publish: PublishCallback) -> RetagStats:
+        """
+        Update the database and re-tag the files in the calling thread.
+
+        :raises LookupError: if the artist does not exist
+        :raises RetagStopped: if the re-tagger was closed while writing files
+        :return: the final statistics, which are also set on the job
+        """
+        stats = RetagStats()
+        job.status = Status.CONVERTING
+        report = self.reporter(job, stats, publish)
+
+        tags = self.update_database(req)
+        stats.songs = len(tags)
+        report(force=True)
+
+        start = time.perf_counter()
+        written: List[str] = []
+        moves: Dict[str, str] = {}
+        try:
+            self._write_files(tags, stats, report, written, moves)
+        finally:
+            # Also when stopped, the songs of moved files must point to them
+            self._update_files(written, moves)
+        elapsed = time.perf_counter() - start
+        stats.files_per_second = stats.songs / elapsed if elapsed > 0 else 0.0
+
+        logger.info('Re-tagged %d songs in %.2fs (%.0f files/s), %d in place, %d rewritten, %d unchanged, %d failed',
+                    stats.songs, elapsed, stats.files_per_second, stats.in_place, stats.rewritten, stats.unchanged,
+                    stats.failed)
+
+        job.status = Status.DONE
+        job.percentage_done = 1.0
+        report(force=True)
+        return stats
+
+    def update_database(self, req: RetagRequest) -> Dict[int, SongTags]:
+        """
+        Apply the corrections and the artist rename of a request in one transaction.
+
+        :raises LookupError: if the artist does not exist
+        :return: the tags of the songs to re-tag by id, songs that do not exist are left out
+        """
+        artist_lookup = self.artist_lookup()
+        song_ids = [u.id for u in req.songs]
+        renamed: List[int] = []
+
+        s = Session(self.engine)
+        try:
+            if req.artist_id is not None:
+                name = s.query(Artist.name).filter(Artist.id == req.artist_id).scalar()
+                if name is None:
+                    raise LookupError(f'Artist {req.artist_id} does not exist')
+
+                song_ids.extend(get_artist_song_ids(s, req.artist_id))
+                new_name = req.artist_name
+                if new_name is None:
+                    new_name = artist_lookup[name].name if name in artist_lookup else name
+                if new_name != name:
+                    logger.info('Renaming artist %d from %s to %s', req.artist_id, name, new_name)
+                    target_id = rename_artist(s, req.artist_id, new_name, artist_lookup)
+                    renamed = list(dict.fromkeys((req.artist_id, target_id)))
+
+            song_ids = list(dict.fromkeys(song_ids))
+            update_songs(s, req.songs, artist_lookup)
+            search.reindex_songs(s, song_ids)
+            tags = get_song_tags(s, song_ids)
+            s.commit()
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
+
+        for artist_id in renamed:
+            for callback in self._on_rename:
+                try:
+                    callback(artist_id)
+                except Exception as e:  # noqa
+                    logger.error('Artist rename callback failed: %s', e, exc_info=True)
+
+        return tags
+
+    def _write_files(self, tags: Dict[int, SongTags], stats: RetagStats, report: Callable[..., None],
+                     written: List[str], moves: Dict[str, str]):
+        """
+        Write the tags of the songs into their files.
+
+        :param written: the files that were written are added to it
+        :param moves: the new paths of the files that were moved are added to it by old path
+        """
+        songs = list(tags.values())
+        args = (
+            [path for path, _, _, _ in songs],
+            [title for _, title, _, _ in songs],
+            [artists for _, _, artists, _ in songs],
+            [album for _, _, _, album in songs],
+            [self.padding] * len(songs),
+        )
+
+        # Writing is mostly file I/O, which releases the GIL, and rendering a tag takes less than
+        # a millisecond, so threads keep up with processes without their startup time
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='retag')
+        results = pool.map(write_tags, *args)
+
+        try:
+            for song_id, path, (result, error) in zip(tags, args[0], results):
+                if self._stop.is_set():
+                    raise RetagStopped()
+
+                if result == FAILED:
+                    logger.warning('Could not re-tag %s: %s', path, error)
+                    stats.failed += 1
+                elif result == UNCHANGED:
+                    stats.unchanged += 1
+                else:
+                    new_path = self._move(song_id, path)
+                    if new_path != path:
+                        moves[path] = new_path
+                    written.append(new_path)
+                    if result == IN_PLACE:
+                        stats.in_place += 1
+                    else:
+                        stats.rewritten += 1
+                report()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _update_files(self, written: List[str], moves: Dict[str, str]):
+        """Store the new paths of moved files, and the new state of written files that were imported from a library."""
+        # The next library import should not read the files again
+        files = {}
+        for path in written:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat_result.st_mtime_ns, stat_result.st_size)
+
+        s = Session(self.engine)
+        try:
+            move_song_files(s, moves)
+            update_library_files(s, files)
+            s.commit()
+        finally:
+            s.close()
+
+    def _move(self, song_id: int, path: str) -> str:
+        """Move a re-tagged song out of the path of the tags it was downloaded with, returns its path."""
+        new_path = retagged_path(self.storage_dir, path, song_id) if self.storage_dir is not None else None
+        if new_path is None:
+            return path
+
+        try:
+            os.replace(path, new_path)
+        except OSError as e:
+            logger.warning('Could not move re-tagged song %s: %s', path, e)
+            return path
+
+        return new_path
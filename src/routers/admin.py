@@ -0,0 +1,147 @@
+import hmac
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+
+from src.db import _MAX_IN_PARAMS, Artist, Song
+from src.dependencies import SessionLocal, artist_registry, job_bus, jobs, library, retagger
+from src.schemas import (
+    ArtistIndexStatus, DownloadJob, LibraryImportRequest, LibraryImportStats, RetagRequest, RetagStats, Status,
+)
+from src.settings import ADMIN_TOKEN, LIBRARY_IMPORT_DIRS, SONGS_STORAGE
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # Without a configured token the admin endpoints are disabled
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail='Admin endpoints are disabled, ADMIN_TOKEN is not set')
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail='Invalid admin token')
+
+
+router = APIRouter(prefix='/admin', dependencies=[Depends(require_admin)])
+
+
+def artist_index_status() -> ArtistIndexStatus:
+    index = artist_registry.current
+    return ArtistIndexStatus(
+        version=index.version,
+        digest=index.digest,
+        names=len(index.names),
+        channels=len(index.yt_lookup),
+        built_at=index.built_at,
+        build_seconds=index.build_seconds,
+        reloading=artist_registry.reloading,
+        last_error=artist_registry.last_error,
+    )
+
+
+@router.get('/artists', response_model=ArtistIndexStatus)
+def artists():
+    """The version of the artist index of this worker"""
+    return artist_index_status()
+
+
+@router.post('/artists/reload', response_model=ArtistIndexStatus, status_code=202)
+def reload_artists(force: bool = False):
+    """
+    Rebuild the artist index in the background, requests keep using the current index until it is done.
+    By default the index is only rebuilt if the artists file changed.
+    Poll ``GET /admin/artists`` for the new version.
+    """
+    started = artist_registry.reload_in_background(force=force)
+    status = artist_index_status()
+    if not started:
+        # A reload is running already, it is not restarted
+        return JSONResponse(status.dict(), status_code=409)
+
+    return status
+
+
+@router.post('/library/import', response_model=DownloadJob, status_code=202)
+async def import_library(req: LibraryImportRequest):
+    """
+    Add the mp3 files of a directory, by default the songs storage, to the database in the background.
+    Only directories in the songs storage or in ``LIBRARY_IMPORT_DIRS`` can be imported.
+    Files that were imported before and did not change are skipped.
+    The progress is reported like the progress of downloads, see ``GET /status/{uid}``.
+    Responds with 409 and the running import if an import is running already.
+    """
+    directory = Path(req.directory if req.directory is not None else SONGS_STORAGE).resolve()
+    if not any(directory.is_relative_to(d.resolve()) for d in (SONGS_STORAGE, *LIBRARY_IMPORT_DIRS)):
+        raise HTTPException(status_code=400, detail=f'{req.directory} is not in the songs storage or LIBRARY_IMPORT_DIRS')
+    if not directory.is_dir():
+        raise HTTPException(status_code=400, detail=f'{directory} is not a directory')
+
+    job = DownloadJob(
+        request_id=uuid.uuid4(),
+        status=Status.WAITING,
+        percentage_done=0.0,
+        last_update=time.time(),
+        library_import=LibraryImportStats(),
+    )
+    jobs.add(job)
+
+    if not library.start(directory, job, job_bus.publish_threadsafe):
+        del jobs[job.request_id]
+        return Response(library.job.json(), status_code=409, media_type='application/json')
+
+    return job.dict()
+
+
+def missing_retag_targets(req: RetagRequest) -> Optional[str]:
+    """The songs or artist of a re-tag request that do not exist."""
+    db = SessionLocal()
+    try:
+        if req.artist_id is not None and db.query(Artist.id).filter(Artist.id == req.artist_id).scalar() is None:
+            return f'Artist with artist_id {req.artist_id} not found'
+
+        song_ids = sorted({u.id for u in req.songs})
+        found = set()
+        for i in range(0, len(song_ids), _MAX_IN_PARAMS):
+            chunk = song_ids[i:i + _MAX_IN_PARAMS]
+            found.update(song_id for song_id, in db.query(Song.id).filter(Song.id.in_(chunk)))
+        missing = [str(song_id) for song_id in song_ids if song_id not in found]
+        if missing:
+            return f'Songs with song_id {", ".join(missing)} not found'
+    finally:
+        db.close()
+
+    return None
+
+
+@router.post('/retag', response_model=DownloadJob, status_code=202)
+async def retag(req: RetagRequest):
+    """
+    Correct the tags of songs, or rename an artist and re-tag its songs, in the background.
+    Without ``artist_name`` the artist is renamed to its canonical name in the artist database.
+    The database is updated first, then the tags are written into the files, files whose tags
+    match already are skipped. The progress is reported like the progress of downloads, see
+    ``GET /status/{uid}``. Responds with 409 and the running re-tag if a re-tag is running already.
+    """
+    if not req.songs and req.artist_id is None:
+        raise HTTPException(status_code=400, detail='Either songs or artist_id is required')
+
+    missing = await run_in_threadpool(missing_retag_targets, req)
+    if missing is not None:
+        raise HTTPException(status_code=404, detail=missing)
+
+    job = DownloadJob(
+        request_id=uuid.uuid4(),
+        status=Status.WAITING,
+        percentage_done=0.0,
+        last_update=time.time(),
+        retag=RetagStats(),
+    )
+    jobs.add(job)
+
+    if not retagger.start(req, job, job_bus.publish_threadsafe):
+        del jobs[job.request_id]
+        return Response(retagger.job.json(), status_code=409, media_type='application/json')
+
+    return job.dict()
@@ -1,47 +1,103 @@
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional
 
-import slugify
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
-from starlette.responses import FileResponse
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
-from src import schemas
-from src.db import get_songs, Artist
-from src.dependencies import get_db, artist_lookup, artist_names, yt_lookup
-from src.metadata import get_metadata
-from src.schemas import MetadataRequest, SongMetadata
-from src.settings import COVER_DIR
+from src import schemas, search
+from src.db import decode_song_key, encode_song_key, get_songs, next_song_key, Artist, Song
+from src.dependencies import get_db, artist_registry, covers
+from src.files import serve_file
+from src.metadata import VideoUnavailable, get_metadata_async, get_metadata_batch_async
+from src.schemas import BatchMetadataRequest, BatchMetadataResult, MetadataRequest, SearchResult, SongMetadata
+from src.settings import COVER_CACHE_CONTROL, SONGS_PAGE_SIZE
 
 router = APIRouter()
 
 
+def stream_songs(songs: Iterable[Song]) -> Iterator[str]:
+    """Serialize songs into a JSON array one song at a time."""
+    yield '['
+    for i, song in enumerate(songs):
+        if i > 0:
+            yield ','
+        yield schemas.Song.from_orm(song).json()
+    yield ']'
+
+
 @router.get('/songs', response_model=List[schemas.Song])
-def songs(limit: Optional[int] = None, db: Session = Depends(get_db)):
-    """Get all tagged songs"""
-    return [schemas.Song.from_orm(s) for s in get_songs(db, limit=limit)]
+def songs(
+    limit: Optional[int] = Query(None, ge=0),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Get tagged songs, newest first.
+
+    If there are more than ``limit`` songs, the ``X-Next-Cursor`` header contains
+    the ``cursor`` to pass for retrieving the next page.
+    """
+    try:
+        after = decode_song_key(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'Invalid cursor {cursor}')
+
+    headers = {}
+    if limit is not None:
+        next_key = next_song_key(db, limit, after=after)
+        if next_key is not None:
+            headers['X-Next-Cursor'] = encode_song_key(next_key)
+
+    return StreamingResponse(
+        stream_songs(get_songs(db, limit=limit, after=after, page_size=SONGS_PAGE_SIZE)),
+        media_type='application/json',
+        headers=headers,
+    )
 
 
 @router.get('/cover/{artist_id}')
-async def cover(artist_id: int, db: Session = Depends(get_db)):
+def cover(artist_id: int, request: Request):
     """Get the cover art of an artist if it exists"""
-    artist = db.query(Artist).get(artist_id)
-    if artist is None:
-        raise HTTPException(status_code=404, detail=f'Artist with artist_id {artist_id} not found')
-
-    db.close()
-
-    cover_path = COVER_DIR / f'{slugify.slugify(artist.name)}.jpg'
-    if not cover_path.exists():
-        raise HTTPException(status_code=404, detail=f'Artist with artist_id {artist_id} does not have a cover')
-
-    return FileResponse(cover_path.resolve(), media_type='image/jpeg')
+    cover_path = covers.get(artist_id)
+    if cover_path is not None:
+        try:
+            return serve_file(request, cover_path, 'image/jpeg', cache_control=COVER_CACHE_CONTROL)
+        except FileNotFoundError:
+            covers.invalidate(artist_id)
+
+    raise HTTPException(status_code=404, detail=f'Artist with artist_id {artist_id} does not have a cover')
+
+
+@router.get('/search', response_model=List[SearchResult])
+def search_library(
+    q: str,
+    kind: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    """
+    Search artists, songs and albums by name, title or alias, best matches first.
+    Every word of ``q`` matches as a prefix.
+    """
+    try:
+        results = search.search(db, q, kind=kind, limit=limit, offset=offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return [SearchResult(kind=k, id=i, name=name, score=score) for k, i, name, score in results]
 
 
 @router.get('/search/artist', response_model=schemas.Artist)
-async def search_artist(name: str, db: Session = Depends(get_db)):
-    # TODO: improve search query
-    artist = db.query(Artist).filter(Artist.name.like(f'%{name}%')).first()
-
+def search_artist(name: str, db: Session = Depends(get_db)):
+    """Get the artist that best matches ``name``"""
+    try:
+        results = search.search(db, name, kind='artist', limit=1)
+    except ValueError:
+        results = []
+
+    artist = db.query(Artist).get(results[0][1]) if results else None
     if artist is None:
         raise HTTPException(status_code=404, detail=f'Artist with name {name} does not exist')
 
@@ -49,7 +105,30 @@ async def search_artist(name: str, db: Session = Depends(get_db)):
 
 
 @router.post('/metadata', response_model=SongMetadata)
-def metadata(req: MetadataRequest):
+async def metadata(req: MetadataRequest):
     """Guess info about song from given Youtube video id"""
-    meta = get_metadata(req.video_id, artist_names, artist_lookup, yt_lookup)
+    try:
+        artists = artist_registry.current
+        meta = await get_metadata_async(req.video_id, artists.matcher, artists.lookup, artists.yt_lookup)
+    except VideoUnavailable:
+        raise HTTPException(status_code=404, detail=f'Video with video_id {req.video_id} not found')
+
     return meta.dict()
+
+
+@router.post('/metadata/batch', response_model=List[BatchMetadataResult])
+async def metadata_batch(req: BatchMetadataRequest):
+    """Guess info about songs from multiple Youtube video ids, duplicate ids are returned once"""
+    artists = artist_registry.current
+    results = await get_metadata_batch_async(req.video_ids, artists.matcher, artists.lookup, artists.yt_lookup)
+
+    response = []
+    for video_id, result in results.items():
+        if isinstance(result, VideoUnavailable):
+            response.append(BatchMetadataResult(video_id=video_id, error='Video not found or private'))
+        elif isinstance(result, Exception):
+            response.append(BatchMetadataResult(video_id=video_id, error=str(result)))
+        else:
+            response.append(BatchMetadataResult(video_id=video_id, metadata=result))
+
+    return response
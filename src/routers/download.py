@@ -1,27 +1,30 @@
-import asyncio
-import copy
+import contextlib
 import time
 import uuid
 from http import HTTPStatus
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from starlette.background import BackgroundTasks
 from starlette.requests import Request
-from starlette.responses import FileResponse
-from starlette.websockets import WebSocket, WebSocketState
+from starlette.status import WS_1008_POLICY_VIOLATION
+from starlette.websockets import WebSocket
 
+from src import metrics
 from src.db import Song
-from src.dependencies import get_db, jobs
-from src.schemas import DownloadJob, SongMetadataForDownload, Status
-from src.tasks.download import start_download
+from src.dependencies import get_db, job_bus, jobs
+from src.files import serve_file
+from src.schemas import DownloadJob, PlaylistRequest, PlaylistStats, SongMetadataForDownload, Status
+from src.settings import DOWNLOAD_STALL_TIMEOUT, SONG_CACHE_CONTROL, SONGS_STORAGE
+from src.tasks.download import find_active_download, song_path
+from src.tasks.playlist import is_playlist_url
+from src.tasks.scheduler import QueueFull
 
 router = APIRouter()
 
 
 @router.get('/download/{song_id}')
-def download(song_id: int, db: Session = Depends(get_db)):
-    """Download stored song with given id"""
+def download(song_id: int, request: Request, db: Session = Depends(get_db)):
+    """Download stored song with given id, supports range and conditional requests"""
     song = db.query(Song).get(song_id)
     if song is None:
         raise HTTPException(status_code=404, detail=f'Song with song_id {song_id} not found')
@@ -30,7 +33,11 @@ def download(song_id: int, db: Session = Depends(get_db)):
     # and the song title would happen to have a period in it, the browser would
     # assume that it does and replace the 'incorrect' extension with the content-type
     # e.g. this would happen "LOVE SPACE ver. Enna Alouette" -> "LOVE SPACE ver.mp3"
-    return FileResponse(song.filepath, filename=f'{song.title}.mp3', media_type='audio/mp3')
+    try:
+        return serve_file(
+            request, song.filepath, 'audio/mp3', filename=f'{song.title}.mp3', cache_control=SONG_CACHE_CONTROL)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f'File of song with song_id {song_id} not found')
 
 
 @router.get('/status/{uid}', response_model=DownloadJob)
@@ -43,45 +50,72 @@ async def status(uid: uuid.UUID):
 
 
 @router.post('/convert', response_model=DownloadJob, status_code=HTTPStatus.ACCEPTED)
-def convert(req: SongMetadataForDownload, background_tasks: BackgroundTasks, request: Request):
-    """Start download and conversion of song with given metadata in the background"""
+async def convert(req: SongMetadataForDownload, request: Request):
+    """
+    Start download and conversion of song with given metadata in the background.
+    If the same song is already being converted, the existing job is returned.
+    Responds with 429 if the download queue is full.
+    """
+    try:
+        song_path(SONGS_STORAGE, req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job = find_active_download(req)
+    if job is not None:
+        metrics.count_job('joined')
+        return job.dict()
+
     uid = uuid.uuid4()
-    jobs[uid] = DownloadJob(request_id=uid, status=Status.WAITING, percentage_done=0.0, last_update=time.time())
-    background_tasks.add_task(start_download, request.app.state.executor, uid, req)
+    jobs.add(DownloadJob(request_id=uid, status=Status.WAITING, percentage_done=0.0, last_update=time.time()), req)
+    try:
+        request.app.state.scheduler.submit(uid, req)
+    except QueueFull as e:
+        del jobs[uid]
+        metrics.count_job('rejected')
+        raise HTTPException(
+            status_code=HTTPStatus.TOO_MANY_REQUESTS, detail=str(e), headers={'Retry-After': str(e.retry_after)})
 
     return jobs[uid].dict()
 
 
-@router.websocket('/status/ws/{uid}')
-async def status_ws(uid: uuid.UUID, ws: WebSocket):
-    await ws.accept()
-
-    closing_ws = False
+@router.post('/convert/playlist', response_model=DownloadJob, status_code=HTTPStatus.ACCEPTED)
+async def convert_playlist(req: PlaylistRequest, request: Request):
+    """
+    Download and convert every video of a playlist or channel in the background.
+    The metadata of the videos is guessed like with ``POST /metadata/batch``.
 
-    async def notifier(j: DownloadJob):
-        nonlocal closing_ws
+    Responds with the job of the playlist, its ``playlist.jobs`` are the jobs of the videos
+    once the playlist is expanded. The progress of the playlist is aggregated from them.
+    Only a few videos of a playlist are downloaded at a time, see ``PLAYLIST_CONCURRENCY``.
+    Responds with 400 if the url is not a Youtube playlist or channel.
+    """
+    if not is_playlist_url(req.url):
+        raise HTTPException(status_code=400, detail=f'{req.url} is not a Youtube playlist or channel')
 
-        if closing_ws or ws.client_state != WebSocketState.CONNECTED:
-            return
+    job = DownloadJob(
+        request_id=uuid.uuid4(),
+        status=Status.WAITING,
+        percentage_done=0.0,
+        last_update=time.time(),
+        playlist=PlaylistStats(),
+    )
+    jobs.add(job)
+    request.app.state.playlists.start(job.request_id, req)
 
-        await ws.send_text(j.json())
+    return job.dict()
 
-    job = jobs[uid]
-    job.listen(notifier)
 
-    await ws.send_text(job.json())
+@router.websocket('/status/ws/{uid}')
+async def status_ws(uid: uuid.UUID, ws: WebSocket):
+    await ws.accept()
 
-    while job.status != Status.DONE and job.status != Status.ERROR:
-        # Send error on timeout
-        if time.time() - job.last_update > 60:
-            job.remove_observer(notifier)
-            # copy job so we don't modify the original
-            jc = copy.deepcopy(job)
-            jc.status = Status.ERROR
-            await ws.send_text(jc.json())
-            break
+    if uid not in jobs:
+        await ws.close(code=WS_1008_POLICY_VIOLATION)
+        return
 
-        await asyncio.sleep(0.5)
+    async with contextlib.aclosing(job_bus.subscribe(uid, DOWNLOAD_STALL_TIMEOUT)) as updates:
+        async for job in updates:
+            await ws.send_text(job.json())
 
-    closing_ws = True
     await ws.close()
@@ -2,11 +2,13 @@ import datetime
 import logging
 import uuid
 from enum import Enum
-from typing import Callable, List, Optional
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel, PrivateAttr, validator
+from pydantic import BaseModel, conlist, validator
 from sqlalchemy.orm import Query
 
+from src.settings import METADATA_BATCH_MAX_VIDEOS
+
 logger = logging.getLogger(__name__)
 
 
@@ -35,25 +37,72 @@ class Status(Enum):
     ERROR = 'error'
 
 
+class LibraryImportStats(BaseModel):
+    # mp3 files found in the directory
+    found: int = 0
+    imported: int = 0
+    # Files that are in the database already with the same mtime and size
+    unchanged: int = 0
+    # Files that could not be read or have no ID3 tag
+    failed: int = 0
+    # Files read per second, unchanged files are not read
+    files_per_second: float = 0.0
+
+
+class RetagStats(BaseModel):
+    # Songs selected for re-tagging
+    songs: int = 0
+    # Files whose tag was written in the padding of the existing tag
+    in_place: int = 0
+    # Files whose tag did not fit, the file was rewritten with new padding
+    rewritten: int = 0
+    # Files whose tags matched the database already
+    unchanged: int = 0
+    # Files that are missing or could not be written
+    failed: int = 0
+    files_per_second: float = 0.0
+
+
+class PlaylistStats(BaseModel):
+    title: Optional[str] = None
+    # The jobs of the videos in playlist order, a video that was being downloaded already has the existing job
+    jobs: List[uuid.UUID] = []
+    videos: int = 0
+    # Videos that are unavailable or whose metadata could not be guessed
+    skipped: int = 0
+    done: int = 0
+    failed: int = 0
+    # Why the playlist could not be expanded
+    error: Optional[str] = None
+
+
 class DownloadJob(BaseModel):
     request_id: uuid.UUID
     status: Status
     percentage_done: float
     last_update: float
-
-    _observers: List[Callable] = PrivateAttr(default_factory=list)
-
-    async def notify(self):
-        for o in self._observers:
-            await o(self)
-
-    def listen(self, o: Callable):
-        logger.debug('Added listener to job %s', self)
-        self._observers.append(o)
-
-    def remove_observer(self, o: Callable):
-        if o in self._observers:
-            self._observers.remove(o)
+    # Seconds spent in each stage of the pipeline
+    timings: Dict[str, float] = {}
+    # Position in the download queue starting at 1, None when not queued
+    queue_position: Optional[int] = None
+    # Bytes received from the network for the download, and how many of those
+    # had been received before, by an attempt that could not be resumed
+    bytes_transferred: int = 0
+    bytes_retransferred: int = 0
+    download_attempts: int = 0
+    # Set for jobs that import a directory of songs instead of downloading one
+    library_import: Optional[LibraryImportStats] = None
+    # Set for jobs that re-tag songs
+    retag: Optional[RetagStats] = None
+    # Set for jobs of playlists, the progress is aggregated from the jobs of the videos
+    playlist: Optional[PlaylistStats] = None
+
+    def is_finished(self) -> bool:
+        # Assigned statuses are not converted to their values
+        return Status(self.status) in (Status.DONE, Status.ERROR)
+
+    def is_waiting(self) -> bool:
+        return Status(self.status) == Status.WAITING
 
     class Config:
         use_enum_values = True
@@ -63,6 +112,10 @@ class MetadataRequest(BaseModel):
     video_id: str
 
 
+class BatchMetadataRequest(BaseModel):
+    video_ids: conlist(str, min_items=1, max_items=METADATA_BATCH_MAX_VIDEOS)
+
+
 class Tagger(OrmBase):
     name: str
 
@@ -116,3 +169,60 @@ class SongMetadata(SongMetadataBase):
 
 class SongMetadataForDownload(SongMetadataBase):
     artists: list[str]
+
+
+class PlaylistRequest(BaseModel):
+    # The url of a playlist or channel
+    url: str
+    # Overrides the album guessed for every video
+    album: Optional[str] = None
+    tagger: Optional[str] = None
+
+
+class BatchMetadataResult(BaseModel):
+    video_id: str
+    metadata: Optional[SongMetadata]
+    error: Optional[str]
+
+
+class LibraryImportRequest(BaseModel):
+    # The directory to import songs from, by default the songs storage
+    directory: Optional[str] = None
+
+
+class SongTagUpdate(BaseModel):
+    id: int
+    # The corrected tags, tags that are not given are kept
+    title: Optional[str] = None
+    artists: Optional[List[str]] = None
+    album: Optional[str] = None
+
+
+class RetagRequest(BaseModel):
+    songs: List[SongTagUpdate] = []
+    # Re-tag the songs of this artist after renaming it to artist_name,
+    # by default to its canonical name in the artist database
+    artist_id: Optional[int] = None
+    artist_name: Optional[str] = None
+
+
+class ArtistIndexStatus(BaseModel):
+    # Increases with every reload of this worker
+    version: int
+    # sha256 of the artists file, the same in every worker that loaded the same file
+    digest: str
+    names: int
+    channels: int
+    built_at: float
+    build_seconds: float
+    reloading: bool
+    # The error of the last failed reload, cleared by a successful reload
+    last_error: Optional[str]
+
+
+class SearchResult(BaseModel):
+    kind: str
+    id: int
+    name: str
+    # bm25 score, lower is a better match
+    score: float
@@ -0,0 +1,231 @@
+"""
+This module contains the full-text search over artists, songs and albums.
+
+The search index is an FTS5 table next to the ORM tables. Every entry has a
+``name`` (the artist name, song title or album name) and ``aliases``: the
+alternative names of an artist, or the artist names of a song. The kind and
+id of the indexed row are encoded in the rowid, so entries can be replaced
+without scanning the index.
+"""
+import logging
+import re
+from typing import Any, Iterable, List, Mapping, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+
+from src.schemas import ArtistMetadata
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('artist', 'song', 'album')
+
+# Matches in names weigh more than matches in aliases
+NAME_WEIGHT = 10.0
+ALIASES_WEIGHT = 2.0
+
+# (kind, id, name, aliases)
+SearchEntry = Tuple[str, int, str, List[str]]
+
+_CREATE_INDEX = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    name,
+    aliases,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+'''
+
+_SONG_ARTISTS = '''
+SELECT song.id, song.title, group_concat(artist.name, char(31))
+FROM song
+LEFT JOIN (
+    SELECT song_id, artist_id FROM song_artist_table
+    UNION SELECT song_id, artist_id FROM song_origina_artist_table
+) AS song_artist ON song_artist.song_id = song.id
+LEFT JOIN artist ON artist.id = song_artist.artist_id
+{where}
+GROUP BY song.id
+'''
+
+_TOKEN = re.compile(r'\w+')
+
+
+def _rowid(kind: str, ref_id: int) -> int:
+    return ref_id * len(KINDS) + KINDS.index(kind)
+
+
+def create_index(engine: Any):
+    with engine.begin() as conn:
+        conn.execute(text(_CREATE_INDEX))
+
+
+def artist_entry(
+    artist_id: int,
+    name: str,
+    artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None,
+) -> SearchEntry:
+    """Create the search entry of an artist, with the alternative names from ``artist_lookup``."""
+    aliases = []
+    if artist_lookup is not None and name in artist_lookup:
+        aliases = artist_lookup[name].alternative_names
+
+    return 'artist', artist_id, name, aliases
+
+
+def index_entries(conn: Any, entries: Iterable[SearchEntry]):
+    """
+    Add entries to the search index, replacing existing entries of the same rows.
+    The caller is responsible for committing.
+
+    :param conn: a connection or session
+    :param entries: the entries to add
+    """
+    params = [
+        {'rowid': _rowid(kind, ref_id), 'name': name, 'aliases': '\n'.join(aliases)}
+        for kind, ref_id, name, aliases in entries
+    ]
+
+    if params:
+        conn.execute(
+            text('INSERT OR REPLACE INTO search_index (rowid, name, aliases) VALUES (:rowid, :name, :aliases)'),
+            params,
+        )
+
+
+def remove_entries(conn: Any, kind: str, ref_ids: Iterable[int]):
+    """
+    Remove the entries of rows from the search index.
+    The caller is responsible for committing.
+    """
+    params = [{'rowid': _rowid(kind, ref_id)} for ref_id in ref_ids]
+
+    if params:
+        conn.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), params)
+
+
+def rebuild_index(engine: Any, artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None) -> int:
+    """
+    Rebuild the search index from the artist, song and album tables.
+
+    :param engine: the database engine
+    :param artist_lookup: the artists by name, for indexing alternative names
+    :return: the number of indexed entries
+    """
+    with engine.begin() as conn:
+        conn.execute(text(_CREATE_INDEX))
+        conn.execute(text('DELETE FROM search_index'))
+
+        entries = [artist_entry(i, name, artist_lookup) for i, name in conn.execute(text('SELECT id, name FROM artist'))]
+        entries.extend(('album', i, name, []) for i, name in conn.execute(text('SELECT id, name FROM album')))
+        entries.extend(
+            ('song', i, title, artists.split('\x1f') if artists else [])
+            for i, title, artists in conn.execute(text(_SONG_ARTISTS.format(where='')))
+        )
+
+        index_entries(conn, entries)
+
+        # Merge the index segments, the index is mostly read after a rebuild
+        conn.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+
+    logger.info('Rebuilt search index with %d entries', len(entries))
+    return len(entries)
+
+
+def reindex_artists(engine: Any, artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None) -> int:
+    """
+    Replace the entries of all artists, e.g. after their alternative names changed.
+
+    :return: the number of indexed artists
+    """
+    with engine.begin() as conn:
+        entries = [artist_entry(i, name, artist_lookup) for i, name in conn.execute(text('SELECT id, name FROM artist'))]
+        index_entries(conn, entries)
+
+    logger.info('Re-indexed %d artists', len(entries))
+    return len(entries)
+
+
+def reindex_songs(conn: Any, song_ids: List[int]):
+    """
+    Replace the entries of songs from the database, e.g. after their titles or artists changed.
+    The caller is responsible for committing.
+    """
+    # src.db imports this module
+    from src.db import _MAX_IN_PARAMS
+
+    query = text(_SONG_ARTISTS.format(where='WHERE song.id IN :ids')).bindparams(bindparam('ids', expanding=True))
+
+    for i in range(0, len(song_ids), _MAX_IN_PARAMS):
+        rows = conn.execute(query, {'ids': song_ids[i:i + _MAX_IN_PARAMS]})
+        index_entries(conn, [
+            ('song', song_id, title, artists.split('\x1f') if artists else []) for song_id, title, artists in rows
+        ])
+
+
+def ensure_index(engine: Any, artist_lookup: Optional[Mapping[str, ArtistMetadata]] = None):
+    """Build the search index if it is empty, e.g. for databases created before search existed."""
+    with engine.connect() as conn:
+        indexed = conn.execute(text('SELECT EXISTS (SELECT 1 FROM search_index)')).scalar()
+        has_rows = conn.execute(text(
+            'SELECT EXISTS (SELECT 1 FROM artist) OR EXISTS (SELECT 1 FROM song) OR EXISTS (SELECT 1 FROM album)'
+        )).scalar()
+
+    if has_rows and not indexed:
+        rebuild_index(engine, artist_lookup)
+
+
+def match_query(query: str) -> str:
+    """
+    Convert user input into an FTS5 query, every word matches as a prefix.
+
+    :raises ValueError: if the query contains no words
+    """
+    tokens = _TOKEN.findall(query)
+    if not tokens:
+        raise ValueError(f'Query {query!r} does not contain any words')
+
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+
+def search(
+    conn: Any,
+    query: str,
+    kind: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> List[Tuple[str, int, str, float]]:
+    """
+    Search the index, best matches first.
+
+    :param conn: a connection or session
+    :param query: the words to search for
+    :param kind: only return entries of this kind, one of ``KINDS``
+    :param limit: the max number of results
+    :param offset: the number of results to skip
+    :return: tuples of (kind, id, name, score), a lower score is a better match
+    :raises ValueError: if the query contains no words or the kind is unknown
+    """
+    params = {
+        'query': match_query(query),
+        'limit': limit,
+        'offset': offset,
+        'name_weight': NAME_WEIGHT,
+        'aliases_weight': ALIASES_WEIGHT,
+    }
+
+    kind_filter = ''
+    if kind is not None:
+        if kind not in KINDS:
+            raise ValueError(f'Unknown kind {kind}, expected one of {KINDS}')
+        kind_filter = f'AND rowid % {len(KINDS)} = :kind'
+        params['kind'] = KINDS.index(kind)
+
+    rows = conn.execute(text(f'''
+        SELECT rowid, name, bm25(search_index, :name_weight, :aliases_weight) AS score
+        FROM search_index
+        WHERE search_index MATCH :query {kind_filter}
+        ORDER BY score
+        LIMIT :limit OFFSET :offset
+    '''), params)
+
+    return [(KINDS[rowid % len(KINDS)], rowid // len(KINDS), name, score) for rowid, name, score in rows]
@@ -23,10 +23,125 @@ API_URL = f'/api/{VERSION}'
 SONGS_STORAGE = ROOT_PATH / 'data' / 'songs'
 DB = ROOT_PATH / 'data' / 'db.sqlite'
 ARTISTS = ROOT_PATH / 'data' / 'artists' / 'artists.json'
+# Precompiled version of ARTISTS, rebuilt automatically when ARTISTS changes
+ARTISTS_SNAPSHOT = ROOT_PATH / 'data' / 'artists' / 'artists.snapshot'
+# Seconds between checks whether ARTISTS changed, the artists are reloaded when it did, 0 disables reloading
+ARTISTS_RELOAD_INTERVAL = float(os.environ.get('ARTISTS_RELOAD_INTERVAL', 5))
 COVER_DIR = ROOT_PATH / 'data' / 'artists' / 'covers'
 
+# Cache-Control headers of served files. Covers are cached briefly and then revalidated with their ETag,
+# the cover of an artist changes when the covers are re-downloaded or the artist is renamed or merged.
+# Songs are always revalidated as they can be re-tagged
+COVER_CACHE_CONTROL = os.environ.get('COVER_CACHE_CONTROL', 'public, max-age=300')
+SONG_CACHE_CONTROL = os.environ.get('SONG_CACHE_CONTROL', 'private, no-cache')
+
+# Cache of the thumbnails embedded in songs, the least recently used thumbnails
+# are evicted when the cache is larger than THUMBNAIL_CACHE_SIZE bytes
+THUMBNAIL_CACHE_DIR = ROOT_PATH / 'data' / 'thumbnails'
+THUMBNAIL_CACHE_SIZE = int(os.environ.get('THUMBNAIL_CACHE_SIZE', 256 * 1024 * 1024))
+# Thumbnails larger than THUMBNAIL_MAX_DIMENSION pixels are downscaled and recompressed
+# with ffmpeg quality THUMBNAIL_QUALITY (2 is best, 31 is worst), 0 embeds the original image
+THUMBNAIL_MAX_DIMENSION = int(os.environ.get('THUMBNAIL_MAX_DIMENSION', 0))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 3))
+
+# The number of songs shown on the index page and fetched per database query
+SONGS_PAGE_SIZE = int(os.environ.get('SONGS_PAGE_SIZE', 100))
+
+# How downloaded media is converted to mp3
+# - single_pass: probe the download and convert and tag it in one ffmpeg run
+# - legacy: let yt-dlp extract mp3, re-encode if needed and tag with eyed3
+AUDIO_PIPELINE = os.environ.get('AUDIO_PIPELINE', 'single_pass')
+
+# How download jobs are run, either 'thread' or 'process'
+# In process mode jobs do not compete for the GIL of the server process
+DOWNLOAD_EXECUTOR = os.environ.get('DOWNLOAD_EXECUTOR', 'thread')
+# The maximum number of concurrent downloads (network bound) and conversions (CPU bound)
+DOWNLOAD_SLOTS = int(os.environ.get('DOWNLOAD_SLOTS', 4))
+CONVERT_SLOTS = int(os.environ.get('CONVERT_SLOTS', os.cpu_count() or 1))
+# The number of download workers, by default enough to fill all slots
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', DOWNLOAD_SLOTS + CONVERT_SLOTS))
+# The maximum number of jobs waiting for a download slot, further requests get a 429
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 32))
+
+# Playlists and channels are expanded into one job per video, at most PLAYLIST_MAX_VIDEOS videos.
+# At most PLAYLIST_CONCURRENCY jobs of a playlist are queued or running at a time,
+# so a large playlist leaves download slots for other requests
+PLAYLIST_MAX_VIDEOS = int(os.environ.get('PLAYLIST_MAX_VIDEOS', 500))
+PLAYLIST_CONCURRENCY = int(os.environ.get('PLAYLIST_CONCURRENCY', 2))
+
+# Failed downloads are retried up to DOWNLOAD_RETRIES times, waiting DOWNLOAD_BACKOFF_BASE
+# seconds before the first retry and twice as long before every next one, up to DOWNLOAD_BACKOFF_MAX.
+# Retries resume from the partially downloaded file.
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', 5))
+DOWNLOAD_BACKOFF_BASE = float(os.environ.get('DOWNLOAD_BACKOFF_BASE', 1))
+DOWNLOAD_BACKOFF_MAX = float(os.environ.get('DOWNLOAD_BACKOFF_MAX', 60))
+# The number of fragments of a fragmented format (e.g. DASH) that are downloaded concurrently
+DOWNLOAD_CONCURRENT_FRAGMENTS = int(os.environ.get('DOWNLOAD_CONCURRENT_FRAGMENTS', 4))
+# Partial downloads that were not touched for PARTIAL_FILE_MAX_AGE seconds are deleted,
+# the songs storage is checked every PARTIAL_CLEANUP_INTERVAL seconds
+PARTIAL_FILE_MAX_AGE = int(os.environ.get('PARTIAL_FILE_MAX_AGE', 24 * 60 * 60))
+PARTIAL_CLEANUP_INTERVAL = int(os.environ.get('PARTIAL_CLEANUP_INTERVAL', 60 * 60))
+
+# Library imports read the tags of existing mp3 files in LIBRARY_IMPORT_WORKERS processes,
+# and add them to the database in transactions of LIBRARY_IMPORT_BATCH_SIZE songs
+LIBRARY_IMPORT_WORKERS = int(os.environ.get('LIBRARY_IMPORT_WORKERS', os.cpu_count() or 1))
+LIBRARY_IMPORT_BATCH_SIZE = int(os.environ.get('LIBRARY_IMPORT_BATCH_SIZE', 500))
+# The directories POST /admin/library/import may import from, besides the songs storage,
+# separated by os.pathsep (':' on Linux). Imported songs can be downloaded and re-tagged through the API
+LIBRARY_IMPORT_DIRS = [Path(d) for d in os.environ.get('LIBRARY_IMPORT_DIRS', '').split(os.pathsep) if d]
+
+# Bytes of padding reserved after the ID3 tag of songs, re-tagging writes the tag in place
+# as long as it fits, without rewriting the audio
+ID3_PADDING = int(os.environ.get('ID3_PADDING', 2048))
+# Re-tagging writes the tags of RETAG_WORKERS files in parallel threads
+RETAG_WORKERS = int(os.environ.get('RETAG_WORKERS', 4))
+
 # The amount of seconds a download request should exist until timeout
 DOWNLOAD_REQUEST_TTL = 10 * 60
+# Where download jobs are kept, either 'sqlite' or 'memory'
+# The sqlite store is shared by all workers and resumes jobs that were interrupted by a restart
+JOB_STORE = os.environ.get('JOB_STORE', 'sqlite')
+JOB_STORE_DB = ROOT_PATH / 'data' / 'jobs.sqlite'
+# The maximum number of jobs in the memory store
+JOB_STORE_SIZE = int(os.environ.get('JOB_STORE_SIZE', 10_000))
+# Seconds without progress after which a job is reported as failed to status listeners
+DOWNLOAD_STALL_TIMEOUT = 60
+# Download progress is published at most every PROGRESS_MIN_INTERVAL seconds,
+# and only when it changed by at least PROGRESS_MIN_DELTA (a fraction between 0 and 1)
+PROGRESS_MIN_INTERVAL = float(os.environ.get('PROGRESS_MIN_INTERVAL', .5))
+PROGRESS_MIN_DELTA = float(os.environ.get('PROGRESS_MIN_DELTA', .01))
+# The maximum number of status updates per second a listener receives for a job
+JOB_UPDATES_PER_SECOND = float(os.environ.get('JOB_UPDATES_PER_SECOND', 4))
+
+# Collect metrics and serve them at /metrics, disabling removes the instrumentation entirely
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# The admin endpoints (/admin/...) require this token in the X-Admin-Token header,
+# they answer every request with 403 while it is not set
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or None
 
 # For getting video info
 YOUTUBE_DEVELOPER_KEY = os.environ.get('YOUTUBE_DEVELOPER_KEY')
+
+# Trimmed copy of the discovery document of the Youtube Data API, so creating the client makes no request
+YOUTUBE_DISCOVERY_DOC = ROOT_PATH / 'data' / 'youtube' / 'youtube.v3.discovery.json'
+# Overrides the root url of the API, e.g. http://127.0.0.1:8765/ for entry/scripts/fake_youtube_api.py
+YOUTUBE_API_ROOT_URL = os.environ.get('YOUTUBE_API_ROOT_URL')
+# Seconds until a request to the API times out, timed out and failed requests (connection errors,
+# 429 and 5xx responses) are retried up to YOUTUBE_API_RETRIES times with exponential backoff
+YOUTUBE_API_TIMEOUT = float(os.environ.get('YOUTUBE_API_TIMEOUT', 10))
+YOUTUBE_API_RETRIES = int(os.environ.get('YOUTUBE_API_RETRIES', 3))
+# The number of threads running API requests for the async endpoints, each keeps its connection alive
+YOUTUBE_API_WORKERS = int(os.environ.get('YOUTUBE_API_WORKERS', 8))
+# The maximum number of videos of one POST /metadata/batch request, every 50 videos take an API call
+METADATA_BATCH_MAX_VIDEOS = int(os.environ.get('METADATA_BATCH_MAX_VIDEOS', 200))
+
+# Caching of Youtube API responses
+YOUTUBE_CACHE_TTL = int(os.environ.get('YOUTUBE_CACHE_TTL', 24 * 60 * 60))
+YOUTUBE_CACHE_SIZE = int(os.environ.get('YOUTUBE_CACHE_SIZE', 10_000))
+# Set YOUTUBE_CACHE_PERSIST=false to only cache in memory
+YOUTUBE_CACHE_DB = (
+    ROOT_PATH / 'data' / 'youtube_cache.sqlite'
+    if os.environ.get('YOUTUBE_CACHE_PERSIST', 'true').lower() == 'true' else None
+)
+YOUTUBE_CACHE_DB_SIZE = int(os.environ.get('YOUTUBE_CACHE_DB_SIZE', 100_000))
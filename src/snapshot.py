@@ -0,0 +1,155 @@
+"""
+This module contains the precompiled artist index snapshot.
+
+Processing the vdb dump (json parsing, romaiji conversion, model validation)
+takes about a second, which every worker would pay on startup. The processed
+lookups are therefore stored in a compact binary file that is keyed by a hash
+of the source file, and is only rebuilt when the source changes.
+
+Layout of the snapshot file::
+
+    magic (4 bytes) | format version (u16) | sha256 of source (32 bytes) | payload length (u64) | padding | payload
+
+The payload is an :class:`src.artist_store.ArtistStore`, which is used directly
+from the read-only mapping of the file. Workers loading the same snapshot share
+its pages, and loading it does not create any objects per artist.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import pathlib
+import struct
+from typing import Mapping, Optional, Sequence
+
+from src.artist_store import Artist, ArtistStore, encode_store
+from src.metadata import load_vdb_artists
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'HTAS'
+SNAPSHOT_VERSION = 2
+
+# Padded so the arrays of the payload are aligned
+_HEADER = struct.Struct('<4sH32sQ2x')
+
+ArtistLookups = tuple[Sequence[str], Mapping[str, Artist], Mapping[str, Artist]]
+
+
+def source_digest(artists_file: pathlib.Path) -> bytes:
+    """Sha256 digest of the source artists file."""
+    h = hashlib.sha256()
+    with artists_file.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def write_snapshot(snapshot_file: pathlib.Path, digest: bytes, lookups: ArtistLookups):
+    """
+    Write processed lookups to ``snapshot_file``, the file is replaced atomically.
+
+    :param snapshot_file: path to write the snapshot to
+    :param digest: the digest of the source file the lookups were created from
+    :param lookups: the processed lookups, as returned by :func:`src.metadata.load_vdb_artists`
+    """
+    payload = encode_store(*lookups)
+
+    tmp_file = snapshot_file.with_name(f'{snapshot_file.name}.{os.getpid()}.tmp')
+    try:
+        with tmp_file.open('wb') as f:
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, digest, len(payload)))
+            f.write(payload)
+        os.replace(tmp_file, snapshot_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+    logger.info('Wrote artist snapshot %s (%d bytes)', snapshot_file, _HEADER.size + len(payload))
+
+
+def build_snapshot(artists_file: pathlib.Path, snapshot_file: pathlib.Path) -> ArtistLookups:
+    """
+    Process the vdb artists file and write the result to ``snapshot_file``.
+
+    :return: the processed lookups
+    """
+    digest = source_digest(artists_file)
+    lookups = load_vdb_artists(artists_file)
+    write_snapshot(snapshot_file, digest, lookups)
+
+    return lookups
+
+
+def load_snapshot(artists_file: pathlib.Path, snapshot_file: pathlib.Path) -> Optional[ArtistLookups]:
+    """
+    Load the artist lookups from a snapshot. The lookups read from a mapping
+    of the file, which stays open as long as they are used.
+
+    :return: the lookups, or None if the snapshot is missing, corrupt or
+        does not belong to the current contents of ``artists_file``
+    """
+    try:
+        f = snapshot_file.open('rb')
+    except FileNotFoundError:
+        return None
+
+    with f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            return None
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    store = _load_mapped(mm, artists_file)
+    if store is None:
+        mm.close()
+        return None
+
+    return store.lookups()
+
+
+def _load_mapped(mm: mmap.mmap, artists_file: pathlib.Path) -> Optional[ArtistStore]:
+    magic, version, digest, length = _HEADER.unpack_from(mm)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        logger.info('Artist snapshot has an unknown format')
+        return None
+
+    if digest != source_digest(artists_file):
+        logger.info('Artist snapshot is stale')
+        return None
+
+    if len(mm) != _HEADER.size + length:
+        logger.warning('Artist snapshot is truncated')
+        return None
+
+    payload = memoryview(mm)[_HEADER.size:]
+    try:
+        return ArtistStore(payload)
+    except (ValueError, TypeError):
+        payload.release()
+        logger.warning('Artist snapshot is corrupt', exc_info=True)
+        return None
+
+
+def load_artists(artists_file: pathlib.Path, snapshot_file: pathlib.Path) -> ArtistLookups:
+    """
+    Load the artist lookups, using the snapshot if it is up to date
+    and (re)building it otherwise.
+    """
+    lookups = load_snapshot(artists_file, snapshot_file)
+    if lookups is not None:
+        return lookups
+
+    digest = source_digest(artists_file)
+    lookups = load_vdb_artists(artists_file)
+
+    try:
+        write_snapshot(snapshot_file, digest, lookups)
+    except OSError:
+        # e.g. read-only filesystem, not being able to cache is not fatal
+        logger.warning('Could not write artist snapshot', exc_info=True)
+        return ArtistStore(encode_store(*lookups)).lookups()
+
+    lookups = load_snapshot(artists_file, snapshot_file)
+    if lookups is None:
+        raise RuntimeError(f'Could not load the artist snapshot {snapshot_file} that was just written')
+    return lookups
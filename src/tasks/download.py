@@ -1,27 +1,39 @@
-import asyncio
+import contextlib
+import hashlib
+import json
 import logging
+import os
+import re
+import shutil
 import time
-import uuid
 from pathlib import Path
-from typing import Any
-from typing import List, Optional
+from typing import Any, Dict
+from typing import List, Optional, Tuple
 
-import yt_dlp
-from slugify import slugify
 from sqlalchemy.orm import Session
 
 import src.settings as settings
-from src.db import add_song
-from src.dependencies import engine, jobs
-from src.metadata import add_metadata, force_mp3
-from src.schemas import DownloadJob, SongMetadataForDownload, Status
+from src.db import add_song, get_stored_media, set_stored_media, song_exists
+from src.dependencies import active_downloads, artist_registry, engine, jobs, thumbnails
+from src.metadata import add_metadata, encode_and_tag, force_mp3
+from src.schemas import DownloadJob, SongMetadataForDownload
+from src.tasks.progress import ProgressReporter
+from src.tasks.resume import TransferMeter, download_with_retry
 
 logger = logging.getLogger(__name__)
 
 
-def init_ydl_options(output_dir: Path, song_title: str, hooks: list) -> dict:
-    return {
+def init_ydl_options(output_dir: Path, song_title: str, hooks: list, extract_audio: bool = True) -> dict:
+    options = {
         'format': 'bestaudio/best',
+        'logger': logger,
+        'progress_hooks': hooks,
+        'outtmpl': f'{output_dir.resolve()}/{song_title}.%(ext)s',
+        'concurrent_fragment_downloads': settings.DOWNLOAD_CONCURRENT_FRAGMENTS,
+        'fragment_retries': settings.DOWNLOAD_RETRIES,
+    }
+
+    if extract_audio:
         # XXX: If the outputted codec is not mp3
         #   we do two ffmpeg steps
         # The supported formats are:
@@ -29,15 +41,82 @@ def init_ydl_options(output_dir: Path, song_title: str, hooks: list) -> dict:
         # - PCM audio in WAV container
         # - AAC audio in MOV container
         # - FLAC audio
-        'postprocessors': [{
+        options['postprocessors'] = [{
             'key': 'FFmpegExtractAudio',
             'preferredcodec': 'mp3',
             'preferredquality': '0',
-        }],
-        'logger': logger,
-        'progress_hooks': hooks,
-        'outtmpl': f'{output_dir.resolve()}/{song_title}.%(ext)s',
-    }
+        }]
+
+    return options
+
+
+@contextlib.contextmanager
+def record_time(timings: Dict[str, float], stage: str):
+    """Add the duration of the block to ``timings`` under ``stage``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+# Video ids are used as directory names
+_VIDEO_ID = re.compile(r'[\w-]+')
+
+
+def tag_digest(meta: SongMetadataForDownload) -> str:
+    """Digest of the metadata that is embedded in the song file."""
+    tags = [meta.title, meta.artists, meta.album, meta.thumbnail_url]
+    return hashlib.sha256(json.dumps(tags).encode()).hexdigest()[:16]
+
+
+def song_path(storage_dir: Path, meta: SongMetadataForDownload) -> Path:
+    """
+    The path of the song file, addressed by the video id and the embedded metadata.
+    Requests for the same song therefore share a file, and songs with the same title do not collide.
+    Songs that are re-tagged later are moved out of this path, see :func:`src.retag.retagged_path`.
+
+    :raises ValueError: if the video id is not a valid Youtube video id
+    """
+    if _VIDEO_ID.fullmatch(meta.video_id) is None:
+        raise ValueError(f'Invalid video id {meta.video_id}')
+
+    return storage_dir / meta.video_id / f'{tag_digest(meta)}.mp3'
+
+
+def download_key(meta: SongMetadataForDownload) -> Tuple[str, str, str]:
+    """Requests with the same key produce the same song file."""
+    return meta.video_id, settings.AUDIO_PIPELINE, tag_digest(meta)
+
+
+def cached_thumbnail(meta: SongMetadataForDownload, timings: Dict[str, float]) -> Path:
+    """Get the thumbnail of a song from the cache, waiting for it if it is still being fetched."""
+    with record_time(timings, 'thumbnail_fetch'):
+        return thumbnails.get(meta.thumbnail_url)
+
+
+def retag(media_file: Path, song_file: Path, meta: SongMetadataForDownload, timings: Dict[str, float]) -> Path:
+    """Create a song file with different tags from the stored audio of a video."""
+    thumbnail = cached_thumbnail(meta, timings)
+
+    if settings.AUDIO_PIPELINE == 'single_pass':
+        # The stored audio is an mp3, so the audio stream is copied
+        return encode_and_tag(media_file, meta, thumbnail, timings=timings,
+                              output=song_file, keep_source=True)
+
+    with record_time(timings, 'tag'):
+        tmp_song = song_file.with_name(f'{song_file.stem}.tmp.mp3')
+        shutil.copyfile(media_file, tmp_song)
+        add_metadata(tmp_song, meta, thumbnail)
+        os.replace(tmp_song, song_file)
+
+    return song_file
+
+
+# What the convert stage does with the media from the download stage
+REUSE = 'reuse'
+RETAG = 'retag'
+ENCODE = 'encode'
 
 
 def download_and_tag(
@@ -48,99 +127,237 @@ def download_and_tag(
     job: DownloadJob,
     hooks: Optional[list] = None,
 ):
+    action, media_file = fetch_media(storage_dir, url, meta, db_engine, job, hooks)
+    tag_media(storage_dir, meta, db_engine, job, action, media_file)
+
+
+def fetch_media(
+    storage_dir: Path,
+    url: str,
+    meta: SongMetadataForDownload,
+    db_engine: Any,
+    job: DownloadJob,
+    hooks: Optional[list] = None,
+) -> Tuple[str, Path]:
+    """
+    Download stage of a job, gets the media to create the song from.
+    Nothing is downloaded if the song or the audio of its video is stored already.
+
+    :return: the action for the convert stage and the media file
+    """
     if hooks is None:
         hooks = []
 
-    out_dir = storage_dir / meta.album
-
-    # TODO: replace this with a more elegant solution.
-    #   E.g. replace slashes in the name
-    stored_song_name = slugify(meta.title)
+    target = song_path(storage_dir, meta)
+    target.parent.mkdir(parents=True, exist_ok=True)
 
-    # Step 1: Download song
-    ydl_options = init_ydl_options(out_dir, stored_song_name, hooks)
-    with yt_dlp.YoutubeDL(ydl_options) as ydl:
-        ydl.download([url])
+    if target.exists():
+        # The same song was converted before
+        logger.info('Job %s reuses %s', job.request_id, target)
+        return REUSE, target
 
-    # HACK: force 100 if ytd does not fire final hook
-    if job.percentage_done < 1.0:
-        job.percentage_done = 1.0
+    # The thumbnail is fetched while the audio is downloaded
+    thumbnails.prefetch(meta.thumbnail_url)
 
-    # Step 2: Add metadata to song
+    # Note: weirdly enough SQLAlchemy 1.3 does not work with the session context manager
+    #       using `with Session(engine)` results in an AttributeError, that's why the
+    #       session is created manually.
+    s = Session(db_engine)
     try:
-        # XXX: glob for downloaded file, the caller should ensure that
-        #   there is no existing song with the same title
-        song_path = next(out_dir.glob(f'{stored_song_name}.*'))
-    except StopIteration:
-        raise RuntimeError('Missing downloaded file')
+        stored_media = get_stored_media(s, meta.video_id, settings.AUDIO_PIPELINE)
+    finally:
+        s.close()
+
+    if stored_media is not None:
+        # The video was downloaded before with different tags
+        logger.info('Job %s re-tags %s', job.request_id, stored_media)
+        return RETAG, stored_media
+
+    return ENCODE, download_media(url, target, job, hooks)
+
 
-    song_path = force_mp3(song_path)
+def tag_media(
+    storage_dir: Path,
+    meta: SongMetadataForDownload,
+    db_engine: Any,
+    job: DownloadJob,
+    action: str,
+    media_file: Path,
+) -> Path:
+    """
+    Convert stage of a job, creates the tagged song from the media of :func:`fetch_media`
+    and adds it to the database.
+
+    :return: the path to the song file
+    """
+    target = song_path(storage_dir, meta)
 
-    add_metadata(song_path, meta, meta.thumbnail_url)
+    if action == RETAG:
+        song_file = retag(media_file, target, meta, job.timings)
+    elif action == ENCODE:
+        song_file = encode_media(media_file, target, meta, job)
+    else:
+        song_file = media_file
+
+    job.percentage_done = 1.0
 
     # Step 3: Add song info to persistence
-    # Note: weirdly enough SQLAlchemy 1.3 does not work with the session context manager
-    #       using `with Session(engine)` results in an AttributeError, that's why the
-    #       session is created manually.
     s = Session(db_engine)
     try:
-        add_song(s, meta, song_path)
+        with record_time(job.timings, 'db'):
+            if action == ENCODE:
+                set_stored_media(s, meta.video_id, settings.AUDIO_PIPELINE, song_file)
+            if not song_exists(s, song_file):
+                add_song(s, meta, song_file, artist_lookup=artist_registry.current.lookup)
     except Exception as e:  # noqa
         logger.error(e)
         s.rollback()
         raise
-    s.close()
+    finally:
+        s.close()
+
+    logger.info('Job %s stage timings (%s pipeline): %s', job.request_id, settings.AUDIO_PIPELINE,
+                ', '.join(f'{k}={v:.2f}s' for k, v in job.timings.items()))
+
+    return song_file
+
+
+def download_media(url: str, target: Path, job: DownloadJob, hooks: list) -> Path:
+    """
+    Download the audio of a video next to ``target``.
 
+    :return: the downloaded file
+    """
+    out_dir = target.parent
+
+    # Step 1: Download song
+    # In the single pass pipeline the media is downloaded as is,
+    # and only converted once when adding the metadata
+    single_pass = settings.AUDIO_PIPELINE == 'single_pass'
+    meter = TransferMeter()
+    ydl_options = init_ydl_options(out_dir, target.stem, [*hooks, meter], extract_audio=not single_pass)
+    try:
+        with record_time(job.timings, 'download'):
+            job.download_attempts = download_with_retry(
+                url,
+                ydl_options,
+                out_dir,
+                target.stem,
+                meter,
+                retries=settings.DOWNLOAD_RETRIES,
+                backoff_base=settings.DOWNLOAD_BACKOFF_BASE,
+                backoff_max=settings.DOWNLOAD_BACKOFF_MAX,
+            )
+    finally:
+        job.bytes_transferred = meter.transferred
+        job.bytes_retransferred = meter.retransferred
+
+    logger.info('Job %s downloaded %d bytes in %d attempts, %d bytes were downloaded again',
+                job.request_id, meter.transferred, job.download_attempts, meter.retransferred)
+
+    # HACK: force 100 if ytd does not fire final hook
+    if job.percentage_done < 1.0:
+        job.percentage_done = 1.0
+
+    try:
+        return next(p for p in out_dir.glob(f'{target.stem}.*') if p.suffix not in ('.part', '.ytdl'))
+    except StopIteration:
+        raise RuntimeError('Missing downloaded file')
 
-def create_download_hook(job: DownloadJob):
-    def download_hook(response):
-        loop = asyncio.get_event_loop()
 
-        if response['status'] == 'finished' or response['total_bytes'] == response['downloaded_bytes']:
-            job.status = Status.CONVERTING
-            loop.run_until_complete(job.notify())
-            return
+def encode_media(media_file: Path, target: Path, meta: SongMetadataForDownload, job: DownloadJob) -> Path:
+    """Step 2: Convert the downloaded media to mp3 and add metadata."""
+    thumbnail = cached_thumbnail(meta, job.timings)
 
-        total_bytes = response['total_bytes']
-        downloaded_bytes = response['downloaded_bytes']
-        job.percentage_done = downloaded_bytes / total_bytes
-        job.last_update = time.time()
+    if settings.AUDIO_PIPELINE == 'single_pass':
+        return encode_and_tag(media_file, meta, thumbnail, timings=job.timings, output=target)
 
-        loop.run_until_complete(job.notify())
+    with record_time(job.timings, 'force_mp3'):
+        song_file = force_mp3(media_file)
 
-    return download_hook
+    with record_time(job.timings, 'tag'):
+        add_metadata(song_file, meta, thumbnail)
 
+    return song_file
 
-def download_worker(req: SongMetadataForDownload, job: DownloadJob):
+
+# Channel for sending job updates to the parent, set by the executor for each worker
+_update_channel: Optional[Any] = None
+
+# The job fields that are owned by the worker while it runs
+WORKER_JOB_FIELDS = {
+    'status', 'percentage_done', 'last_update', 'timings',
+    'bytes_transferred', 'bytes_retransferred', 'download_attempts',
+}
+
+
+def set_update_channel(channel: Any):
+    """Executor initializer, ``channel`` is a queue shared with the parent."""
+    global _update_channel
+    _update_channel = channel
+
+
+def init_process_worker(channel: Any):
     """
-    Synchronous CPU-bound download job.
-    This should be run in a separate thread/process.
+    Executor initializer of worker processes, which have their own copy of the artists.
+    Reloads only replace that copy, the search index of the artists is updated by the server.
     """
-    # Create new asyncio event loop, in case threading is used
-    asyncio.set_event_loop(asyncio.new_event_loop())
+    set_update_channel(channel)
+    if settings.ARTISTS_RELOAD_INTERVAL > 0:
+        artist_registry.watch(settings.ARTISTS_RELOAD_INTERVAL)
 
-    download_hook = create_download_hook(job)
 
-    logger.info('Worker %s starting %s', job.request_id, req.title)
+def publish(job: DownloadJob):
+    """Send the current state of ``job`` to the parent."""
+    if _update_channel is not None:
+        _update_channel.put((job.request_id, job.dict(include=WORKER_JOB_FIELDS)))
+
+
+def download_worker(req: SongMetadataForDownload, job: DownloadJob) -> Tuple[dict, str, Path]:
+    """
+    Download stage of a job, mostly waits on the network.
+    This should be run in a separate thread/process.
+
+    :param req: the song to download
+    :param job: a copy of the job, progress is sent to the parent over the update channel
+    :return: the final state of the job fields owned by the worker, and the action and media for the convert stage
+    """
+    download_hook = ProgressReporter(
+        job,
+        publish,
+        min_interval=settings.PROGRESS_MIN_INTERVAL,
+        min_delta=settings.PROGRESS_MIN_DELTA,
+    )
+
+    logger.info('Worker %s downloading %s', job.request_id, req.title)
     url = f'http://youtube.com/watch?v={req.video_id}'
-    download_and_tag(settings.SONGS_STORAGE, url, req, engine, job, hooks=[download_hook])
+    action, media_file = fetch_media(settings.SONGS_STORAGE, url, req, engine, job, hooks=[download_hook])
 
+    return job.dict(include=WORKER_JOB_FIELDS - {'status'}), action, media_file
 
-async def start_download(executor: Any, uid: uuid.UUID, req) -> None:
-    loop = asyncio.get_event_loop()
-    job = jobs[uid]
-    job.status = Status.DOWNLOADING
 
-    logger.debug('Starting download job, job=%s', id(job))
+def convert_worker(req: SongMetadataForDownload, job: DownloadJob, action: str, media_file: Path) -> dict:
+    """
+    Convert stage of a job, CPU-bound.
+    This should be run in a separate thread/process.
 
-    await job.notify()
-    try:
-        await loop.run_in_executor(executor, download_worker, req, job)
-    except Exception as e:  # noqa
-        logger.error(e, exc_info=True)
-        job.status = Status.ERROR
-    else:
-        logger.debug('Job finished, job=%s', id(job))
-        job.status = Status.DONE
-    finally:
-        await job.notify()
+    :return: the final state of the job fields owned by the worker
+    """
+    logger.info('Worker %s converting %s', job.request_id, req.title)
+    tag_media(settings.SONGS_STORAGE, req, engine, job, action, media_file)
+
+    return job.dict(include=WORKER_JOB_FIELDS - {'status'})
+
+
+def find_active_download(req: SongMetadataForDownload) -> Optional[DownloadJob]:
+    """
+    Get the unfinished job that produces the same song as ``req``, if any.
+    This must be called on the event loop.
+    """
+    uid = active_downloads.get(download_key(req))
+    job = jobs.get(uid) if uid is not None else None
+
+    if job is None or job.is_finished():
+        return None
+
+    return job
@@ -0,0 +1,102 @@
+"""
+This module contains the executor that runs download jobs.
+
+Jobs run in a thread or a process pool, depending on ``settings.DOWNLOAD_EXECUTOR``.
+Workers never touch the ``jobs`` cache directly, they send their job state over
+an update channel (a queue) and the parent process applies it to the
+:class:`DownloadJob` and publishes it on the job bus.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import threading
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from src.dependencies import job_bus, jobs
+from src.tasks.download import init_process_worker, set_update_channel
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_MODES = ('thread', 'process')
+
+# Sentinel to stop the update pump
+_STOP = None
+
+
+class DownloadExecutor:
+    """
+    Pool of download workers with a channel for sending job updates to the parent.
+
+    :param mode: either 'thread' or 'process'
+    :param max_workers: the size of the pool, None uses the pool default
+    """
+
+    def __init__(self, mode: str = 'thread', max_workers: Optional[int] = None):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f'Unknown executor mode {mode}, expected one of {EXECUTOR_MODES}')
+
+        self.mode = mode
+
+        if mode == 'process':
+            # Forking a process with running threads is unsafe, start fresh interpreters instead
+            ctx = multiprocessing.get_context('spawn')
+            self.updates = ctx.Queue()
+            self.pool: Executor = ProcessPoolExecutor(
+                max_workers, mp_context=ctx, initializer=init_process_worker, initargs=(self.updates,))
+        else:
+            self.updates = queue.SimpleQueue()
+            self.pool = ThreadPoolExecutor(
+                max_workers, initializer=set_update_channel, initargs=(self.updates,))
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pump: Optional[threading.Thread] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Start relaying job updates from the workers to ``loop``."""
+        self._loop = loop
+        self._pump = threading.Thread(target=self._pump_updates, name='job-update-pump', daemon=True)
+        self._pump.start()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+        if self._pump is not None:
+            self.updates.put(_STOP)
+            self._pump.join()
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Run ``fn`` in the pool, the arguments and result must be picklable in process mode."""
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def _pump_updates(self):
+        while True:
+            update = self.updates.get()
+            if update is _STOP:
+                return
+
+            uid, changes = update
+            self._loop.call_soon_threadsafe(apply_job_update, uid, changes)
+
+
+def apply_job_update(uid: uuid.UUID, changes: dict) -> None:
+    """
+    Apply job state sent by a worker and publish the change.
+    This must be called on the event loop.
+    """
+    job = jobs.get(uid)
+    if job is None:
+        logger.debug('Dropped update for unknown job %s', uid)
+        return
+
+    # The final status is set by the parent once the worker returns,
+    # updates that were still queued at that point are stale
+    if job.is_finished():
+        return
+
+    for field, value in changes.items():
+        setattr(job, field, value)
+
+    job_bus.publish(job)
@@ -0,0 +1,296 @@
+"""
+This module contains the expansion of playlists and channels into download jobs.
+
+The videos of a playlist are listed with yt-dlp's flat extraction, which only requests the
+pages of the playlist instead of every video. Their metadata and artists are then guessed with
+as few Youtube API calls as possible, see :func:`src.metadata.get_metadata_batch`.
+
+Every video gets its own job, which runs through the :class:`src.tasks.scheduler.JobScheduler`
+like a job of ``POST /convert``. The playlist has a parent job whose progress is aggregated from
+the jobs of its videos. At most ``concurrency`` jobs of a playlist are in the scheduler at a time,
+the others wait for their playlist, so a large playlist does not fill the download queue and the
+requests of other users still get slots.
+
+Playlists are not resumed when their worker stops. Only the jobs of a playlist that got a slot
+are stored with their request, those are resumed and the others fail, see :mod:`src.jobstore`.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, List, Optional, Set, Tuple
+
+import yt_dlp
+from yt_dlp.extractor.youtube import YoutubeTabIE
+
+from src.dependencies import active_downloads, artist_registry, job_bus, jobs
+from src.metadata import VideoUnavailable, get_metadata_batch_async
+from src.schemas import DownloadJob, PlaylistRequest, SongMetadataForDownload, Status
+from src.settings import SONGS_STORAGE
+from src.tasks.download import download_key, find_active_download, song_path
+from src.tasks.scheduler import QueueFull
+
+logger = logging.getLogger(__name__)
+
+# The title of a playlist and the ids of its videos in order
+Playlist = Tuple[Optional[str], List[str]]
+
+
+def is_playlist_url(url: str) -> bool:
+    """
+    Whether the url is a Youtube playlist or channel. Other urls must not reach yt-dlp,
+    its generic extractor would request any url, including internal addresses.
+    """
+    return YoutubeTabIE.suitable(url)
+
+
+class YtDlpPlaylistExtractor:
+    """
+    Lists the videos of a playlist or channel with yt-dlp.
+
+    The :class:`PlaylistRunner` calls ``extract(url)`` from a worker thread, any object with
+    that method can stand in for this one, e.g. a fake that needs no network access.
+
+    :param max_videos: the maximum number of videos to list
+    """
+
+    def __init__(self, max_videos: int):
+        self.max_videos = max_videos
+
+    def extract(self, url: str) -> Playlist:
+        """
+        :raises ValueError: if the url is not a playlist or channel
+        :raises yt_dlp.utils.DownloadError: if the playlist can't be listed
+        """
+        if not is_playlist_url(url):
+            raise ValueError(f'{url} is not a playlist or channel')
+
+        options = {
+            # Only list the entries of the playlist
+            'extract_flat': 'in_playlist',
+            'playlistend': self.max_videos,
+            'logger': logger,
+        }
+
+        with yt_dlp.YoutubeDL(options) as ydl:
+            # Only the Youtube tab extractor, not the generic one
+            info = ydl.extract_info(url, download=False, ie_key=YoutubeTabIE.ie_key())
+            if info.get('_type') != 'playlist':
+                raise ValueError(f'{url} is not a playlist or channel')
+
+            video_ids = []
+            for entry in info.get('entries') or []:
+                if entry.get('ie_key') == 'YoutubeTab' and len(video_ids) < self.max_videos:
+                    # Channel pages list their tabs, e.g. videos and live streams
+                    tab = ydl.extract_info(entry['url'], download=False, ie_key=YoutubeTabIE.ie_key())
+                    video_ids.extend(self._video_ids(tab.get('entries') or []))
+                else:
+                    video_ids.extend(self._video_ids([entry]))
+
+        return info.get('title'), list(dict.fromkeys(video_ids))[:self.max_videos]
+
+    @staticmethod
+    def _video_ids(entries: List[dict]) -> List[str]:
+        return [e['id'] for e in entries if e.get('ie_key') == 'Youtube' and e.get('id')]
+
+
+class PlaylistRunner:
+    """
+    Runs the jobs of playlists, every playlist in its own task on the event loop.
+
+    :param scheduler: the scheduler running the jobs of the videos
+    :param extractor: lists the videos of a playlist, see :class:`YtDlpPlaylistExtractor`
+    :param concurrency: the maximum number of jobs of a playlist that are queued or running at a time
+    :param progress_interval: seconds between updates of the progress of a playlist
+    """
+
+    def __init__(self, scheduler, extractor: Any, concurrency: int, progress_interval: float = .5):
+        self.scheduler = scheduler
+        self.extractor = extractor
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, uid: uuid.UUID, req: PlaylistRequest):
+        """
+        Expand the playlist of the parent job ``uid`` and run the jobs of its videos,
+        the job must be in ``jobs``. This must be called on the event loop.
+        """
+        task = asyncio.create_task(self._run(jobs[uid], req))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def close(self):
+        """Stop expanding playlists and submitting their jobs, jobs in the scheduler keep running."""
+        for task in self._tasks:
+            task.cancel()
+
+    async def _run(self, parent: DownloadJob, req: PlaylistRequest):
+        stats = parent.playlist
+
+        try:
+            stats.title, video_ids = await asyncio.get_running_loop().run_in_executor(
+                None, self.extractor.extract, req.url)
+            songs = await self._resolve(video_ids, req)
+        except Exception as e:  # noqa
+            logger.warning('Could not expand playlist %s: %s', req.url, e)
+            stats.error = str(e)
+            parent.status = Status.ERROR
+            parent.last_update = time.time()
+            job_bus.publish(parent)
+            return
+
+        stats.videos = len(video_ids)
+        stats.skipped = len(video_ids) - len(songs)
+
+        # Videos that are being downloaded already are followed instead of downloaded again
+        submit: List[Tuple[uuid.UUID, SongMetadataForDownload]] = []
+        for song in songs:
+            existing = find_active_download(song)
+            if existing is not None:
+                stats.jobs.append(existing.request_id)
+                continue
+
+            child = DownloadJob(request_id=uuid.uuid4(), status=Status.WAITING, percentage_done=0.0,
+                                last_update=time.time())
+            # Without its request until it gets a slot, see _run_child
+            jobs.add(child)
+            active_downloads[download_key(song)] = child.request_id
+            stats.jobs.append(child.request_id)
+            submit.append((child.request_id, song))
+
+        logger.info('Playlist %s has %d videos, running %d jobs, %d skipped',
+                    req.url, stats.videos, len(stats.jobs), stats.skipped)
+        parent.last_update = time.time()
+        job_bus.publish(parent)
+
+        slots = asyncio.Semaphore(self.concurrency)
+        children = [asyncio.create_task(self._run_child(slots, uid, song)) for uid, song in submit]
+        try:
+            await self._report(parent)
+        finally:
+            for child in children:
+                child.cancel()
+
+    async def _resolve(self, video_ids: List[str], req: PlaylistRequest) -> List[SongMetadataForDownload]:
+        """Guess the metadata of the videos, videos without metadata are left out."""
+        artists = artist_registry.current
+        results = await get_metadata_batch_async(video_ids, artists.matcher, artists.lookup, artists.yt_lookup)
+
+        songs = []
+        for video_id, result in results.items():
+            if isinstance(result, Exception):
+                if not isinstance(result, VideoUnavailable):
+                    logger.warning('Skipping video %s of playlist %s: %s', video_id, req.url, result)
+                continue
+
+            song = SongMetadataForDownload(
+                title=result.title,
+                artists=[artist.name for artist, _ in result.artists],
+                album=req.album if req.album is not None else result.album,
+                original_artists=result.original_artists,
+                video_id=video_id,
+                tagger=req.tagger,
+                thumbnail_url=result.thumbnail_url,
+            )
+            try:
+                song_path(SONGS_STORAGE, song)
+            except ValueError as e:
+                logger.warning('Skipping video %s of playlist %s: %s', video_id, req.url, e)
+                continue
+
+            songs.append(song)
+
+        return songs
+
+    async def _run_child(self, slots: asyncio.Semaphore, uid: uuid.UUID, song: SongMetadataForDownload):
+        try:
+            async with slots:
+                try:
+                    # The request is stored only once the job has a slot, so when this worker
+                    # dies at most `concurrency` jobs of the playlist are resumed, the others fail
+                    jobs.add(jobs[uid], song)
+                    task = await self._submit(uid, song)
+                except Exception as e:  # noqa
+                    # E.g. the job expired while it waited for a slot
+                    logger.error('Could not submit job %s of a playlist: %s', uid, e, exc_info=True)
+                    self._fail_unsubmitted(uid, song)
+                    return
+
+                # The job is not cancelled with its playlist
+                await asyncio.shield(task)
+        except asyncio.CancelledError:
+            self._fail_unsubmitted(uid, song)
+            raise
+
+    async def _submit(self, uid: uuid.UUID, song: SongMetadataForDownload) -> asyncio.Task:
+        while True:
+            try:
+                return self.scheduler.submit(uid, song)
+            except QueueFull as e:
+                # The slots of this playlist stay taken, other playlists wait as well
+                await asyncio.sleep(e.retry_after)
+
+    @staticmethod
+    def _fail_unsubmitted(uid: uuid.UUID, song: SongMetadataForDownload):
+        """Fail a job that was not submitted to the scheduler, jobs that were are left alone."""
+        job = jobs.get(uid)
+        if job is not None and not (job.is_waiting() and job.queue_position is None):
+            return
+
+        if job is not None:
+            job.status = Status.ERROR
+            job.last_update = time.time()
+            job_bus.publish(job)
+        if active_downloads.get(download_key(song)) == uid:
+            del active_downloads[download_key(song)]
+
+    async def _report(self, parent: DownloadJob):
+        """Aggregate the progress of the jobs of a playlist into its job until they are all finished."""
+        stats = parent.playlist
+
+        while True:
+            progress = 0.0
+            done = failed = 0
+            # The latest update of a running job, a playlist stalls when all its running jobs stall
+            last_update = None
+            for uid in stats.jobs:
+                # Jobs that expired are counted as failed
+                job = jobs.get(uid)
+                if job is None or Status(job.status) == Status.ERROR:
+                    failed += 1
+                    progress += 1
+                elif Status(job.status) == Status.DONE:
+                    done += 1
+                    progress += 1
+                else:
+                    progress += job.percentage_done
+                    if not job.is_waiting():
+                        last_update = max(last_update or 0, job.last_update)
+
+            if done + failed == len(stats.jobs):
+                # Failed if none of the videos could be downloaded
+                status = Status.DONE if done or not stats.videos else Status.ERROR
+                last_update = time.time()
+            elif last_update is not None:
+                status = Status.DOWNLOADING
+            else:
+                # Every unfinished job is queued
+                status = Status.WAITING
+                last_update = parent.last_update
+
+            update = {
+                'status': status,
+                'percentage_done': progress / len(stats.jobs) if stats.jobs else 1.0,
+                'last_update': max(last_update, parent.last_update),
+            }
+            if any(getattr(parent, k) != v for k, v in update.items()) or (done, failed) != (stats.done, stats.failed):
+                for k, v in update.items():
+                    setattr(parent, k, v)
+                stats.done, stats.failed = done, failed
+                job_bus.publish(parent)
+
+            if parent.is_finished():
+                return
+            await asyncio.sleep(self.progress_interval)
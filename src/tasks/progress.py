@@ -0,0 +1,116 @@
+"""
+This module contains the progress reporting of downloads.
+
+yt-dlp calls its progress hooks for every chunk it receives, which can be many
+times per second. :class:`ProgressReporter` samples these callbacks and only
+publishes a job update when enough time has passed and the progress moved
+enough, so the download thread never waits on listeners.
+"""
+import logging
+import time
+from typing import Callable, Optional
+
+from src.schemas import DownloadJob, Status
+
+logger = logging.getLogger(__name__)
+
+
+def download_fraction(response: dict) -> Optional[float]:
+    """
+    The fraction of the download that is done according to a yt-dlp progress dict.
+
+    :return: the fraction between 0 and 1, or None if the size is unknown
+    """
+    downloaded = response.get('downloaded_bytes')
+    total = response.get('total_bytes') or response.get('total_bytes_estimate')
+
+    if downloaded is not None and total:
+        return min(downloaded / total, 1.0)
+
+    # Fragmented downloads (e.g. DASH) may only report the fragment progress
+    fragment_count = response.get('fragment_count')
+    if response.get('fragment_index') is not None and fragment_count:
+        return min(response['fragment_index'] / fragment_count, 1.0)
+
+    return None
+
+
+class ProgressReporter:
+    """
+    yt-dlp progress hook that updates a job and publishes a sample of the updates.
+
+    :param job: the job to update
+    :param publish: called with the job for every published update, it must not block
+    :param min_interval: the minimum number of seconds between published updates
+    :param min_delta: the minimum change of ``percentage_done`` between published updates
+    :param heartbeat: publish after this many seconds even if the progress did not change
+    """
+
+    def __init__(
+        self,
+        job: DownloadJob,
+        publish: Callable[[DownloadJob], None],
+        min_interval: float = .5,
+        min_delta: float = .01,
+        heartbeat: float = 10,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.job = job
+        self.publish = publish
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.heartbeat = heartbeat
+        self.clock = clock
+
+        # Counters, for checking how much the sampling saves
+        self.calls = 0
+        self.published = 0
+
+        self._published_at = None
+        self._published_fraction = None
+
+    def __call__(self, response: dict):
+        self.calls += 1
+        status = response.get('status')
+
+        if status == 'finished':
+            self.job.percentage_done = 1.0
+            self.job.status = Status.CONVERTING
+            self.job.last_update = time.time()
+            self._publish()
+            logger.debug('Published %d of %d progress updates of job %s',
+                         self.published, self.calls, self.job.request_id)
+            return
+
+        if status != 'downloading':
+            return
+
+        fraction = download_fraction(response)
+        if fraction is not None:
+            self.job.percentage_done = fraction
+        self.job.last_update = time.time()
+
+        if self._should_publish(fraction):
+            self._publish()
+
+    def _should_publish(self, fraction: Optional[float]) -> bool:
+        if self._published_at is None:
+            return True
+
+        elapsed = self.clock() - self._published_at
+        if elapsed >= self.heartbeat:
+            return True
+        if elapsed < self.min_interval or fraction is None:
+            return False
+
+        # Always report reaching the end of the download
+        if fraction == 1.0 and self._published_fraction != 1.0:
+            return True
+
+        return self._published_fraction is None or fraction - self._published_fraction >= self.min_delta
+
+    def _publish(self):
+        self._published_at = self.clock()
+        self._published_fraction = self.job.percentage_done
+        self.published += 1
+        self.publish(self.job)
@@ -0,0 +1,186 @@
+"""
+This module contains the retrying and resuming of interrupted downloads.
+
+yt-dlp keeps a partially downloaded file as ``<name>.part`` and continues it with
+a range request, so a retry only downloads what is missing. Partial files of
+downloads that are never retried are deleted by :func:`cleanup_partial_files`.
+"""
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+import yt_dlp
+from yt_dlp.utils import DownloadError, ExtractorError
+
+logger = logging.getLogger(__name__)
+
+# Files left behind by interrupted downloads and conversions
+_PARTIAL_FILE = re.compile(r'.*\.(part|part-Frag\d+|ytdl|tmp\.mp3)$')
+# Downloaded media in a video directory that was not converted, see `src.tasks.download.song_path`
+_UNCONVERTED_MEDIA = re.compile(r'[0-9a-f]{16}\.(?!mp3$)\w+$')
+
+
+class TransferMeter:
+    """
+    yt-dlp progress hook that counts the bytes received over all attempts of a download.
+
+    Bytes count as re-transferred if they were received by an earlier attempt,
+    which happens when the server does not support resuming.
+    """
+
+    def __init__(self):
+        self.transferred = 0
+        self.retransferred = 0
+
+        # The position in the file of the current attempt, and the furthest position of all attempts
+        self._position = 0
+        self._reached = 0
+        self._lock = threading.Lock()
+
+    def begin_attempt(self, resume_position: int):
+        """
+        :param resume_position: the size of the partial file the attempt starts with
+        """
+        with self._lock:
+            self._position = resume_position
+            self._reached = max(self._reached, resume_position)
+
+    def __call__(self, d: dict):
+        downloaded = d.get('downloaded_bytes')
+        if downloaded is None or d.get('status') not in ('downloading', 'finished'):
+            return
+
+        with self._lock:
+            start = self._position
+            if downloaded < start:
+                # The download started over from the beginning
+                start = 0
+
+            self.transferred += downloaded - start
+            self.retransferred += max(0, min(downloaded, self._reached) - start)
+            self._position = downloaded
+            self._reached = max(self._reached, downloaded)
+
+
+def backoff_delays(retries: int, base: float, maximum: float) -> Iterator[float]:
+    """
+    Exponential backoff with full jitter, the n-th delay is at most ``base * 2 ** n`` seconds.
+    """
+    for attempt in range(retries):
+        yield random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def is_retryable(error: DownloadError) -> bool:
+    """Errors the extractor expects, e.g. an unavailable video, will not go away by retrying."""
+    cause = error.exc_info[1] if error.exc_info else None
+    return not (isinstance(cause, ExtractorError) and cause.expected)
+
+
+def partial_size(output_dir: Path, stem: str) -> int:
+    """The number of bytes of the partial files of a download."""
+    return sum(p.stat().st_size for p in output_dir.glob(f'{stem}.*.part') if p.is_file())
+
+
+def download_with_retry(
+    url: str,
+    ydl_options: dict,
+    output_dir: Path,
+    stem: str,
+    meter: TransferMeter,
+    retries: int,
+    backoff_base: float,
+    backoff_max: float,
+    on_retry: Optional[Callable[[int, DownloadError], None]] = None,
+    sleep: Callable[[float], None] = time.sleep,
+) -> int:
+    """
+    Download ``url`` with yt-dlp, retrying with exponential backoff.
+    Every retry continues the partial file of the previous attempt.
+
+    :param url: the url of the video
+    :param ydl_options: the yt-dlp options, ``meter`` must be one of the progress hooks
+    :param output_dir: the directory the download is written to
+    :param stem: the file name of the download without extension
+    :param meter: counts the bytes received
+    :param retries: the maximum number of retries
+    :param backoff_base: the maximum delay in seconds before the first retry
+    :param backoff_max: the maximum delay in seconds before any retry
+    :param on_retry: called with the number of the retry and the error before waiting for a retry
+    :param sleep: waits the given number of seconds
+    :return: the number of attempts
+    :raises DownloadError: if the last attempt failed or the error is not retryable
+    """
+    ydl_options = {
+        **ydl_options,
+        # Retries are done here, so every retry is delayed and counted
+        'retries': 0,
+        'continuedl': True,
+    }
+    delays = backoff_delays(retries, backoff_base, backoff_max)
+    attempt = 0
+
+    while True:
+        attempt += 1
+        meter.begin_attempt(partial_size(output_dir, stem))
+        try:
+            with yt_dlp.YoutubeDL(ydl_options) as ydl:
+                ydl.download([url])
+            return attempt
+        except DownloadError as e:
+            delay = next(delays, None)
+            if delay is None or not is_retryable(e):
+                raise
+
+            logger.warning('Download of %s failed (attempt %d), retrying in %.1fs: %s', url, attempt, delay, e)
+            if on_retry is not None:
+                on_retry(attempt, e)
+            sleep(delay)
+
+
+def cleanup_partial_files(storage_dir: Path, max_age: float) -> int:
+    """
+    Delete the partial files of interrupted downloads and conversions that were
+    not modified for ``max_age`` seconds, and downloaded media that was never converted.
+
+    :return: the number of deleted files
+    """
+    if not storage_dir.exists():
+        return 0
+
+    expired_before = time.time() - max_age
+    deleted = 0
+
+    for path in storage_dir.rglob('*'):
+        if not (_PARTIAL_FILE.fullmatch(path.name) or _UNCONVERTED_MEDIA.fullmatch(path.name)):
+            continue
+
+        try:
+            if path.is_file() and path.stat().st_mtime < expired_before:
+                path.unlink()
+                deleted += 1
+        except FileNotFoundError:
+            # Finished or deleted while cleaning up
+            continue
+
+    if deleted:
+        logger.info('Deleted %d partial files from %s', deleted, storage_dir)
+
+    return deleted
+
+
+async def cleanup_partial_files_periodically(storage_dir: Path, max_age: float, interval: float):
+    """Run :func:`cleanup_partial_files` every ``interval`` seconds, until cancelled."""
+    loop = asyncio.get_running_loop()
+
+    while True:
+        try:
+            await loop.run_in_executor(None, cleanup_partial_files, storage_dir, max_age)
+        except Exception as e:  # noqa
+            logger.error('Cleaning up partial files failed: %s', e, exc_info=True)
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,197 @@
+"""
+This module contains the scheduler that admits download jobs and runs their stages.
+
+Every job has a download stage (network bound) and a convert stage (CPU bound),
+which have their own number of slots. A job keeps its download slot until it gets
+a convert slot, so downloads pause when conversion can't keep up. Jobs waiting for
+a download slot are queued in order, and new jobs are refused when the queue is full.
+"""
+import asyncio
+import collections
+import logging
+import math
+import time
+import uuid
+import weakref
+from typing import Deque, Set, Tuple
+
+from src import metrics
+from src.dependencies import active_downloads, job_bus, jobs
+from src.schemas import DownloadJob, SongMetadataForDownload, Status
+from src.tasks.download import convert_worker, download_key, download_worker
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is full.
+
+    :param retry_after: the estimated number of seconds until there is room in the queue
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'Download queue is full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class JobScheduler:
+    """
+    Admission control and per stage concurrency limits for download jobs.
+
+    :param executor: the executor to run the stages of jobs in, see :class:`src.tasks.executor.DownloadExecutor`
+    :param download_slots: the maximum number of concurrent downloads
+    :param convert_slots: the maximum number of concurrent conversions
+    :param max_queued: the maximum number of jobs waiting for a download slot
+    """
+
+    def __init__(self, executor, download_slots: int, convert_slots: int, max_queued: int):
+        self.executor = executor
+        self.download_slots = download_slots
+        self.convert_slots = convert_slots
+        self.max_queued = max_queued
+
+        self._download = asyncio.Semaphore(download_slots)
+        self._convert = asyncio.Semaphore(convert_slots)
+
+        # Jobs waiting for a download slot, in order
+        self._queue: Deque[uuid.UUID] = collections.deque()
+        self._tasks: Set[asyncio.Task] = set()
+
+        # Jobs of the same video run one at a time, so only the first downloads
+        # the video and the others re-tag its stored audio
+        self._media_locks: 'weakref.WeakValueDictionary[Tuple[str, str], asyncio.Lock]' = \
+            weakref.WeakValueDictionary()
+
+        # Moving average of the time a job holds its download slot, for estimating Retry-After
+        self._slot_time = 30.0
+
+        self.downloading = 0
+        self.converting = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def retry_after(self) -> int:
+        """The estimated number of seconds until a queued job gets a download slot."""
+        return max(1, math.ceil(self._slot_time * (len(self._queue) + 1) / self.download_slots))
+
+    def submit(self, uid: uuid.UUID, req: SongMetadataForDownload) -> asyncio.Task:
+        """
+        Queue the job ``uid`` for the song ``req``, the job must be in ``jobs``.
+        This must be called on the event loop.
+
+        :raises QueueFull: if there are ``max_queued`` jobs waiting already
+        :return: the task running the job, it finishes when the job is finished
+        """
+        if len(self._queue) >= self.max_queued:
+            raise QueueFull(self.retry_after())
+
+        job = jobs[uid]
+        self._queue.append(uid)
+        job.queue_position = len(self._queue)
+        active_downloads[download_key(req)] = uid
+
+        task = asyncio.create_task(self._run(uid, req))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def resume(self, uid: uuid.UUID, req: SongMetadataForDownload):
+        """
+        Queue an interrupted job again, the job fails if the queue is full.
+        This must be called on the event loop.
+        """
+        try:
+            self.submit(uid, req)
+        except QueueFull:
+            job = jobs[uid]
+            job.status = Status.ERROR
+            job.queue_position = None
+            logger.warning('Could not resume job %s, the queue is full', uid)
+
+        job_bus.publish(jobs[uid])
+
+    def _publish_positions(self):
+        for position, uid in enumerate(self._queue, start=1):
+            job = jobs.get(uid)
+            if job is not None and job.queue_position != position:
+                job.queue_position = position
+                job_bus.publish(job)
+
+    async def _run(self, uid: uuid.UUID, req: SongMetadataForDownload):
+        job = jobs[uid]
+        key = download_key(req)
+        lock = self._media_locks.setdefault(key[:2], asyncio.Lock())
+
+        try:
+            async with lock:
+                await self._download.acquire()
+                download_released = False
+                slot_start = time.monotonic()
+
+                self._queue.remove(uid)
+                self._publish_positions()
+                job.queue_position = None
+                try:
+                    job.status = Status.DOWNLOADING
+                    job.last_update = time.time()
+                    logger.debug('Starting download job, job=%s', id(job))
+                    job_bus.publish(job)
+
+                    self.downloading += 1
+                    try:
+                        # The worker gets its own copy of the job,
+                        # so it can be sent to another process
+                        fields, action, media_file = await self.executor.run(
+                            download_worker, req, DownloadJob(**job.dict()))
+                    finally:
+                        self.downloading -= 1
+                    self._apply(job, fields)
+
+                    # Hand the download slot over to a convert slot
+                    async with self._convert:
+                        self._download.release()
+                        download_released = True
+                        self._record_slot_time(slot_start)
+
+                        job.status = Status.CONVERTING
+                        job.last_update = time.time()
+                        job_bus.publish(job)
+
+                        self.converting += 1
+                        try:
+                            fields = await self.executor.run(
+                                convert_worker, req, DownloadJob(**job.dict()), action, media_file)
+                        finally:
+                            self.converting -= 1
+                        self._apply(job, fields)
+                except Exception as e:  # noqa
+                    logger.error(e, exc_info=True)
+                    job.status = Status.ERROR
+                    metrics.observe_job(job, 'error')
+                else:
+                    logger.debug('Job finished, job=%s', id(job))
+                    job.status = Status.DONE
+                    metrics.observe_job(job, 'done')
+                finally:
+                    if not download_released:
+                        self._download.release()
+                        self._record_slot_time(slot_start)
+                    job_bus.publish(job)
+        finally:
+            if uid in self._queue:
+                # Cancelled while queued
+                self._queue.remove(uid)
+                self._publish_positions()
+            if active_downloads.get(key) == uid:
+                del active_downloads[key]
+
+    def _record_slot_time(self, start: float):
+        self._slot_time = .8 * self._slot_time + .2 * (time.monotonic() - start)
+
+    @staticmethod
+    def _apply(job: DownloadJob, fields: dict):
+        for field, value in fields.items():
+            setattr(job, field, value)
@@ -0,0 +1,211 @@
+"""
+This module contains the on-disk cache of the thumbnails embedded as album covers.
+
+Thumbnails are stored in the cache directory by the digest of their url, so songs
+of the same video or channel fetch the image once. The cache is bounded in size,
+the least recently used thumbnails are evicted first. Thumbnails can optionally be
+downscaled and recompressed before they are cached, which keeps the song files small.
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import ffmpeg
+
+from src.metadata import fetch_thumbnail
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    """
+    Size-bounded LRU cache of thumbnails on disk, safe to share between threads and processes.
+
+    The modification time of a cached file is its last use, so evicting
+    does not need any state besides the files.
+
+    :param cache_dir: the directory to store thumbnails in
+    :param max_bytes: the maximum total size of the cached thumbnails
+    :param max_dimension: downscale thumbnails to fit in a square of this size, 0 keeps the original image
+    :param quality: the JPEG quality of recompressed thumbnails, from 2 (best) to 31
+    :param fetch_workers: the number of threads for prefetching thumbnails
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, max_dimension: int = 0, quality: int = 3,
+                 fetch_workers: int = 2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.fetch_workers = fetch_workers
+
+        self._lock = threading.Lock()
+        # Fetches in progress by url, concurrent requests for the same thumbnail wait on the same fetch
+        self._fetches: Dict[str, concurrent.futures.Future] = {}
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # Size of the cache as seen by this process, None until the directory was scanned
+        self._size: Optional[int] = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, url: str) -> Path:
+        """The cache path of a thumbnail, thumbnails processed with other settings have a different path."""
+        key = f'{url}\n{self.max_dimension}\n{self.quality if self.max_dimension else ""}'
+        return self.cache_dir / f'{hashlib.sha256(key.encode()).hexdigest()[:32]}.jpg'
+
+    def get(self, url: str) -> Path:
+        """
+        Get the path of a cached thumbnail, fetching it if it is not cached.
+        Waits for the prefetch of the thumbnail if there is one.
+
+        :param url: the url of the thumbnail
+        :return: the path of the cached image
+        """
+        path = self.path(url)
+        if self._touch(path):
+            self.hits += 1
+            return path
+
+        with self._lock:
+            future = self._fetches.get(url)
+
+        if future is not None:
+            return future.result()
+
+        self.misses += 1
+        return self._fetch(url, path)
+
+    def prefetch(self, url: str) -> concurrent.futures.Future:
+        """
+        Fetch a thumbnail in the background, e.g. while the song is downloading.
+
+        :return: a future of the path of the cached image
+        """
+        path = self.path(url)
+
+        with self._lock:
+            future = self._fetches.get(url)
+            if future is not None:
+                return future
+
+            if path.exists():
+                future = concurrent.futures.Future()
+                future.set_result(path)
+                return future
+
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.fetch_workers, thread_name_prefix='thumbnail')
+
+            future = self._executor.submit(self._fetch, url, path)
+            self._fetches[url] = future
+
+        self.misses += 1
+        future.add_done_callback(lambda _: self._forget(url, future))
+        return future
+
+    def _forget(self, url: str, future: concurrent.futures.Future):
+        with self._lock:
+            if self._fetches.get(url) is future:
+                del self._fetches[url]
+
+    @staticmethod
+    def _touch(path: Path) -> bool:
+        """Mark a cached thumbnail as used, returns whether it is cached."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _fetch(self, url: str, path: Path) -> Path:
+        start = time.perf_counter()
+        image, mime_type = fetch_thumbnail(url)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.stem}.{threading.get_ident()}.tmp')
+        try:
+            tmp_path.write_bytes(image)
+            # Thumbnails are stored as jpeg, others are converted even if they are not downscaled
+            if self.max_dimension or mime_type != 'image/jpeg':
+                self._convert(tmp_path, url)
+
+            size = tmp_path.stat().st_size
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        logger.debug('Cached thumbnail %s (%d bytes) in %.2fs', url, size, time.perf_counter() - start)
+        self._add_size(size)
+        return path
+
+    def _convert(self, image_path: Path, url: str):
+        """Recompress an image to jpeg in place, downscaling it if it is larger than the max dimension."""
+        out_path = image_path.with_suffix('.jpg.tmp')
+        stream = ffmpeg.input(str(image_path))
+        if self.max_dimension:
+            stream = stream.filter(
+                'scale',
+                f'min(iw,{self.max_dimension})',
+                f'min(ih,{self.max_dimension})',
+                force_original_aspect_ratio='decrease',
+            )
+
+        try:
+            (stream
+             .output(str(out_path), format='mjpeg', vframes=1, **{'q:v': self.quality})
+             .overwrite_output()
+             .run(quiet=True))
+            os.replace(out_path, image_path)
+        except ffmpeg.Error as e:
+            # The original image is still better than no cover
+            logger.warning('Could not convert thumbnail %s, keeping the original: %s',
+                           url, e.stderr.decode(errors='replace'))
+        finally:
+            out_path.unlink(missing_ok=True)
+
+    def _add_size(self, size: int):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        files = []
+        for path in self.cache_dir.glob('*.jpg'):
+            try:
+                stat_result = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat_result.st_mtime, stat_result.st_size, path))
+
+        return files, sum(size for _, size, _ in files)
+
+    def _evict(self):
+        """Delete the least recently used thumbnails until the cache is below 90% of its size."""
+        files, self._size = self._scan()
+        target = self.max_bytes * .9
+        evicted = 0
+
+        for _, size, path in sorted(files):
+            if self._size <= target:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+            evicted += 1
+
+        logger.info('Evicted %d thumbnails, %d bytes cached', evicted, self._size)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)